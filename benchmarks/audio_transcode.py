@@ -0,0 +1,58 @@
+"""Compare per-request latency and peak memory of the pydub and streamed ffmpeg audio paths.
+
+Generates a webm/opus test clip with ffmpeg, then transcodes it to MP3 with each mode.
+
+Usage: python -m benchmarks.audio_transcode [--seconds 60] [--repeat 3]
+"""
+import argparse
+import io
+import resource
+import subprocess
+import time
+import tracemalloc
+
+from src.audio.utils import transcode_audio
+
+
+def make_webm(seconds: int) -> bytes:
+    """Synthesize a speech-like webm/opus clip."""
+    return subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+         "-i", f"sine=frequency=440:duration={seconds}", "-c:a", "libopus", "-f", "webm", "pipe:1"],
+        check=True, capture_output=True
+    ).stdout
+
+
+def measure(mode: str, webm: bytes, repeat: int):
+    timings = []
+    peak = 0
+    output_size = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        # Feed a stream, like an uploaded file, so the ffmpeg path never holds the whole input
+        output, _ = transcode_audio(io.BufferedReader(io.BytesIO(webm)), "audio/webm", mode=mode)
+        timings.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        output_size = len(output)
+    return min(timings), peak, output_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    webm = make_webm(args.seconds)
+    print(f"input: {len(webm)} bytes of webm ({args.seconds}s)")
+    print(f"{'mode':<12} {'latency ms':>12} {'peak py MB':>12} {'output bytes':>14}")
+    for mode in ["pydub", "ffmpeg", "passthrough"]:
+        latency, peak, output_size = measure(mode, webm, args.repeat)
+        print(f"{mode:<12} {latency * 1000:>12.1f} {peak / 1024 / 1024:>12.2f} {output_size:>14}")
+    print(f"max rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Compare jsonpickle with the segment codec used by src.chat.history.
+
+Usage: python -m benchmarks.chat_history_codec [--repeat 5]
+"""
+import argparse
+import json
+import time
+
+import jsonpickle
+from vertexai.generative_models import Content, Part
+
+from src.chat.history import encode_contents, decode_contents
+
+TURN_COUNTS = [10, 100, 1000]
+
+
+def build_history(turns: int):
+    """Build a history of question, function call, SQL result and answer turns."""
+    rows = [{'patient_id': i, 'age': 40 + i % 50, 'a1c': 6.5 + (i % 30) / 10} for i in range(25)]
+    history = []
+    for i in range(turns):
+        if i % 4 == 0:
+            history.append(Content(role="user", parts=[Part.from_text(f"How many diabetic patients over {60 + i % 10}?")]))
+        elif i % 4 == 1:
+            history.append(Content.from_dict({
+                'role': 'model',
+                'parts': [{'function_call': {'name': 'get_diabetes_data_output',
+                                             'args': {'question': f"patients over {60 + i % 10}"}}}]
+            }))
+        elif i % 4 == 2:
+            history.append(Content(role="user", parts=[Part.from_function_response(
+                name='get_diabetes_data_output',
+                response={'content': {'output_answer': json.dumps(rows),
+                                      'queries_used_for_output_answer': "SELECT COUNT(*) FROM patients"}}
+            )]))
+        else:
+            history.append(Content(role="model", parts=[Part.from_text("There are 1,234 patients. " * 8)]))
+    return history
+
+
+def measure(fn, repeat: int):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'turns':>6} {'codec':<12} {'encode ms':>10} {'decode ms':>10} {'bytes':>12}")
+    for turns in TURN_COUNTS:
+        history = build_history(turns)
+        codecs = {
+            'jsonpickle': (lambda: jsonpickle.encode(history, True).encode('utf-8'),
+                           lambda data: jsonpickle.decode(data.decode('utf-8'))),
+            'json': (lambda: encode_contents(history, compress=False), decode_contents),
+            'json+gzip': (lambda: encode_contents(history, compress=True), decode_contents),
+        }
+        for name, (encode, decode) in codecs.items():
+            encode_time, data = measure(encode, args.repeat)
+            decode_time, _ = measure(lambda: decode(data), args.repeat)
+            print(f"{turns:>6} {name:<12} {encode_time * 1000:>10.2f} {decode_time * 1000:>10.2f} {len(data):>12}")
+
+
+if __name__ == '__main__':
+    main()
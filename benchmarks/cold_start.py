@@ -0,0 +1,146 @@
+"""Cold-start benchmark: import-time profile of main.py and time-to-first-response of the server.
+
+Profiles `import main` with `python -X importtime` in a fresh interpreter and lists the slowest
+modules, then starts the server (gunicorn as in production, or the development server) and
+measures how long it takes to answer /hello-world and to report ready on /readyz. Exits with
+status 1 when time-to-first-response exceeds the budget.
+
+Usage: python -m benchmarks.cold_start [--server gunicorn|dev] [--budget 2.0] [--top 15]
+       [--repeat 3] [--save]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "import_profile.json")
+
+# Seconds from process start to the first response, override with COLD_START_BUDGET
+DEFAULT_BUDGET = float(os.getenv("COLD_START_BUDGET", 2.0))
+
+
+def import_profile(module: str = "main"):
+    """Import module in a fresh interpreter, returning the total seconds and per-module timings.
+
+    Each entry has the module name, its own import time and the cumulative time including the
+    modules it imported first, all in milliseconds.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append({
+            'module': name.strip(),
+            'self_ms': int(self_us) / 1000,
+            'cumulative_ms': int(cumulative_us) / 1000,
+        })
+    total = next(entry['cumulative_ms'] for entry in modules if entry['module'] == module) / 1000
+    return total, modules
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def poll(url: str, deadline: float, expect_ok: bool = True):
+    """Poll url until it answers (with a 2xx status when expect_ok), returning the time it did."""
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return time.monotonic()
+        except urllib.error.HTTPError:
+            if not expect_ok:
+                return time.monotonic()
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def measure_server(server: str, timeout: float):
+    """Start the server and time its first response and its readiness, in seconds from launch."""
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), SQL_AGENT_WARMUP="false")
+    if server == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"]
+    else:
+        command = [sys.executable, "main.py"]
+
+    start = time.monotonic()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = start + timeout
+        first_response = poll(f"http://127.0.0.1:{port}/hello-world", deadline)
+        ready = poll(f"http://127.0.0.1:{port}/readyz", deadline) if first_response else None
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def elapsed(at):
+        return round(at - start, 3) if at else None
+
+    return {'first_response': elapsed(first_response), 'ready': elapsed(ready)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=["gunicorn", "dev"], default="gunicorn")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="max seconds to first response")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--repeat", type=int, default=3, help="server starts to measure (the best is used)")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the server")
+    parser.add_argument("--save", action="store_true", help=f"record the import profile in {PROFILE_PATH}")
+    args = parser.parse_args()
+
+    total, modules = import_profile()
+    print(f"import main: {total:.3f}s")
+    print(f"{'module':<50} {'self ms':>9} {'cumulative ms':>14}")
+    for entry in sorted(modules, key=lambda entry: entry['self_ms'], reverse=True)[:args.top]:
+        print(f"{entry['module']:<50} {entry['self_ms']:>9.1f} {entry['cumulative_ms']:>14.1f}")
+
+    runs = [measure_server(args.server, args.timeout) for _ in range(args.repeat)]
+    print(f"\n{args.server} starts: {runs}")
+    first_responses = [run['first_response'] for run in runs if run['first_response'] is not None]
+    first_response = min(first_responses) if first_responses else None
+    readies = [run['ready'] for run in runs if run['ready'] is not None]
+    print(f"time to first response: {first_response}s (budget {args.budget}s)")
+    print(f"time to ready: {min(readies) if readies else None}s")
+
+    if args.save:
+        os.makedirs(os.path.dirname(PROFILE_PATH), exist_ok=True)
+        with open(PROFILE_PATH, "w") as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'import_main_seconds': round(total, 3),
+                'server': args.server,
+                'time_to_first_response': first_response,
+                'time_to_ready': min(readies) if readies else None,
+                # Modules taking at least a millisecond, slowest (cumulative) first
+                'modules': sorted((entry for entry in modules if entry['cumulative_ms'] >= 1),
+                                  key=lambda entry: entry['cumulative_ms'], reverse=True),
+            }, f, indent=2)
+        print(f"Saved import profile to {PROFILE_PATH}")
+
+    if first_response is None or first_response > args.budget:
+        print("FAIL: time to first response over budget")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
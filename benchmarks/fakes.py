@@ -0,0 +1,481 @@
+"""Local stand-ins for the Google Cloud, Firebase and model backends used by the app.
+
+Every fake sleeps for a configurable latency (with jitter) so the app behaves like it waits
+on the network, and keeps its state in memory. install() wires them into the app through the
+client registry and the module level hooks the app already exposes.
+"""
+import random
+import re
+import threading
+import time
+import types
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+from google.api_core.exceptions import NotFound, NotModified, PreconditionFailed
+from vertexai.generative_models import Content, GenerationResponse, Part
+
+
+class FakeBackendError(Exception):
+    """Raised by a fake backend when a scripted Fault fails the call."""
+
+
+class Fault:
+    """Scripted misbehaviour of a backend: each call fails with probability error_rate and
+    otherwise stalls for stall seconds with probability stall_rate; down fails every call."""
+
+    def __init__(self, error_rate: float = 0.0, stall_rate: float = 0.0, stall: float = 30.0, down: bool = False):
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.down = down
+        self.stats = {'errors': 0, 'stalls': 0}
+
+    def apply(self, name: str):
+        if self.down or random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            raise FakeBackendError(f"Scripted failure of {name}")
+        if random.random() < self.stall_rate:
+            self.stats['stalls'] += 1
+            time.sleep(self.stall)
+
+
+class Latency:
+    """Simulated round-trip latencies in seconds, applied with +/- jitter.
+
+    faults maps a latency name (e.g. "llm") or a model name to the Fault applied to its calls.
+    """
+
+    def __init__(self, storage: float = 0.02, firestore: float = 0.02, tasks: float = 0.03,
+                 auth: float = 0.005, remote_config: float = 0.1, llm: float = 0.5,
+                 sql_llm: float = 0.3, embedding: float = 0.05, jitter: float = 0.5,
+                 faults: Optional[Dict[str, Fault]] = None):
+        self.storage = storage
+        self.firestore = firestore
+        self.tasks = tasks
+        self.auth = auth
+        self.remote_config = remote_config
+        self.llm = llm
+        self.sql_llm = sql_llm
+        self.embedding = embedding
+        self.jitter = jitter
+        self.faults = faults or {}
+
+    def wait(self, name: str, model: Optional[str] = None):
+        seconds = getattr(self, name)
+        if seconds > 0:
+            time.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+        fault = self.faults.get(model) or self.faults.get(name)
+        if fault:
+            fault.apply(model or name)
+
+    def to_dict(self):
+        return {name: value for name, value in vars(self).items() if name != 'faults'}
+
+
+# Google Cloud Storage
+
+class FakeBlob:
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def generation(self) -> Optional[int]:
+        entry = self.bucket.objects.get(self.name)
+        return entry['generation'] if entry else None
+
+    def exists(self) -> bool:
+        self.bucket.latency.wait("storage")
+        return self.name in self.bucket.objects
+
+    def reload(self):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.name}")
+
+    def upload_from_string(self, data, content_type: Optional[str] = None, if_generation_match: Optional[int] = None):
+        self.bucket.latency.wait("storage")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.bucket.lock:
+            entry = self.bucket.objects.get(self.name)
+            if if_generation_match is not None and (entry['generation'] if entry else 0) != if_generation_match:
+                raise PreconditionFailed(f"Precondition failed for {self.name}")
+            self.bucket.generation += 1
+            self.bucket.objects[self.name] = {
+                'data': bytes(data),
+                'content_type': content_type,
+                'generation': self.bucket.generation,
+            }
+        self.bucket.stats['uploads'] += 1
+
+    def download_as_bytes(self, if_generation_not_match: Optional[int] = None, **kwargs) -> bytes:
+        self.bucket.latency.wait("storage")
+        entry = self.bucket.objects.get(self.name)
+        if entry is None:
+            raise NotFound(f"No such object: {self.name}")
+        if if_generation_not_match is not None and entry['generation'] == if_generation_not_match:
+            raise NotModified(f"Not modified: {self.name}")
+        self.bucket.stats['downloads'] += 1
+        return entry['data']
+
+    def download_as_text(self, **kwargs) -> str:
+        return self.download_as_bytes(**kwargs).decode("utf-8")
+
+    def delete(self):
+        self.bucket.latency.wait("storage")
+        with self.bucket.lock:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise NotFound(f"No such object: {self.name}")
+
+
+class FakeBucket:
+    def __init__(self, name: str, latency: Latency):
+        self.name = name
+        self.latency = latency
+        self.objects: Dict[str, dict] = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.stats = {'uploads': 0, 'downloads': 0, 'lists': 0}
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix: str = ""):
+        self.latency.wait("storage")
+        self.stats['lists'] += 1
+        with self.lock:
+            names = sorted(name for name in self.objects if name.startswith(prefix))
+        return [FakeBlob(self, name) for name in names]
+
+
+class FakeStorageClient:
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self._buckets: Dict[str, FakeBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name: str) -> FakeBucket:
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(name, self.latency)
+            return self._buckets[name]
+
+    def stats(self):
+        return {name: dict(bucket.stats, objects=len(bucket.objects)) for name, bucket in self._buckets.items()}
+
+
+# Firestore
+
+class FakeDocumentReference:
+    def __init__(self, db, path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str):
+        return FakeCollectionReference(self._db, f"{self.path}/{name}")
+
+    def set(self, data: dict, merge: bool = False):
+        self._db.latency.wait("firestore")
+        self._db.write(self.path, data, merge)
+
+    def update(self, data: dict):
+        self.set(data, merge=True)
+
+    def get(self):
+        self._db.latency.wait("firestore")
+        data = self._db.documents.get(self.path)
+        return types.SimpleNamespace(id=self.id, exists=data is not None, to_dict=lambda: dict(data or {}))
+
+
+class FakeCollectionReference:
+    def __init__(self, db, path: str):
+        self._db = db
+        self.path = path
+
+    def document(self, document_id: Optional[str] = None):
+        return FakeDocumentReference(self._db, f"{self.path}/{document_id or format(random.getrandbits(64), 'x')}")
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data: dict, merge: bool = False):
+        self._writes.append((reference.path, data, merge))
+
+    def update(self, reference, data: dict):
+        self._writes.append((reference.path, data, True))
+
+    def commit(self):
+        self._db.latency.wait("firestore")
+        for path, data, merge in self._writes:
+            self._db.write(path, data, merge)
+        self._db.stats['commits'] += 1
+
+
+class FakeFirestoreClient:
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.documents: Dict[str, dict] = {}
+        self.stats = {'writes': 0, 'commits': 0}
+        self._lock = threading.Lock()
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def write(self, path: str, data: dict, merge: bool):
+        with self._lock:
+            document = dict(self.documents.get(path, {})) if merge else {}
+            document.update(data)
+            self.documents[path] = document
+            self.stats['writes'] += 1
+
+
+# Cloud Tasks
+
+class FakeTasksClient:
+    """Records created tasks without calling back into the app."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.tasks = 0
+
+    def queue_path(self, project, location, queue):
+        return f"projects/{project}/locations/{location}/queues/{queue}"
+
+    def create_task(self, request):
+        self.latency.wait("tasks")
+        self.tasks += 1
+        return types.SimpleNamespace(name=f"{request['parent']}/tasks/{self.tasks}")
+
+
+# Firebase Auth
+
+class FakeAuth:
+    """Stand-in for firebase_admin.auth.verify_id_token: the token is the user id."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.verified = 0
+
+    def verify_id_token(self, id_token: str, app=None, check_revoked: bool = False, clock_skew_seconds: int = 0):
+        self.latency.wait("auth")
+        self.verified += 1
+        now = int(time.time())
+        return {'uid': id_token, 'iat': now, 'exp': now + 3600}
+
+
+# Remote Config
+
+class FakeRemoteConfig:
+    """Serves a fixed template with ETag support, like fetch_remote_config."""
+
+    def __init__(self, latency: Latency, prompt_files: Dict[str, str], version: str = "1"):
+        self.latency = latency
+        self.etag = f"etag-{version}"
+        self.fetches = 0
+        self.template = {
+            'version': {'versionNumber': version},
+            'parameterGroups': {
+                'Prompts': {
+                    'parameters': {
+                        key: {'valueType': 'JSON', 'defaultValue': {'value': f'{{"fileName": "{file_name}"}}'}}
+                        for key, file_name in prompt_files.items()
+                    }
+                }
+            }
+        }
+
+    def fetch(self, etag: Optional[str] = None):
+        self.latency.wait("remote_config")
+        self.fetches += 1
+        if etag == self.etag:
+            return "not-modified", etag
+        return self.template, self.etag
+
+
+# Vertex AI Gemini
+
+def _to_content(role: str, message) -> Content:
+    items = message if isinstance(message, list) else [message]
+    parts = [Part.from_text(item) if isinstance(item, str) else item for item in items]
+    return Content(role=role, parts=parts)
+
+
+def _response(parts: List[dict]) -> GenerationResponse:
+    return GenerationResponse.from_dict({'candidates': [{'content': {'role': 'model', 'parts': parts}}]})
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self._model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream: bool = False):
+        message = _to_content("user", content)
+        self._model.latency.wait("llm", self._model.model_name)
+        self._model.stats['calls'] += 1
+        parts = self._model.reply(message)
+        if not stream:
+            self.history.extend([message, Content.from_dict({'role': 'model', 'parts': parts})])
+            return _response(parts)
+        return self._stream(message, parts)
+
+    def _stream(self, message, parts):
+        text = "".join(part.get('text', '') for part in parts)
+        words = text.split(" ")
+        for index in range(0, len(words), 8):
+            yield _response([{'text': " ".join(words[index:index + 8]) + " "}])
+        self.history.extend([message, Content.from_dict({'role': 'model', 'parts': parts})])
+
+
+class FakeGenerativeModel:
+    """Scripted GenerativeModel: with tools it calls get_diabetes_data_output with the user's
+    text, otherwise it answers with a summary of the last message."""
+
+    stats = {'models': 0, 'calls': 0}
+    latency = Latency()
+    answer_words = 120
+
+    def __init__(self, model_name: str, system_instruction=None, generation_config=None,
+                 safety_settings=None, tools=None, tool_config=None):
+        self.model_name = model_name
+        self.tools = tools
+        FakeGenerativeModel.stats['models'] += 1
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    def generate_content(self, contents, **kwargs):
+        self.latency.wait("llm", self.model_name)
+        self.stats['calls'] += 1
+        return _response([{'text': self._summary(str(contents))}])
+
+    def _summary(self, text: str) -> str:
+        words = re.findall(r"\w+", text)[:self.answer_words] or ["No", "answer"]
+        return " ".join(words[index % len(words)] for index in range(self.answer_words))
+
+    def reply(self, message: Content) -> List[dict]:
+        message_dict = message.to_dict()
+        texts = [part['text'] for part in message_dict['parts'] if 'text' in part]
+        if self.tools and texts:
+            return [{'function_call': {'name': 'get_diabetes_data_output', 'args': {'question': " ".join(texts)}}}]
+        return [{'text': self._summary(str(message_dict))}]
+
+
+# LangChain LLM used by the SQL fast path
+
+class FakeSQLLLM:
+    """Answers FAST_PATH_PROMPT prompts with the scripted SQL for the question."""
+
+    def __init__(self, latency: Latency, sql_for_question: Callable[[str], Optional[str]],
+                 model_name: str = "claude-3-5-sonnet@20240620"):
+        self.latency = latency
+        self.sql_for_question = sql_for_question
+        self.model_name = model_name
+        self.calls = 0
+
+    def invoke(self, prompt, config: Optional[dict] = None, **kwargs):
+        # Callbacks see the call start, as with a LangChain model
+        for callback in (config or {}).get('callbacks', []):
+            callback.on_llm_start({}, [prompt], run_id=uuid4())
+        self.latency.wait("sql_llm", self.model_name)
+        self.calls += 1
+        question = prompt.rsplit("Question:", 1)[-1].strip()
+        sql = self.sql_for_question(question)
+        return f"```sql\n{sql}\n```" if sql else "CANNOT_ANSWER"
+
+
+# Embeddings used by the answer cache
+
+class FakeEmbeddingModel:
+    """Bag-of-words hashing embeddings: identical questions map to identical vectors."""
+
+    def __init__(self, latency: Latency, dimensions: int = 64):
+        self.latency = latency
+        self.dimensions = dimensions
+
+    def get_embeddings(self, texts: List[str]):
+        self.latency.wait("embedding")
+        embeddings = []
+        for text in texts:
+            values = [0.0] * self.dimensions
+            for word in re.findall(r"\w+", text.lower()):
+                values[hash(word) % self.dimensions] += 1.0
+            embeddings.append(types.SimpleNamespace(values=values))
+        return embeddings
+
+
+# Anthropic Claude
+
+class FakeAnthropicClient:
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.messages = self
+
+    def create(self, messages, model: Optional[str] = None, **kwargs):
+        self.latency.wait("llm", model)
+        words = re.findall(r"\w+", str(messages[-1]['content']))[-6:]
+        return types.SimpleNamespace(content=[types.SimpleNamespace(text=" ".join(words).title())])
+
+
+def install(latency: Latency, prompts: Dict[str, str], prompt_files: Dict[str, str],
+            sql_for_question: Callable[[str], Optional[str]], bucket_name: str):
+    """Replace every external backend of the app with a local fake.
+
+    prompts maps prompt file names to their text (stored in the fake bucket) and prompt_files
+    maps Remote Config keys of the Prompts group to those file names. Must run before main is
+    imported so its startup threads use the fakes. Returns the fakes by name.
+    """
+    import firebase_admin.auth
+    import vertexai
+
+    import src.chat.models as models
+    import src.chat.sql_fast_path as sql_fast_path
+    import src.remote_config.utils as remote_config_utils
+    from src.chat.answer_cache import set_embedding_model
+    from src.clients.utils import set_client
+
+    storage_client = FakeStorageClient(latency)
+    bucket = storage_client.bucket(bucket_name)
+    for file_name, text in prompts.items():
+        bucket.objects[f"shared/prompts/{file_name}"] = {'data': text.encode("utf-8"), 'content_type': 'text/plain',
+                                                         'generation': 1}
+
+    fakes = {
+        'storage': storage_client,
+        'firestore': FakeFirestoreClient(latency),
+        'tasks': FakeTasksClient(latency),
+        'auth': FakeAuth(latency),
+        'remote_config': FakeRemoteConfig(latency, prompt_files),
+        'sql_llm': FakeSQLLLM(latency, sql_for_question),
+        'embedding': FakeEmbeddingModel(latency),
+        'anthropic': FakeAnthropicClient(latency),
+    }
+    set_client("storage", fakes['storage'])
+    set_client("firestore", fakes['firestore'])
+    set_client("tasks", fakes['tasks'])
+    set_client("anthropic:us-east5", fakes['anthropic'])
+    set_embedding_model(fakes['embedding'])
+
+    firebase_admin.auth.verify_id_token = fakes['auth'].verify_id_token
+    remote_config_utils.fetch_remote_config = fakes['remote_config'].fetch
+
+    sql_llms = {fakes['sql_llm'].model_name: fakes['sql_llm']}
+
+    def get_langchain_llm(*args, model_name: str = fakes['sql_llm'].model_name, **kwargs):
+        if model_name not in sql_llms:
+            sql_llms[model_name] = FakeSQLLLM(latency, sql_for_question, model_name=model_name)
+        return sql_llms[model_name]
+
+    FakeGenerativeModel.latency = latency
+    vertexai.init = lambda **kwargs: None
+    models.GenerativeModel = FakeGenerativeModel
+    sql_fast_path.get_langchain_llm = get_langchain_llm
+    return fakes
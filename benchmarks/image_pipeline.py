@@ -0,0 +1,103 @@
+"""Measure what the image pipeline adds and saves on phone-sized photos.
+
+Synthesizes a photo-like JPEG and a screenshot-like PNG, runs them through the downscaling
+pipeline (uploads go to the in-memory fake bucket) and reports per-stage latency, output size,
+bytes saved, the estimated upload time of the original and the processed image at the given
+bandwidth, and the cost of a duplicate.
+
+Usage: python -m benchmarks.image_pipeline [--width 4032] [--height 3024] [--repeat 3]
+       [--upload-mbps 20]
+"""
+import argparse
+import io
+import os
+import random
+import time
+
+from benchmarks.fakes import FakeStorageClient, Latency
+
+BUCKET_NAME = "image-benchmark-bucket"
+
+
+def make_photo(width: int, height: int) -> bytes:
+    """A noisy gradient, which compresses about as well as a camera photo."""
+    from PIL import Image, ImageFilter
+
+    noise = Image.effect_noise((width // 4, height // 4), 64).resize((width, height))
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (noise, gradient, noise.filter(ImageFilter.GaussianBlur(2))))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+def make_screenshot(width: int, height: int) -> bytes:
+    """Flat blocks of colour with some text-like detail, saved as PNG."""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for top in range(0, height, 120):
+        draw.rectangle((40, top + 20, width - 40, top + 100), fill=(230, 236, 245))
+        for left in range(60, width - 200, 90):
+            draw.text((left, top + 50), random.choice(["SELECT", "COUNT", "patients", "HbA1c"]), fill="black")
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def measure(name: str, image_bytes: bytes, mime_type: str, bucket, repeat: int, upload_mbps: float):
+    import src.image.utils as image_utils
+    from src.metrics.utils import get_stage_summary, reset_metrics
+
+    reset_metrics()
+    timings = []
+    for attempt in range(repeat):
+        # A different user each time, so the dedup cache does not short-circuit the pipeline
+        start = time.perf_counter()
+        gcs_path, output_mime_type, _ = image_utils.stage_image(
+            image_bytes, mime_type, f"{name}-{attempt}", upload_mode="sync")
+        timings.append(time.perf_counter() - start)
+    stages = get_stage_summary()
+    output_size = len(bucket.objects[gcs_path.split("/", 3)[3]]['data'])
+
+    start = time.perf_counter()
+    image_utils.stage_image(image_bytes, mime_type, f"{name}-0", upload_mode="sync")
+    duplicate = time.perf_counter() - start
+
+    def upload_ms(size):
+        return size * 8 / (upload_mbps * 1_000_000) * 1000
+
+    print(f"\n{name}: {len(image_bytes)} bytes {mime_type} -> {output_size} bytes {output_mime_type} "
+          f"({100 * (1 - output_size / len(image_bytes)):.0f}% saved)")
+    print(f"  pipeline {min(timings) * 1000:.1f} ms, duplicate {duplicate * 1000:.1f} ms")
+    print(f"  upload at {upload_mbps:g} Mbit/s: original {upload_ms(len(image_bytes)):.0f} ms, "
+          f"processed {upload_ms(output_size):.0f} ms")
+    for stage, summary in sorted(stages.items()):
+        print(f"  {stage:<14} {summary['mean'] * 1000:>8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--upload-mbps", type=float, default=20, help="upload bandwidth to GCS")
+    args = parser.parse_args()
+
+    os.environ["GOOGLE_CLOUD_BUCKET"] = BUCKET_NAME
+    import src.image.utils as image_utils
+    from src.clients.utils import set_client
+
+    storage_client = FakeStorageClient(Latency(storage=0))
+    set_client("storage", storage_client)
+    bucket = storage_client.bucket(BUCKET_NAME)
+
+    measure("photo", make_photo(args.width, args.height), "image/jpeg", bucket, args.repeat, args.upload_mbps)
+    measure("screenshot", make_screenshot(args.width // 2, args.height), "image/png", bucket, args.repeat,
+            args.upload_mbps)
+    print(f"\nstats: {image_utils.image_stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Compare peak memory and latency of request ingestion: whole-upload reads vs spooled parts.
+
+Drives a minimal Flask app with three kinds of request: a multipart file upload, a JSON body
+carrying base64 audio, and an upload over the size limit. Each request is handled the legacy
+way (read the whole part, a new libmagic handle, base64 decoded in one go) and through
+src.routes.ingest (parts spooled to size-capped buffers, cached per-thread sniffer, chunked
+base64 decoding), then the payload is consumed in chunks as the transcoder would. The request
+body is streamed from a temporary file so only the handling is measured.
+
+Usage: python -m benchmarks.ingest_memory [--megabytes 20] [--repeat 3]
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from flask import Flask, jsonify, request
+from werkzeug.test import EnvironBuilder
+
+import src.routes.ingest as ingest_utils
+import src.routes.utils as endpoint_utils
+
+CHUNK_SIZE = 64 * 1024
+BOUNDARY = "----ingest-benchmark"
+# EBML header with the webm DocType, followed by filler
+WEBM_HEADER = bytes.fromhex("1a45dfa39f4286810142f7810142f2810442f381084282847765626d4287810442858102")
+
+
+def consume(stream) -> int:
+    """Read a payload in chunks, like the ffmpeg transcoder does."""
+    total = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return total
+        total += len(chunk)
+
+
+def create_legacy_app():
+    import magic
+
+    app = Flask("legacy")
+
+    @app.route("/upload", methods=["POST"])
+    def upload():
+        audio_bytes = request.files['audio'].read()
+        mime_type = magic.Magic(mime=True).from_buffer(audio_bytes[:2048])
+        return jsonify({'mime_type': mime_type, 'bytes': consume(io.BytesIO(audio_bytes))})
+
+    @app.route("/json", methods=["POST"])
+    def json_audio():
+        audio_bytes = base64.b64decode(request.json['audio'])
+        mime_type = magic.Magic(mime=True).from_buffer(audio_bytes[:2048])
+        return jsonify({'mime_type': mime_type, 'bytes': consume(io.BytesIO(audio_bytes))})
+
+    return app
+
+
+def create_ingest_app(max_bytes: int):
+    app = Flask("ingest")
+    ingest_utils.init_app(app)
+
+    @app.route("/upload", methods=["POST"])
+    def upload():
+        stream, mime_type = ingest_utils.open_upload('audio', ["video/webm", "audio/webm"], max_bytes)
+        return jsonify({'mime_type': mime_type, 'bytes': consume(stream)})
+
+    @app.route("/json", methods=["POST"])
+    def json_audio():
+        data = endpoint_utils.parse_json_data(request)
+        stream, mime_type = ingest_utils.decode_base64_upload(data.pop('audio'), ["video/webm", "audio/webm"], max_bytes)
+        with stream:
+            return jsonify({'mime_type': mime_type, 'bytes': consume(stream)})
+
+    return app
+
+
+def write_multipart(path: str, size: int):
+    with open(path, "wb") as f:
+        f.write(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="json"\r\n\r\n{{}}\r\n'.encode())
+        f.write(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="audio"; filename="a.webm"\r\n'
+                f'Content-Type: audio/webm\r\n\r\n'.encode())
+        f.write(WEBM_HEADER)
+        filler = os.urandom(CHUNK_SIZE)
+        remaining = size - len(WEBM_HEADER)
+        while remaining > 0:
+            f.write(filler[:remaining])
+            remaining -= len(filler)
+        f.write(f'\r\n--{BOUNDARY}--\r\n'.encode())
+
+
+def write_json(path: str, size: int):
+    payload = WEBM_HEADER + os.urandom(size - len(WEBM_HEADER))
+    with open(path, "w") as f:
+        json.dump({'audio': base64.b64encode(payload).decode("ascii")}, f)
+
+
+def measure(app, path: str, url: str, content_type: str, repeat: int):
+    """Best latency, peak traced Python memory and status of posting the file at path to url."""
+    client = app.test_client()
+    timings = []
+    peak = 0
+    status = None
+    for _ in range(repeat):
+        with open(path, "rb") as body:
+            builder = EnvironBuilder(path=url, method="POST", input_stream=body,
+                                     content_length=os.path.getsize(path), content_type=content_type)
+            environ = builder.get_environ()
+            tracemalloc.start()
+            start = time.perf_counter()
+            response = client.open(environ)
+            timings.append(time.perf_counter() - start)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            status = response.status_code
+            response.close()
+    return min(timings), peak, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megabytes", type=float, default=20, help="size of the uploaded audio")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    size = int(args.megabytes * 1024 * 1024)
+    workdir = tempfile.mkdtemp(prefix="ingest-benchmark-")
+    multipart_path = os.path.join(workdir, "multipart.bin")
+    json_path = os.path.join(workdir, "body.json")
+    write_multipart(multipart_path, size)
+    write_json(json_path, size)
+
+    apps = {
+        'legacy': create_legacy_app(),
+        'ingest': create_ingest_app(max_bytes=size * 2),
+        'ingest limit': create_ingest_app(max_bytes=size // 2),
+    }
+    multipart_type = f"multipart/form-data; boundary={BOUNDARY}"
+
+    print(f"payload: {size} bytes")
+    print(f"{'request':<12} {'mode':<14} {'latency ms':>12} {'peak py MB':>12} {'status':>8}")
+    for request_name, path, url, content_type in [("multipart", multipart_path, "/upload", multipart_type),
+                                                  ("base64 json", json_path, "/json", "application/json")]:
+        for mode, app in apps.items():
+            latency, peak, status = measure(app, path, url, content_type, args.repeat)
+            print(f"{request_name:<12} {mode:<14} {latency * 1000:>12.1f} {peak / 1024 / 1024:>12.2f} {status:>8}")
+    print(f"ingest stats: {ingest_utils.ingest_stats}")
+
+    for path in (multipart_path, json_path):
+        os.remove(path)
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Show what deadlines, hedging and circuit breaking do to model call latency under scripted faults.
+
+Model calls go through src.llm (the path chat titles and history summaries take) to the fake
+Claude and Gemini backends, with faults scripted per model:
+
+  hedging   Claude answers in --latency seconds but stalls for --stall seconds on --stall-rate
+            of calls; latency percentiles without and with hedged requests
+  outage    Claude fails every call; the first calls retry and fail over to Gemini, then the
+            circuit opens and calls go straight to Gemini
+  deadline  both models stall; the per-call timeout and the request deadline bound the wait
+
+Usage: python -m benchmarks.llm_resilience [--calls 300] [--concurrency 8] [--latency 0.05]
+       [--stall 1.0] [--stall-rate 0.03]
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import FakeAnthropicClient, FakeGenerativeModel, Fault, Latency
+
+CLAUDE_MODEL = "claude-3-5-sonnet@20240620"
+GEMINI_MODEL = "gemini-1.5-flash-001"
+
+
+def install(latency: Latency):
+    import vertexai
+
+    import src.chat.models as models
+    from src.clients.utils import set_client
+
+    set_client("anthropic:us-east5", FakeAnthropicClient(latency))
+    FakeGenerativeModel.latency = latency
+    FakeGenerativeModel.answer_words = 8
+    vertexai.init = lambda **kwargs: None
+    models.GenerativeModel = FakeGenerativeModel
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return {q: timings[min(len(timings) - 1, int(q / 100 * len(timings)))] for q in (50, 95, 99)}
+
+
+def run_calls(calls: int, concurrency: int, **kwargs):
+    """Latencies of calls generate_text calls made from concurrency threads, and the errors raised."""
+    from src.llm.generate import generate_text
+
+    errors = []
+
+    def one(index):
+        start = time.perf_counter()
+        try:
+            generate_text(f"Title for question {index} about HbA1c", **kwargs)
+        except Exception as e:
+            errors.append(e)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        timings = list(executor.map(one, range(calls)))
+    return timings, errors
+
+
+def print_row(name: str, timings, errors):
+    p = percentiles(timings)
+    print(f"  {name:<22} p50 {p[50] * 1000:>7.0f} ms  p95 {p[95] * 1000:>7.0f} ms  p99 {p[99] * 1000:>7.0f} ms  "
+          f"max {max(timings) * 1000:>7.0f} ms  errors {len(errors)}")
+
+
+def print_models():
+    import src.llm.utils as llm_utils
+
+    for model, stats in llm_utils.get_llm_stats().items():
+        counters = ", ".join(f"{key} {value}" for key, value in stats.items()
+                             if not key.endswith("_seconds") and value)
+        print(f"    {model}: {counters}")
+
+
+def hedging(args):
+    import src.llm.utils as llm_utils
+
+    print(f"\nhedging: {CLAUDE_MODEL} stalls {args.stall:g}s on {args.stall_rate:.0%} of calls")
+    for hedge in (False, True):
+        latency = Latency(llm=args.latency, faults={CLAUDE_MODEL: Fault(stall_rate=args.stall_rate, stall=args.stall)})
+        install(latency)
+        llm_utils.reset_llm_state()
+        llm_utils.LLM_HEDGE_ENABLED = hedge
+        llm_utils.LLM_HEDGE_MIN_DELAY = args.hedge_min_delay
+        # Warm the latency window so the hedge delay is known
+        run_calls(llm_utils.LLM_HEDGE_MIN_SAMPLES, args.concurrency, models=[CLAUDE_MODEL])
+        timings, errors = run_calls(args.calls, args.concurrency, models=[CLAUDE_MODEL])
+        print_row("hedged" if hedge else "no hedging", timings, errors)
+        print_models()
+    llm_utils.LLM_HEDGE_ENABLED = False
+
+
+def outage(args):
+    import src.llm.utils as llm_utils
+
+    print(f"\noutage: {CLAUDE_MODEL} fails every call, {GEMINI_MODEL} is healthy")
+    install(Latency(llm=args.latency, faults={CLAUDE_MODEL: Fault(down=True)}))
+    llm_utils.reset_llm_state()
+    before, errors_before = run_calls(llm_utils.LLM_BREAKER_FAILURES, 1)
+    after, errors_after = run_calls(args.calls // 10, args.concurrency)
+    print_row("until the circuit opens", before, errors_before)
+    print_row("circuit open", after, errors_after)
+    print(f"    {CLAUDE_MODEL} circuit: {llm_utils.get_model_state(CLAUDE_MODEL).breaker.state}")
+    print_models()
+
+
+def deadline(args):
+    import src.llm.utils as llm_utils
+
+    stall = 30.0
+    print(f"\ndeadline: both models stall {stall:g}s, per-call timeout {args.call_timeout:g}s, "
+          f"request deadline {args.deadline:g}s")
+    install(Latency(llm=args.latency, faults={'llm': Fault(stall_rate=1.0, stall=stall)}))
+    llm_utils.reset_llm_state()
+
+    start = time.perf_counter()
+    try:
+        with llm_utils.deadline(args.deadline):
+            from src.llm.generate import generate_text
+            generate_text("Title for a stuck question", timeout=args.call_timeout)
+        outcome = "answered"
+    except llm_utils.LLMUnavailable as e:
+        outcome = f"LLMUnavailable ({', '.join(f'{model}: {type(error).__name__}' for model, error in e.errors.items())})"
+    print(f"  gave up after {time.perf_counter() - start:.2f}s: {outcome}")
+    print_models()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="typical model latency in seconds")
+    parser.add_argument("--stall", type=float, default=1.0, help="seconds a stalled call takes")
+    parser.add_argument("--stall-rate", type=float, default=0.03)
+    parser.add_argument("--hedge-min-delay", type=float, default=0.05)
+    parser.add_argument("--call-timeout", type=float, default=1.0)
+    parser.add_argument("--deadline", type=float, default=1.5)
+    args = parser.parse_args()
+
+    hedging(args)
+    outage(args)
+    deadline(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""Offline load test of /chat, /chat/task and /chat/title against local fakes of every backend.
+
+GCS, Firestore, Cloud Tasks, Remote Config, Firebase Auth, Gemini, Claude and the embedding
+model are replaced by the fakes in benchmarks/fakes.py (with simulated latency) and BigQuery by
+a SQLite database, then each endpoint is driven through the Flask app at the given concurrency.
+Reports p50/p95/p99 latency, throughput, peak RSS and the per-stage breakdown from
+src.metrics, and compares against (or saves) a baseline JSON.
+
+Usage: python -m benchmarks.load_test [--requests 200] [--concurrency 8] [--latency-scale 1.0]
+       [--scenarios chat task title] [--save-baseline] [--tolerance 0.2]
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "load_test.json")
+BUCKET_NAME = "load-test-bucket"
+
+PROMPTS = {
+    "chat_title.txt": "Write a short title for a chat that starts with: {input_text}",
+    "sql_agent_system_instruction.txt": "You are a data analyst answering questions about a diabetes datamart.",
+    "sql_agent_function_description.txt": "Answer a question about patients using the diabetes datamart.",
+    "sql_agent_function_parameters.json": json.dumps({
+        "type": "object",
+        "properties": {"question": {"type": "string", "description": "The question to answer."}},
+        "required": ["question"],
+    }),
+}
+PROMPT_FILES = {
+    "generateChatTitle": "chat_title.txt",
+    "sqlAgentSystemInstruction": "sql_agent_system_instruction.txt",
+    "sqlAgentFunctionDescription": "sql_agent_function_description.txt",
+    "sqlAgentFunctionParameters": "sql_agent_function_parameters.json",
+}
+
+
+def make_questions():
+    """Questions the scripted models can answer, with the SQL the fast path should generate."""
+    questions = {}
+    for year in range(2000, 2024):
+        questions[f"How many patients were diagnosed in {year}?"] = (
+            f"SELECT COUNT(*) FROM patients WHERE diagnosis_year = {year}")
+        questions[f"What was the average HbA1c of patients diagnosed in {year}?"] = (
+            f"SELECT AVG(hba1c) FROM patients WHERE diagnosis_year = {year}")
+    for sex in ("F", "M"):
+        questions[f"What is the age distribution of {sex} patients?"] = (
+            f"SELECT age, COUNT(*) FROM patients WHERE sex = '{sex}' GROUP BY age ORDER BY age")
+    return questions
+
+
+def make_database(path: str, rows: int, seed: int = 0):
+    """Create a SQLite stand-in for the BigQuery diabetes datamart."""
+    generator = random.Random(seed)
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE patients (id INTEGER PRIMARY KEY, age INTEGER, sex TEXT, "
+                       "diagnosis_year INTEGER, hba1c REAL)")
+    connection.executemany(
+        "INSERT INTO patients VALUES (?, ?, ?, ?, ?)",
+        [(index, generator.randint(18, 90), generator.choice("FM"), generator.randint(2000, 2023),
+          round(generator.uniform(5.0, 12.0), 1)) for index in range(rows)])
+    connection.commit()
+    connection.close()
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class LoadTest:
+    """Drives the app's endpoints with simulated users, keeping each user's chat ids for follow-ups."""
+
+    def __init__(self, app, questions, users: int, follow_up: float, seed: int = 0):
+        self.app = app
+        self.questions = list(questions)
+        self.users = [f"load-test-user-{index}" for index in range(users)]
+        self.follow_up = follow_up
+        self.chats = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    def pick(self):
+        with self._lock:
+            user_id = self._random.choice(self.users)
+            question = self._random.choice(self.questions)
+            chat_id = None
+            if self.chats.get(user_id) and self._random.random() < self.follow_up:
+                chat_id = self._random.choice(self.chats[user_id])
+        return user_id, question, chat_id
+
+    def remember_chat(self, user_id, chat_id):
+        with self._lock:
+            chats = self.chats.setdefault(user_id, [])
+            if chat_id not in chats:
+                chats.append(chat_id)
+
+    def chat(self):
+        user_id, question, chat_id = self.pick()
+        return self.client().post("/chat", json={'text': question, 'chat_id': chat_id},
+                                  headers={'Authorization': f"Bearer {user_id}"})
+
+    def task(self):
+        user_id, question, chat_id = self.pick()
+        response = self.client().post("/chat/task", json={
+            'text': question,
+            'user_id': user_id,
+            'chat_history_id': chat_id,
+            'system_instruction': None,
+            'image_gcs_path': None,
+            'image_mime_type': None,
+            'audio_gcs_path': None,
+            'audio_mime_type': None,
+        })
+        if response.status_code == 200:
+            self.remember_chat(user_id, response.get_json()['chat_history_id'])
+        return response
+
+    def title(self):
+        user_id, question, _ = self.pick()
+        return self.client().post("/chat/title", json={'text': question},
+                                  headers={'Authorization': f"Bearer {user_id}"})
+
+    def run(self, scenario: str, requests: int, concurrency: int):
+        """Send requests to scenario's endpoint from concurrency threads and return the results."""
+        from src.metrics.utils import get_stage_summary, reset_metrics
+
+        send = getattr(self, scenario)
+        latencies, statuses = [], {}
+
+        def one():
+            start = time.perf_counter()
+            try:
+                status = send().status_code
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        reset_metrics()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(one) for _ in range(requests)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        errors = sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 400)
+        return {
+            'requests': requests,
+            'concurrency': concurrency,
+            'errors': errors,
+            'statuses': statuses,
+            'throughput_rps': requests / elapsed if elapsed else 0.0,
+            'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'stages': {stage: {'count': summary['count'], 'mean_ms': summary['mean'] * 1000}
+                       for stage, summary in sorted(get_stage_summary().items())},
+        }
+
+
+def wait_for_tasks(timeout: float = 300):
+    """Wait until the in-process dispatcher has finished every dispatched task."""
+    from src.routes.dispatch import get_dispatcher
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = get_dispatcher().stats()
+        if not stats.get('outstanding'):
+            return stats
+        time.sleep(0.05)
+    return get_dispatcher().stats()
+
+
+# Settings that must match for results to be comparable with a baseline
+COMPARABLE_CONFIG = ("concurrency", "dispatch", "follow_up", "latency_scale", "rows", "users")
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Return the regressions of results against baseline (p95 latency and throughput)."""
+    regressions = []
+    for scenario, result in results['scenarios'].items():
+        expected = baseline.get('scenarios', {}).get(scenario)
+        if not expected:
+            continue
+        if result['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{scenario}: p95 {result['p95_ms']:.1f} ms > baseline {expected['p95_ms']:.1f} ms")
+        if result['throughput_rps'] < expected['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{scenario}: throughput {result['throughput_rps']:.1f} rps < "
+                               f"baseline {expected['throughput_rps']:.1f} rps")
+    return regressions
+
+
+def print_results(results: dict):
+    print(f"{'scenario':<8} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'rss MB':>8}")
+    for scenario, result in results['scenarios'].items():
+        print(f"{scenario:<8} {result['throughput_rps']:>8.1f} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+              f"{result['p99_ms']:>9.1f} {result['errors']:>7} {result['peak_rss_mb']:>8.1f}")
+    for scenario, result in results['scenarios'].items():
+        print(f"\n{scenario} stages (mean ms x count):")
+        for stage, summary in result['stages'].items():
+            print(f"  {stage:<28} {summary['mean_ms']:>9.2f} x {summary['count']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per scenario")
+    parser.add_argument("--scenarios", nargs="+", default=["chat", "task", "title"], choices=["chat", "task", "title"])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--follow-up", type=float, default=0.5, help="share of task requests continuing a chat")
+    parser.add_argument("--rows", type=int, default=20000, help="rows in the SQLite datamart")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplier for every simulated latency")
+    parser.add_argument("--dispatch", choices=["cloud_tasks", "in_process"], default="cloud_tasks",
+                        help="cloud_tasks records tasks in a fake client, in_process runs them in the app")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own log output")
+    args = parser.parse_args()
+
+    # The app reads its configuration at import time, so set it up before importing anything from it
+    workdir = tempfile.mkdtemp(prefix="load-test-")
+    database_path = os.path.join(workdir, "datamart.db")
+    make_database(database_path, args.rows)
+    os.environ.update({
+        'GOOGLE_CLOUD_PROJECT': "load-test-project",
+        'GOOGLE_CLOUD_BUCKET': BUCKET_NAME,
+        'SQLALCHEMY_DATABASE_URL': f"sqlite:///{database_path}",
+        'SQL_AGENT_WARMUP': "false",
+        'ANONYMIZED_TELEMETRY': "False",
+        'TASK_DISPATCH_BACKEND': args.dispatch,
+    })
+
+    from benchmarks.fakes import Latency, install
+    latency = Latency()
+    for name, value in latency.to_dict().items():
+        if name != "jitter":
+            setattr(latency, name, value * args.latency_scale)
+
+    questions = make_questions()
+    fakes = install(latency, PROMPTS, PROMPT_FILES, questions.get, BUCKET_NAME)
+
+    from main import create_app
+    app = create_app()
+
+    load_test = LoadTest(app, questions, args.users, args.follow_up)
+    output = sys.stdout if args.verbose else io.StringIO()
+    if not args.verbose:
+        logging.getLogger("chromadb.telemetry").setLevel(logging.CRITICAL)
+    results = {
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ("baseline", "save_baseline", "verbose")},
+        'latency': latency.to_dict(),
+        'scenarios': {},
+    }
+    with contextlib.redirect_stdout(output):
+        for scenario in args.scenarios:
+            load_test.run(scenario, args.warmup, args.concurrency)
+            results['scenarios'][scenario] = load_test.run(scenario, args.requests, args.concurrency)
+            if args.dispatch == "in_process" and scenario == "chat":
+                results['scenarios'][scenario]['tasks'] = wait_for_tasks()
+    results['backends'] = {
+        'storage': fakes['storage'].stats(),
+        'firestore': fakes['firestore'].stats,
+        'tasks_created': fakes['tasks'].tasks,
+        'auth_verified': fakes['auth'].verified,
+        'remote_config_fetches': fakes['remote_config'].fetches,
+        'sql_llm_calls': fakes['sql_llm'].calls,
+    }
+
+    print_results(results)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f"\nSaved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        mismatched = [key for key in COMPARABLE_CONFIG if baseline['config'].get(key) != results['config'][key]]
+        if mismatched:
+            print(f"\nBaseline was recorded with different {', '.join(mismatched)}; not comparing")
+            return
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Micro-benchmark model setup in generate_text: building models per request vs the cached factory.
+
+Usage: python -m benchmarks.model_factory [--iterations 1000]
+"""
+import argparse
+import time
+
+from vertexai.generative_models import FunctionDeclaration, Tool
+
+from src.chat.models import get_model, init_vertexai, model_cache, model_cache_stats
+
+SYSTEM_INSTRUCTION = "You are a data analyst answering questions about a diabetes datamart. " * 50
+
+
+def build_tools():
+    return [Tool(function_declarations=[FunctionDeclaration(
+        name="get_diabetes_data_output",
+        description="Answer a question with the diabetes datamart.",
+        parameters={"type": "object", "properties": {"question": {"type": "string"}}, "required": ["question"]},
+    )])]
+
+
+def setup_models(tools):
+    init_vertexai("benchmark-project", "us-central1")
+    get_model("gemini-1.5-pro-001", system_instruction=SYSTEM_INSTRUCTION, tools=tools, tools_version="1")
+    get_model("gemini-1.5-pro-001", system_instruction=SYSTEM_INSTRUCTION)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+    tools = build_tools()
+
+    def cold():
+        model_cache.clear()
+        setup_models(tools)
+
+    def warm():
+        setup_models(tools)
+
+    print(f"{'case':<8} {'us / request':>14}")
+    for name, fn in [("cold", cold), ("warm", warm)]:
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            fn()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<8} {elapsed / args.iterations * 1e6:>14.1f}")
+    print(model_cache_stats)
+
+
+if __name__ == '__main__':
+    main()
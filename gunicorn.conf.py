@@ -0,0 +1,66 @@
+"""Production server configuration: gunicorn -c gunicorn.conf.py
+
+The app is created once in the parent process (preload hooks run before forking), every
+worker then imports the heavy modules and runs the warmup hooks in the background, reporting
+ready on /readyz once done, and SIGTERM marks the worker as draining before gunicorn finishes
+in-flight requests.
+
+GUNICORN_WORKER_CLASS selects the worker model: "gthread" (default, a thread pool per worker)
+or "gevent" (cooperative workers for many concurrent, mostly waiting requests).
+"""
+import os
+import signal
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+wsgi_app = "main:create_app()"
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("GUNICORN_WORKERS", 1))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 100))
+
+# Cloud Run enforces the request timeout; LLM-bound tasks must not be killed by gunicorn
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 0))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 8))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 75))
+
+accesslog = "-"
+errorlog = "-"
+
+if worker_class == "gevent":
+    # Patch before the app (and gRPC) are imported in the parent process
+    from gevent import monkey
+    monkey.patch_all()
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+
+
+def on_starting(server):
+    if server.cfg.preload_app:
+        import src.serving.utils as serving_utils
+        serving_utils.run_preload()
+
+
+def post_worker_init(worker):
+    import main
+    import src.serving.utils as serving_utils
+
+    if not worker.cfg.preload_app:
+        serving_utils.run_preload()
+
+    # Report unready as soon as SIGTERM arrives, then let gunicorn finish in-flight requests
+    handle_exit = worker.handle_exit
+
+    def handle_sigterm(signum, frame):
+        serving_utils.begin_drain()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    main.start_worker()
+
+
+def worker_exit(server, worker):
+    import src.serving.utils as serving_utils
+    serving_utils.drain(graceful_timeout)
@@ -1,48 +1,154 @@
 import os
+import sys
 import time
 from dotenv import load_dotenv
 from flask import Flask, Response
-from firebase_admin import credentials, initialize_app
+from firebase_admin import credentials, get_app, initialize_app
 from flask_cors import CORS
-from random_word import RandomWords
 from routes.chat import chat_bp
+import src.routes.ingest as ingest_utils
+import src.serving.utils as serving_utils
+from src.audio.utils import transcode_stats
+from src.chat.answer_cache import answer_cache_stats
+from src.chat.sql_cache import sql_result_cache
+from src.clients.utils import get_client_stats, get_firestore_client, get_storage_client
+from src.image.utils import image_stats
+from src.llm.utils import get_llm_stats
+from src.metrics.utils import init_app as init_metrics, register_collector
+from src.remote_config.prompts import get_prompt_bundle
+from src.routes.dispatch import get_dispatcher
+from src.routes.utils import get_auth_token_cache_stats
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Flask app
-app = Flask(__name__)
 
-# Configure CORS
-cors = CORS(app, resources={
-    r"/*": {
-        "origins": "*",
-        "methods": ["OPTIONS", "POST", "GET"],
-        "allow_headers": ["Content-Type", "Authorization", "Accept"],
-        "supports_credentials": True
-    }
-})
+def create_app():
+    """Create the Flask app.
 
-# Initialize Firebase admin
-cred = credentials.ApplicationDefault()
-initialize_app(cred)
+    Used directly by gunicorn (gunicorn.conf.py preloads it in the parent process before
+    forking workers) and by `python main.py`. Background work starts per process in start_worker.
+    """
+    app = Flask(__name__)
+
+    # Configure CORS
+    CORS(app, resources={
+        r"/*": {
+            "origins": "*",
+            "methods": ["OPTIONS", "POST", "GET"],
+            "allow_headers": ["Content-Type", "Authorization", "Accept"],
+            "supports_credentials": True
+        }
+    })
+
+    # Initialize Firebase admin
+    try:
+        get_app()
+    except ValueError:
+        initialize_app(credentials.ApplicationDefault())
+
+    # Stream uploads into size-capped spooled buffers
+    ingest_utils.init_app(app)
+
+    app.register_blueprint(chat_bp)
+
+    # Stage timing, Server-Timing headers and /metrics
+    init_metrics(app)
+    register_collector("clients", get_client_stats)
+    register_collector("auth_token_cache", get_auth_token_cache_stats)
+    register_collector("sql_result_cache", sql_result_cache.stats)
+    register_collector("answer_cache", lambda: answer_cache_stats)
+    register_collector("model_cache", loaded_module_stats("src.chat.models", "model_cache_stats"))
+    register_collector("audio_transcode", lambda: transcode_stats)
+    register_collector("image_processing", lambda: image_stats)
+    register_collector("ingest", lambda: ingest_utils.ingest_stats)
+    register_collector("llm", get_llm_stats)
+    register_collector("task_dispatch", lambda: get_dispatcher().stats())
+
+    # Liveness and readiness probes
+    serving_utils.init_app(app)
+
+    # Test routes
+    app.add_url_rule("/hello-world", view_func=hello_world)
+    app.add_url_rule("/test-stream", view_func=test_stream, methods=["POST"])
+
+    return app
+
+
+def loaded_module_stats(module_name: str, attribute: str):
+    """Collector for stats of a lazily imported module, empty until the module is first used."""
+    def collect():
+        module = sys.modules.get(module_name)
+        return getattr(module, attribute) if module else {}
+    return collect
+
+
+def warm_clients():
+    """Create the shared clients and the task dispatcher."""
+    get_storage_client()
+    get_firestore_client()
+    get_dispatcher()
+
+
+def warm_prompts_and_models():
+    """Load Remote Config and the prompt bundle, then build the models for the current bundle."""
+    from src.chat.chat_gemini import create_models
+    from src.chat.models import init_vertexai
+
+    init_vertexai()
+    prompt_bundle = get_prompt_bundle()
+    if prompt_bundle:
+        create_models("gemini-1.5-pro-001", system_instruction=prompt_bundle.system_instruction,
+                      tools=prompt_bundle.tools, tools_version=prompt_bundle.version)
+
+
+def warm_tokenizer():
+    from src.chat.window import count_text_tokens
+    count_text_tokens("warmup")
+
+
+def warm_sql_agent():
+    """Reflect the schema, cache table info and build the agent executor."""
+    from src.chat.sql_agent import warm_sql_agent
+    warm_sql_agent()
+
+
+# Heavy modules (Vertex AI, LangChain, the BigQuery dialect) are imported during warmup, not by main
+serving_utils.register_warmup_import("src.chat.chat_gemini")
+serving_utils.register_warmup_import("src.chat.sql_fast_path")
+
+serving_utils.register_warmup_hook("clients", warm_clients)
+serving_utils.register_warmup_hook("prompts_and_models", warm_prompts_and_models)
+serving_utils.register_warmup_hook("tokenizer", warm_tokenizer)
+
+# Warm the SQL agent (schema reflection, table info, agent executor)
+if os.getenv("SQL_AGENT_WARMUP", "true").lower() == "true":
+    serving_utils.register_warmup_hook("sql_agent", warm_sql_agent)
+
+
+def start_worker(wait: bool = True):
+    """Start per-process background work: the warmup hooks.
+
+    With wait, blocks for up to WARMUP_TIMEOUT seconds (0 by default: warmup continues in the
+    background and /readyz reports when it is done).
+    """
+    serving_utils.start_warmup(timeout=None if wait else 0)
 
-app.register_blueprint(chat_bp)
 
 # Test routes
-@app.route("/hello-world")
 def hello_world():
     """Example Hello World route."""
     name = os.environ.get("NAME", "World")
     return f"Hello {name}!"
 
 
-@app.route("/test-stream", methods=["POST"])
 def test_stream():
     """Test streaming response with random words."""
+    from random_word import RandomWords
+
     def mock_generate():
         r = RandomWords()
-        while True:
+        while not serving_utils.is_draining():
             random_word = r.get_random_word()
             if random_word:
                 yield random_word + "\n"
@@ -52,4 +158,9 @@ def test_stream():
 
 
 if __name__ == '__main__':
+    # Development server; production runs gunicorn with gunicorn.conf.py
+    serving_utils.run_preload()
+    app = create_app()
+    serving_utils.install_signal_handlers()
+    start_worker(wait=False)
     app.run(debug=False, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -1,26 +1,22 @@
-import base64
-import io
-import json
-import magic
 import os
+import time
 
 from flask import Blueprint, request, jsonify, Response
-from firebase_admin import auth
-from google.cloud import firestore
-from google.cloud import tasks_v2
-from pydub import AudioSegment
-from vertexai.generative_models import (
-    FunctionDeclaration,
-    Part,
-    Tool
-)
-from uuid import uuid4
-
-import src.anthropic.generate as anthropic_generate
-import src.chat.chat_gemini as perform_chat
+
+import src.audio.utils as audio_utils
+import src.image.utils as image_utils
+import src.llm.utils as llm_utils
+import src.routes.ingest as ingest_utils
+import src.routes.dispatch as dispatch_utils
+import src.routes.sse as sse_utils
 import src.routes.utils as endpoint_utils
 import src.remote_config.utils as remote_config_utils
-from src.chat.utils import clean_text, upload_image_to_gcs
+from src.chat.progress import ChatProgressWriter, write_chat_answer
+from src.chat.utils import clean_text, upload_media_to_gcs
+from src.llm.generate import generate_text
+from src.remote_config.prompts import get_prompt_bundle
+from src.metrics.utils import span, traced
+from src.prefetch.utils import Prefetch, PrefetchTimeout
 
 
 chat_bp = Blueprint('chat', __name__, url_prefix='/chat')
@@ -49,11 +45,17 @@ def chat():
     chat_history_id = data.get("chat_id", data.get("chatId"))
     system_instruction = data.get("system_instruction", data.get("systemInstruction"))
 
-    # Process audio data
-    audio_bytes, audio_mime_type = process_audio_data(request, data)
-
-    # Process image data
-    image_gcs_path, image_mime_type = process_image_data(request, user_id, chat_history_id)
+    # Downscale the image and stage it and the audio in GCS so the task payload only carries
+    # references; the image upload runs in the background while the audio is processed, and the
+    # task is only enqueued once both are stored
+    try:
+        image_gcs_path, image_mime_type, image_upload = process_image_data(request, user_id)
+        audio_bytes, audio_mime_type = process_audio_data(request, data)
+        audio_gcs_path = stage_audio_data(user_id, audio_bytes, audio_mime_type)
+        image_utils.wait_for_upload(image_upload)
+    except image_utils.ImageUploadError as e:
+        print(f"Unable to stage image: {e}")
+        return jsonify({'error': 'Unable to upload the image, please try again'}), 503
 
     # Create a task for background processing
     payload = {
@@ -63,11 +65,14 @@ def chat():
         'system_instruction': system_instruction,
         'image_gcs_path': image_gcs_path,
         'image_mime_type': image_mime_type,
-        'audio_bytes': audio_bytes,
+        'audio_gcs_path': audio_gcs_path,
         'audio_mime_type': audio_mime_type,
     }
 
-    endpoint_utils.create_cloud_task('/chat/task', payload)
+    try:
+        dispatch_utils.dispatch_task('/chat/task', payload)
+    except dispatch_utils.QueueFullError:
+        return jsonify({'error': 'Too many requests, please try again shortly'}), 429, {'Retry-After': '5'}
 
     return jsonify({'status': 'processing'}), 202
 
@@ -75,6 +80,14 @@ def chat():
 @chat_bp.route("/task", methods=["POST"])
 def task_chat():
     """Task: Process chat in the background."""
+    # Vertex AI and LangChain load on first use (or during warmup), not when the app starts
+    import src.chat.chat_gemini as perform_chat
+
+    # The in-process dispatcher forwards the task deadline, model calls must end before it
+    if _task_time_left() <= 0:
+        print("Dropping chat task past its deadline")
+        return Response("Task deadline exceeded", status=504)
+
     data = endpoint_utils.parse_json_data(request)
 
     # Extract data from the request
@@ -83,125 +96,189 @@ def task_chat():
     chat_history_id = data['chat_history_id']
     image_gcs_path = data['image_gcs_path']
     image_mime_type = data['image_mime_type']
-    audio_bytes = data['audio_bytes']
+    audio_gcs_path = data.get('audio_gcs_path')
     audio_mime_type = data['audio_mime_type']
 
     # Prepare content for chat generation
-    contents = prepare_chat_contents(text, audio_bytes, audio_mime_type, image_gcs_path, image_mime_type)
-
-    # Fetch system instruction
-    config = remote_config_utils.get_remote_config_value("Prompts", "sqlAgentSystemInstruction")
-    if not config:
-        return Response("Configuration not found", status=404)
-
-    file_name = config['fileName']
-    system_instruction = remote_config_utils.get_gcs_prompt(file_name)
-
-    # Define diabetes datamart tool
-    # -- SQL Agent Function Description
-    config = remote_config_utils.get_remote_config_value("Prompts", "sqlAgentFunctionDescription")
-    if not config:
-        return Response("Configuration not found", status=404)
-
-    file_name = config['fileName']
-    sql_agent_function_description = remote_config_utils.get_gcs_prompt(file_name)
-
-    # -- SQL Agent Function Parameters
-    config = remote_config_utils.get_remote_config_value("Prompts", "sqlAgentFunctionParameters")
-    if not config:
+    contents = prepare_chat_contents(text, audio_gcs_path, audio_mime_type, image_gcs_path, image_mime_type)
+
+    # Load system instruction, tools and chat history concurrently
+    try:
+        prompt_bundle, prefetched = prefetch_chat(contents, user_id, chat_history_id)
+    except PrefetchTimeout as e:
+        print(f"Unable to prepare chat: {e}")
+        return Response("Timed out preparing the chat", status=503)
+    if not prompt_bundle:
         return Response("Configuration not found", status=404)
 
-    file_name = config['fileName']
-    sql_agent_function_parameters = remote_config_utils.get_gcs_prompt(file_name)
-    sql_agent_function_parameters = json.loads(sql_agent_function_parameters)
-
-    get_diabetes_data_output = FunctionDeclaration(
-        name="get_diabetes_data_output",
-        description=sql_agent_function_description,
-        parameters=sql_agent_function_parameters,
-    )
-
-    diabetes_datamart_tool = Tool(
-        function_declarations=[
-            get_diabetes_data_output
-        ],
-    )
-
-    # Generate chat response
-    output_text, chat_history_id = perform_chat.generate_text(
-        prompt=contents,
-        system_instruction=system_instruction,
-        user_id=user_id,
-        chat_history_id=chat_history_id,
-        tools=[diabetes_datamart_tool],
-    )
+    # The same image may still be uploading for a concurrent request in this process
+    try:
+        image_utils.wait_for_pending_upload(image_gcs_path)
+    except image_utils.ImageUploadError as e:
+        print(f"Unable to stage image: {e}")
+        return Response("Image upload failed", status=503)
+
+    # Generate chat response, publishing progress to Firestore as it runs
+    progress_writer = ChatProgressWriter(user_id, chat_history_id)
+    with llm_utils.deadline(min(llm_utils.LLM_REQUEST_DEADLINE, _task_time_left())):
+        output_text, chat_history_id = perform_chat.generate_text(
+            prompt=contents,
+            system_instruction=prompt_bundle.system_instruction,
+            user_id=user_id,
+            chat_history_id=chat_history_id,
+            tools=prompt_bundle.tools,
+            tools_version=prompt_bundle.version,
+            progress=progress_writer,
+            prefetched=prefetched,
+        )
 
     # Update Firestore with the generated answer
-    update_firestore(user_id, chat_history_id, output_text)
+    progress_writer.complete(output_text, chat_history_id)
 
     return jsonify({
         "output_text": output_text,
-        "chat_history_id": chat_history_id
+        "chat_history_id": chat_history_id,
+        "prompt_version": prompt_bundle.version
     }), 200
 
 
+def _task_time_left() -> float:
+    """Seconds until the X-Task-Deadline (epoch seconds) of this task, the request deadline without one."""
+    try:
+        return float(request.headers['X-Task-Deadline']) - time.time()
+    except (KeyError, ValueError):
+        return llm_utils.LLM_REQUEST_DEADLINE
+
+
+@chat_bp.route("/stream", methods=["POST"])
+def stream_chat():
+    """Handle chat requests, streaming the answer over Server-Sent Events."""
+    import src.chat.chat_gemini as perform_chat
+
+    # Verify the authentication token
+    auth_result = endpoint_utils.verify_auth_token(request)
+    if isinstance(auth_result, tuple):
+        return auth_result
+
+    decoded_token = auth_result
+    user_id = decoded_token['uid']
+
+    # Parse JSON data from request
+    data = endpoint_utils.parse_json_data(request)
+
+    # Extract and clean text
+    text = data.get("text")
+    if text:
+        text = clean_text(text)
+
+    chat_history_id = data.get("chat_id", data.get("chatId"))
+
+    # Process audio and image data
+    audio_bytes, audio_mime_type = process_audio_data(request, data)
+    audio_gcs_path = stage_audio_data(user_id, audio_bytes, audio_mime_type)
+    try:
+        image_gcs_path, image_mime_type, image_upload = process_image_data(request, user_id)
+    except image_utils.ImageUploadError as e:
+        print(f"Unable to stage image: {e}")
+        return jsonify({'error': 'Unable to upload the image, please try again'}), 503
+
+    # Prepare content for chat generation
+    contents = prepare_chat_contents(text, audio_gcs_path, audio_mime_type, image_gcs_path, image_mime_type)
+
+    # Load system instruction, tools and chat history concurrently
+    try:
+        prompt_bundle, prefetched = prefetch_chat(contents, user_id, chat_history_id)
+    except PrefetchTimeout as e:
+        print(f"Unable to prepare chat: {e}")
+        return Response("Timed out preparing the chat", status=503)
+    if not prompt_bundle:
+        return Response("Configuration not found", status=404)
+
+    # The model reads the image from GCS
+    try:
+        image_utils.wait_for_upload(image_upload)
+    except image_utils.ImageUploadError as e:
+        print(f"Unable to stage image: {e}")
+        return jsonify({'error': 'Unable to upload the image, please try again'}), 503
+
+    def produce(cancel_event):
+        # Runs on the SSE worker thread, which does not inherit this request's context
+        with llm_utils.deadline():
+            for event in perform_chat.stream_text(
+                prompt=contents,
+                system_instruction=prompt_bundle.system_instruction,
+                user_id=user_id,
+                chat_history_id=chat_history_id,
+                tools=prompt_bundle.tools,
+                tools_version=prompt_bundle.version,
+                cancel_event=cancel_event,
+                prefetched=prefetched,
+            ):
+                if event['event'] == 'done':
+                    # Keep Firestore in sync for clients that listen instead of streaming
+                    update_firestore(user_id, event['data']['chat_history_id'], event['data']['output_text'])
+                yield event
+
+    return sse_utils.sse_response(produce)
+
+
+@traced("audio_transcode")
 def process_audio_data(request, data):
     """Process audio data from the request."""
     if 'audio' in request.files:
-        audio_file = request.files['audio']
-        audio_bytes = audio_file.read()
-        mime = magic.Magic(mime=True)
-        file_mime_type = mime.from_buffer(audio_bytes)
-
-        if file_mime_type in ["video/webm", "audio/webm"]:
-            webm_audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format="webm")
-            mp3_io = io.BytesIO()
-            webm_audio.export(mp3_io, format="mp3")
-            return mp3_io.getvalue(), "audio/mpeg"
-        else:
+        # Size and MIME type are checked from the spooled upload, then it streams into the transcoder
+        audio_stream, file_mime_type = ingest_utils.open_upload(
+            'audio', audio_utils.WEBM_MIME_TYPES, audio_utils.AUDIO_MAX_INPUT_BYTES)
+        try:
+            return audio_utils.transcode_audio(audio_stream, file_mime_type)
+        except audio_utils.TranscodeError as e:
+            print(f"Unable to transcode audio: {e}")
             return None, None
     elif 'audio' in data:
+        # Decoded a chunk at a time into a spooled buffer instead of one bytes object, and the
+        # base64 text is dropped from the request data once decoded
+        audio_stream, audio_mime_type = ingest_utils.decode_base64_upload(
+            data.pop('audio'), ["audio/"] + audio_utils.WEBM_MIME_TYPES, audio_utils.AUDIO_MAX_INPUT_BYTES)
         try:
-            audio_bytes = base64.b64decode(data['audio'])
-            mime = magic.Magic(mime=True)
-            audio_mime_type = mime.from_buffer(audio_bytes)
-
-            if audio_mime_type in ["video/webm", "audio/webm"]:
-                webm_audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format="webm")
-                mp3_io = io.BytesIO()
-                webm_audio.export(mp3_io, format="mp3")
-                return mp3_io.getvalue(), "audio/mpeg"
-            return audio_bytes, audio_mime_type
-        except:
+            return audio_utils.transcode_audio(audio_stream, audio_mime_type)
+        except (ValueError, audio_utils.TranscodeError) as e:
+            print(f"Unable to transcode audio: {e}")
             return None, None
+        finally:
+            audio_stream.close()
     return None, None
 
 
-def process_image_data(request, user_id, chat_history_id):
-    """Process image data from the request."""
+@traced("audio_upload")
+def stage_audio_data(user_id, audio_bytes, audio_mime_type):
+    """Upload audio bytes to GCS (deduplicated by content hash) and return the gs:// path."""
+    if not audio_bytes:
+        return None
+    return upload_media_to_gcs(user_id, audio_bytes, audio_mime_type)
+
+
+@traced("image_process")
+def process_image_data(request, user_id):
+    """Process image data from the request, returning (gs:// path, MIME type, pending upload)."""
     if 'image' in request.files:
-        image_file = request.files['image']
-        image_bytes = image_file.read()
-        mime = magic.Magic(mime=True)
-        image_mime_type = mime.from_buffer(image_bytes)
-
-        if image_mime_type.startswith("image/"):
-            image_gcs_path = upload_image_to_gcs(
-                user_id,
-                chat_history_id,
-                image_bytes,
-                image_mime_type
-            )
-            return image_gcs_path, image_mime_type
-    return None, None
+        # Size and MIME type are checked from the spooled upload before the pipeline reads it
+        image_stream, image_mime_type = ingest_utils.open_upload(
+            'image', ["image/"], image_utils.IMAGE_MAX_INPUT_BYTES)
+        try:
+            return image_utils.stage_image(image_stream, image_mime_type, user_id)
+        except image_utils.ImageError as e:
+            print(f"Unable to process image: {e}")
+    return None, None, None
 
 
-def prepare_chat_contents(text, audio_bytes, audio_mime_type, image_gcs_path, image_mime_type):
+def prepare_chat_contents(text, audio_gcs_path, audio_mime_type, image_gcs_path, image_mime_type):
     """Prepare contents for chat generation."""
+    from vertexai.generative_models import Part
+
     contents = []
 
-    if audio_bytes:
-        audio_part = Part.from_data(data=audio_bytes, mime_type=audio_mime_type)
+    if audio_gcs_path:
+        audio_part = Part.from_uri(audio_gcs_path, audio_mime_type)
         contents.append(audio_part)
 
     contents.append(text)
@@ -213,26 +290,27 @@ def prepare_chat_contents(text, audio_bytes, audio_mime_type, image_gcs_path, im
     return contents
 
 
+def prefetch_chat(contents, user_id, chat_history_id):
+    """Start the prompt bundle and chat history (or cached answer) lookups together.
+
+    Returns the prompt bundle and the prefetched results for generate_text; the wait is the
+    slowest lookup rather than their sum. Raises PrefetchTimeout when one misses its deadline.
+    """
+    import src.chat.chat_gemini as perform_chat
+
+    prefetch = Prefetch()
+    prefetch.start('prompt_bundle', get_prompt_bundle)
+    for name, (fn, *args) in perform_chat.get_prefetch_operations(contents, user_id, chat_history_id).items():
+        prefetch.start(name, fn, *args)
+
+    with span("prefetch_wait"):
+        prefetched = prefetch.results()
+    return prefetched.pop('prompt_bundle'), prefetched
+
+
 def update_firestore(user_id, chat_history_id, output_text):
     """Update Firestore with the generated answer."""
-    db = firestore.Client()
-    chat_ref = db.collection('users').document(user_id).collection('chats').document(chat_history_id)
-    messages_ref = chat_ref.collection('messages')
-
-    answer_id = str(uuid4())
-    messages_ref.document(answer_id).set({
-        'id': answer_id,
-        'content': output_text,
-        'type': 'answer',
-        'status': 'completed',
-        'timestamp': firestore.SERVER_TIMESTAMP
-    })
-
-    chat_ref.update({
-        'lastMessage': output_text,
-        'status': 'completed',
-        'updatedAt': firestore.SERVER_TIMESTAMP
-    })
+    write_chat_answer(user_id, chat_history_id, output_text)
 
 
 @chat_bp.route("/title", methods=["POST"])
@@ -267,5 +345,10 @@ def get_chat_title():
 
     # Generate chat title
     prompt = prompt.format(input_text=text)
-    generated_title = anthropic_generate.generate(prompt=prompt)
+    with llm_utils.deadline():
+        try:
+            generated_title = generate_text(prompt, max_output_tokens=256)
+        except llm_utils.LLMUnavailable as e:
+            print(f"Unable to generate chat title: {e}")
+            return jsonify({'error': 'Title generation is unavailable'}), 503
     return jsonify({'title': generated_title})
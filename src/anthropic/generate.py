@@ -1,9 +1,12 @@
-import os
-from anthropic import AnthropicVertex
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
+from src.clients.utils import get_anthropic_client
+from src.llm.utils import attempt_timeout, stop_at_deadline
+from src.metrics.utils import traced
 
-@retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(3))
+
+@traced("claude_generate")
+@retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(3) | stop_at_deadline, reraise=True)
 def generate(
     prompt,
     system_instruction: str = "",
@@ -12,8 +15,7 @@ def generate(
 ):
     """Generate."""
 
-    client = AnthropicVertex(region="us-east5",
-                             project_id=os.getenv("GOOGLE_CLOUD_PROJECT"))
+    client = get_anthropic_client(region="us-east5")
 
     message = client.messages.create(
         max_tokens=max_output_tokens,
@@ -25,11 +27,12 @@ def generate(
             }
         ],
         model=model_name,
+        timeout=attempt_timeout(),
     )
     return message.content[0].text
 
 
-@retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(3))
+@retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(3) | stop_at_deadline, reraise=True)
 def stream(
     prompt,
     system_instruction: str = "",
@@ -38,8 +41,7 @@ def stream(
 ):
     """Stream."""
 
-    client = AnthropicVertex(region="us-east5",
-                             project_id=os.getenv("GOOGLE_CLOUD_PROJECT"))
+    client = get_anthropic_client(region="us-east5")
 
     with client.messages.stream(
         max_tokens=max_output_tokens,
@@ -51,6 +53,7 @@ def stream(
             }
         ],
         model=model_name,
+        timeout=attempt_timeout(),
     ) as response:
         for text in response.text_stream:
             yield text
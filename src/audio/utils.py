@@ -0,0 +1,187 @@
+import io
+import os
+import subprocess
+import threading
+import time
+from typing import Iterable, Optional, Tuple, Union
+
+# Transcoding mode: "ffmpeg" (streamed through a subprocess), "passthrough" (forward webm/opus
+# untouched, for models that accept it) or "pydub" (legacy in-memory decode)
+AUDIO_TRANSCODE_MODE = os.getenv("AUDIO_TRANSCODE_MODE", "ffmpeg")
+
+# Concurrent ffmpeg subprocesses, and how long to wait for a free one
+AUDIO_TRANSCODE_WORKERS = int(os.getenv("AUDIO_TRANSCODE_WORKERS", os.cpu_count() or 2))
+AUDIO_TRANSCODE_QUEUE_TIMEOUT = float(os.getenv("AUDIO_TRANSCODE_QUEUE_TIMEOUT", 10))
+
+# Per-transcode limits
+AUDIO_TRANSCODE_TIMEOUT = float(os.getenv("AUDIO_TRANSCODE_TIMEOUT", 60))
+AUDIO_MAX_INPUT_BYTES = int(os.getenv("AUDIO_MAX_INPUT_BYTES", 25 * 1024 * 1024))  # 25 MB
+AUDIO_MAX_OUTPUT_BYTES = int(os.getenv("AUDIO_MAX_OUTPUT_BYTES", 25 * 1024 * 1024))  # 25 MB
+AUDIO_MP3_BITRATE = os.getenv("AUDIO_MP3_BITRATE", "64k")
+
+WEBM_MIME_TYPES = ["video/webm", "audio/webm"]
+CHUNK_SIZE = 64 * 1024
+
+_transcode_slots = threading.BoundedSemaphore(AUDIO_TRANSCODE_WORKERS)
+
+transcode_stats = {
+    'transcodes': 0,
+    'failures': 0,
+    'timeouts': 0,
+    'rejected': 0,
+    'input_bytes': 0,
+    'output_bytes': 0,
+    'seconds': 0.0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, value=1):
+    with _stats_lock:
+        transcode_stats[name] += value
+
+
+class TranscodeError(Exception):
+    """Raised when audio cannot be transcoded within the configured limits."""
+
+
+def iter_chunks(source: Union[bytes, Iterable[bytes], io.IOBase], chunk_size: int = CHUNK_SIZE):
+    """Yield chunks from bytes, a file-like object or an iterable of chunks."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+    elif hasattr(source, "read"):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in source:
+            yield from iter_chunks(chunk, chunk_size)
+
+
+def read_limited(source, max_bytes: int = AUDIO_MAX_INPUT_BYTES) -> bytes:
+    """Read a source fully, failing once it exceeds max_bytes."""
+    buffer = bytearray()
+    for chunk in iter_chunks(source):
+        buffer += chunk
+        if len(buffer) > max_bytes:
+            raise TranscodeError(f"Audio exceeds {max_bytes} bytes")
+    return bytes(buffer)
+
+
+def ffmpeg_to_mp3(
+    source,
+    timeout: float = AUDIO_TRANSCODE_TIMEOUT,
+    max_input_bytes: int = AUDIO_MAX_INPUT_BYTES,
+    max_output_bytes: int = AUDIO_MAX_OUTPUT_BYTES,
+    bitrate: str = AUDIO_MP3_BITRATE
+) -> bytes:
+    """Pipe audio through an ffmpeg subprocess into MP3 without decoding it in Python.
+
+    At most AUDIO_TRANSCODE_WORKERS ffmpeg processes run at once; the input is streamed to
+    stdin in chunks while stdout is drained, and the process is killed on timeout or when
+    either side exceeds its byte limit.
+    """
+    if not _transcode_slots.acquire(timeout=AUDIO_TRANSCODE_QUEUE_TIMEOUT):
+        _count('rejected')
+        raise TranscodeError("All audio transcoding workers are busy")
+
+    start_time = time.perf_counter()
+    process = None
+    try:
+        process = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+             "-i", "pipe:0", "-vn", "-f", "mp3", "-b:a", bitrate, "pipe:1"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        deadline = time.monotonic() + timeout
+        input_bytes = [0]
+        writer_error = []
+
+        def write_input():
+            try:
+                for chunk in iter_chunks(source):
+                    input_bytes[0] += len(chunk)
+                    if input_bytes[0] > max_input_bytes:
+                        writer_error.append(TranscodeError(f"Audio exceeds {max_input_bytes} bytes"))
+                        process.kill()
+                        return
+                    process.stdin.write(chunk)
+            except (BrokenPipeError, OSError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        writer = threading.Thread(target=write_input, daemon=True)
+        writer.start()
+
+        # Kill ffmpeg if it runs past the deadline
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        output = bytearray()
+        try:
+            while True:
+                chunk = process.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                output += chunk
+                if len(output) > max_output_bytes:
+                    process.kill()
+                    raise TranscodeError(f"Transcoded audio exceeds {max_output_bytes} bytes")
+            writer.join()
+            stderr = process.stderr.read()
+            return_code = process.wait()
+        finally:
+            timer.cancel()
+
+        if writer_error:
+            raise writer_error[0]
+        if time.monotonic() > deadline:
+            _count('timeouts')
+            raise TranscodeError(f"Audio transcoding timed out after {timeout}s")
+        if return_code != 0:
+            raise TranscodeError(f"ffmpeg failed ({return_code}): {stderr.decode('utf-8', 'replace')[-500:]}")
+
+        _count('transcodes')
+        _count('input_bytes', input_bytes[0])
+        _count('output_bytes', len(output))
+        return bytes(output)
+    except Exception:
+        _count('failures')
+        raise
+    finally:
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        _count('seconds', time.perf_counter() - start_time)
+        _transcode_slots.release()
+
+
+def pydub_to_mp3(source) -> bytes:
+    """Legacy path: decode the whole webm into PCM with pydub and re-export it as MP3."""
+    from pydub import AudioSegment
+    webm_audio = AudioSegment.from_file(io.BytesIO(read_limited(source)), format="webm")
+    mp3_io = io.BytesIO()
+    webm_audio.export(mp3_io, format="mp3")
+    return mp3_io.getvalue()
+
+
+def transcode_audio(source, mime_type: str, mode: Optional[str] = None) -> Tuple[Optional[bytes], Optional[str]]:
+    """Convert webm audio into a format the model accepts, returning (bytes, mime type)."""
+    mode = mode or AUDIO_TRANSCODE_MODE
+    if mime_type not in WEBM_MIME_TYPES:
+        return read_limited(source), mime_type
+
+    if mode == "passthrough":
+        return read_limited(source), "audio/webm"
+    if mode == "pydub":
+        return pydub_to_mp3(source), "audio/mpeg"
+    return ffmpeg_to_mp3(source), "audio/mpeg"
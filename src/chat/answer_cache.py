@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import List, Optional
+
+# Semantic answer cache settings
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))  # cosine similarity
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))  # 1 day
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")  # empty keeps the index in memory
+ANSWER_CACHE_EMBEDDING_MODEL = os.getenv("ANSWER_CACHE_EMBEDDING_MODEL", "text-embedding-004")
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 10000))  # per dataset
+ANSWER_CACHE_EVICT_EVERY = int(os.getenv("ANSWER_CACHE_EVICT_EVERY", 100))  # stores per dataset between evictions
+
+# Numbers and quoted values, which must match exactly: "over 65" and "over 66" embed almost identically
+LITERAL_PATTERN = re.compile(r"\b\d+(?:[.,]\d+)*\b|'[^']+'|\"[^\"]+\"")
+
+# Comparators, negations and categories flip the answer just as literals do ("over 65" vs "under 65")
+QUALIFIER_PATTERN = re.compile(
+    r"\b(?:over|under|above|below|more|less|fewer|greater|higher|lower|older|younger|before|after|"
+    r"between|least|most|than|exactly|equal|max|maximum|min|minimum|highest|lowest|"
+    r"not|no|never|none|without|except|excluding|non|"
+    r"male|female|men|women|man|woman|boys?|girls?)\b|n't\b"
+)
+
+_chroma_client = None
+_embedding_model = None
+_answer_cache_lock = threading.Lock()
+
+# Stores per dataset since its last eviction
+_stores_since_eviction = {}
+
+answer_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'stale': 0,
+    'stored': 0,
+    'evicted': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, value: int = 1):
+    with _stats_lock:
+        answer_cache_stats[name] += value
+
+
+def _get_chroma_client():
+    global _chroma_client
+    if _chroma_client is None:
+        with _answer_cache_lock:
+            if _chroma_client is None:
+                import chromadb
+                if ANSWER_CACHE_PATH:
+                    _chroma_client = chromadb.PersistentClient(path=ANSWER_CACHE_PATH)
+                else:
+                    _chroma_client = chromadb.EphemeralClient()
+    return _chroma_client
+
+
+def set_embedding_model(model):
+    """Replace the embedding model (any object with get_embeddings(texts)), e.g. in tests."""
+    global _embedding_model
+    _embedding_model = model
+
+
+def embed(texts: List[str]) -> List[List[float]]:
+    """Embed texts with the Vertex AI text embedding model."""
+    global _embedding_model
+    if _embedding_model is None:
+        from vertexai.language_models import TextEmbeddingModel
+        _embedding_model = TextEmbeddingModel.from_pretrained(ANSWER_CACHE_EMBEDDING_MODEL)
+    return [embedding.values for embedding in _embedding_model.get_embeddings(texts)]
+
+
+def normalize_question(question: str) -> str:
+    return re.sub(r'\s+', ' ', question).strip().lower()
+
+
+def question_literals(question: str) -> str:
+    """The numbers, quoted values and qualifiers in question, as a canonical string."""
+    normalized = normalize_question(question)
+    qualifiers = ["not" if word == "n't" else word for word in QUALIFIER_PATTERN.findall(normalized)]
+    return json.dumps(sorted(LITERAL_PATTERN.findall(normalized) + qualifiers))
+
+
+def _collection(dataset: str):
+    """Each dataset gets its own collection (namespace) of cached answers."""
+    name = "answers_" + hashlib.sha1(dataset.encode("utf-8")).hexdigest()[:16]
+    return _get_chroma_client().get_or_create_collection(name=name, metadata={"hnsw:space": "cosine"})
+
+
+def lookup_answer(question: str, dataset: str, version: str) -> Optional[dict]:
+    """Return the cached answer for a similar question on the same dataset version, if confident."""
+    if not ANSWER_CACHE_ENABLED or not question:
+        return None
+
+    try:
+        collection = _collection(dataset)
+        result = collection.query(
+            query_embeddings=embed([normalize_question(question)]),
+            n_results=1,
+            where={"$and": [{"version": version}, {"literals": question_literals(question)}]},
+        )
+    except Exception as e:
+        print(f"Answer cache lookup failed: {e}")
+        return None
+
+    if not result['ids'] or not result['ids'][0]:
+        _count('misses')
+        return None
+
+    similarity = 1 - result['distances'][0][0]
+    metadata = result['metadatas'][0][0]
+    if similarity < ANSWER_CACHE_THRESHOLD:
+        _count('misses')
+        return None
+    if time.time() - metadata['created_at'] > ANSWER_CACHE_TTL:
+        _count('stale')
+        return None
+
+    _count('hits')
+    return {
+        'question': metadata['question'],
+        'answer': metadata['answer'],
+        'output_answer': metadata['output_answer'],
+        'queries': json.loads(metadata['queries']),
+        'similarity': similarity,
+    }
+
+
+def store_answer(question: str, dataset: str, version: str, answer: str, output_answer: str, queries: List[str]):
+    """Store the final answer, agent output and queries used for question."""
+    if not ANSWER_CACHE_ENABLED or not question or not answer:
+        return
+
+    normalized = normalize_question(question)
+    try:
+        collection = _collection(dataset)
+        collection.upsert(
+            ids=[hashlib.sha256(f"{version}\0{normalized}".encode("utf-8")).hexdigest()],
+            embeddings=embed([normalized]),
+            metadatas=[{
+                'question': question,
+                'version': version,
+                'literals': question_literals(question),
+                'answer': answer,
+                'output_answer': str(output_answer),
+                'queries': json.dumps(queries),
+                'created_at': time.time(),
+            }],
+        )
+        _count('stored')
+        if _eviction_due(dataset):
+            evict_answers(collection, version)
+    except Exception as e:
+        print(f"Answer cache store failed: {e}")
+
+
+def _eviction_due(dataset: str) -> bool:
+    """True once every ANSWER_CACHE_EVICT_EVERY stores, eviction scans the whole collection."""
+    with _stats_lock:
+        stores = _stores_since_eviction.get(dataset, 0) + 1
+        due = stores >= ANSWER_CACHE_EVICT_EVERY
+        _stores_since_eviction[dataset] = 0 if due else stores
+    return due
+
+
+def evict_answers(collection, version: str, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+    """Delete answers for other dataset versions or past the TTL, then the oldest beyond max_entries."""
+    before = collection.count()
+    collection.delete(where={"$or": [
+        {"version": {"$ne": version}},
+        {"created_at": {"$lt": time.time() - ANSWER_CACHE_TTL}},
+    ]})
+    remaining = collection.count()
+    if remaining > max_entries:
+        # Trim to 90% so the full scan runs once per many stores
+        entries = collection.get(include=["metadatas"])
+        oldest = sorted(zip(entries['ids'], entries['metadatas']), key=lambda entry: entry[1]['created_at'])
+        collection.delete(ids=[entry_id for entry_id, _ in oldest[:remaining - int(max_entries * 0.9)]])
+        remaining = collection.count()
+    _count('evicted', before - remaining)
+
+
+def invalidate_answers(dataset: Optional[str] = None):
+    """Drop cached answers for a dataset, or every dataset when omitted."""
+    client = _get_chroma_client()
+    for collection in client.list_collections():
+        name = collection if isinstance(collection, str) else collection.name
+        if not name.startswith("answers_"):
+            continue
+        if dataset is None or name == "answers_" + hashlib.sha1(dataset.encode("utf-8")).hexdigest()[:16]:
+            client.delete_collection(name)
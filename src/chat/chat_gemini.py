@@ -1,20 +1,216 @@
 import os
 import traceback
-import vertexai
-import vertexai.preview.generative_models as generative_models
 from vertexai.generative_models import (
-    FunctionDeclaration,
-    GenerationConfig,
-    GenerativeModel,
-    Part,
-    Tool,
-    ToolConfig
+    Content,
+    Part
 )
 from typing import Any, Dict, List, Optional
 from uuid import uuid4
 
-from src.chat.sql_agent import create_database_sql_agent
+from src.chat.answer_cache import lookup_answer, store_answer
+from src.chat.models import get_model, init_vertexai
+from src.chat.sql_agent import get_sql_database
+from src.chat.sql_fast_path import answer_question
 from src.chat.utils import get_chat_history, save_chat_history
+from src.chat.window import shape_history
+import src.llm.utils as llm_utils
+from src.metrics.utils import span
+
+
+def chat_call_key(model_name: str) -> str:
+    """Breaker and stats key of chat turns.
+
+    Chat turns have no fallback model, so they get their own circuit: failures of the same model
+    elsewhere (e.g. as the SQL fallback) do not open it. Once chat turns themselves fail
+    LLM_BREAKER_FAILURES times in a row, chats fail fast with the retry message for
+    LLM_BREAKER_RESET seconds instead of each waiting out LLM_CALL_TIMEOUT.
+    """
+    return f"chat:{model_name}"
+
+
+def create_models(
+    model_name: str,
+    system_instruction: Optional[str] = None,
+    tools: List[Any] = None,
+    safety_settings: Optional[Dict[str, Any]] = None,
+    tools_version=None
+):
+    """Get the function calling and output response models (cached per configuration)."""
+    # Initialize function calling model
+    function_calling_model_instance = get_model(
+        model_name,
+        system_instruction=system_instruction,
+        tools=tools,
+        tools_version=tools_version,
+        safety_settings=safety_settings
+    )
+
+    # Initialize output response model
+    output_response_model_instance = get_model(
+        model_name,
+        system_instruction=system_instruction,
+        safety_settings=safety_settings
+    )
+
+    return function_calling_model_instance, output_response_model_instance
+
+
+def start_chat_session(model, user_id: Optional[str] = None, chat_history_id: Optional[str] = None,
+                       chat_history=None):
+    """Start a chat session, resuming the stored history (windowed and summarized) when a chat id is given.
+
+    chat_history, when already loaded (see routes.chat prefetching), is used instead of loading it.
+    Returns the chat, the chat id, the full stored history and the length of the shaped history
+    the chat was started with, so save_chat_session can append only the new turns.
+    """
+    if chat_history_id:
+        if chat_history is None:
+            chat_history = get_chat_history(user_id, chat_history_id)
+        shaped_history, token_stats = shape_history(chat_history, user_id, chat_history_id)
+        if token_stats['tokens_saved']:
+            print(f"History shaping saved {token_stats['tokens_saved']} of "
+                  f"{token_stats['tokens_before']} tokens for chat {chat_history_id}")
+        chat = model.start_chat(history=shaped_history)
+    else:
+        chat_history_id, chat_history, shaped_history = str(uuid4()), [], []
+        chat = model.start_chat()
+    return chat, chat_history_id, chat_history, len(shaped_history)
+
+
+def save_chat_session(user_id: str, chat_history_id: str, history, chat_history, shaped_length: int):
+    """Save the stored history plus the turns added to the chat during this request.
+
+    history is a snapshot of the chat's history taken after its last completed turn: a timed out
+    call keeps running and may still append its turn to the live chat.
+    """
+    save_chat_history(user_id, chat_history_id, list(chat_history) + list(history[shaped_length:]))
+
+
+def get_diabetes_data_output(function_call, system_instruction: Optional[str] = None, progress=None):
+    """Run the SQL agent for a get_diabetes_data_output function call and build the response part.
+
+    Answers for semantically similar questions on the same dataset version are served from the
+    answer cache; otherwise the single-shot SQL fast path runs before falling back to the agent.
+    Returns the response part and the result, including the path used and its LLM call count.
+    """
+    args = dict(function_call.args)
+    question = args['question']
+
+    cached_answer = lookup_cached_answer(question)
+    if cached_answer:
+        answer = cached_answer['output_answer']
+        intermediate_steps = cached_answer['queries']
+        sql_path, llm_calls = 'cache', 0
+    else:
+        sql_result = answer_question(question, system_instruction, progress=progress)
+        answer = sql_result['output_answer']
+        intermediate_steps = sql_result['queries']
+        sql_path, llm_calls = sql_result['sql_path'], sql_result['llm_calls']
+    print(f"Answered data question via {sql_path} path with {llm_calls} LLM calls")
+
+    instructions = (
+        "Summarize the output answer. Below the output answer include and explain"
+        " each and every query used for the answer."
+        " Always include the output answer and the queries used for the output answer."
+    )
+    api_response = {
+        'queries_used_for_output_answer': str(intermediate_steps),
+        'instructions': instructions,
+        'output_answer': answer}
+    response_part = Part.from_function_response(
+        name=function_call.name,
+        response={"content": api_response},
+    )
+    result = {
+        'question': question,
+        'output_answer': answer,
+        'queries': intermediate_steps,
+        'cached': bool(cached_answer),
+        'sql_path': sql_path,
+        'llm_calls': llm_calls,
+    }
+    return response_part, result
+
+
+def get_prompt_text(prompt) -> Optional[str]:
+    """Get the question text when the prompt is text only (no audio or image parts)."""
+    if isinstance(prompt, str):
+        return prompt
+    if isinstance(prompt, list) and prompt and all(isinstance(item, str) for item in prompt):
+        return " ".join(prompt)
+    return None
+
+
+def lookup_cached_answer(question: Optional[str]) -> Optional[dict]:
+    """Look up a cached answer for question on the current dataset version."""
+    if not question:
+        return None
+    try:
+        db = get_sql_database()
+        return lookup_answer(question, db.dataset_key, db.get_table_version())
+    except Exception as e:
+        print(f"Answer cache unavailable: {e}")
+        return None
+
+
+def remember_answers(prompt, new_chat: bool, results: List[dict], output_text: str):
+    """Store the final answer of a turn that ran one agent query, for the agent's question and
+    for the user's question when it starts a chat.
+
+    Turns with several results are not cached, their answer combines results of other questions.
+    """
+    if len(results) != 1 or results[0]['cached'] or not output_text:
+        return
+    result = results[0]
+    try:
+        db = get_sql_database()
+        dataset, version = db.dataset_key, db.get_table_version()
+        questions = [result['question']]
+        prompt_text = get_prompt_text(prompt)
+        if new_chat and prompt_text:
+            questions.append(prompt_text)
+        for question in questions:
+            store_answer(question, dataset, version, output_text, result['output_answer'], result['queries'])
+    except Exception as e:
+        print(f"Unable to store answer in cache: {e}")
+
+
+def get_prefetch_operations(prompt, user_id: Optional[str], chat_history_id: Optional[str]) -> dict:
+    """I/O generate_text would otherwise do before its first model call, as {name: (fn, *args)}.
+
+    Callers start these concurrently (see src.prefetch.utils.Prefetch) and pass the results
+    to generate_text or stream_text as prefetched.
+    """
+    if chat_history_id:
+        return {'chat_history': (get_chat_history, user_id, chat_history_id)}
+    return {'cached_answer': (lookup_cached_answer, get_prompt_text(prompt))}
+
+
+def get_cached_answer(prompt, chat_history_id: Optional[str], prefetched: dict) -> Optional[dict]:
+    """Cached answer for a new chat's question, from prefetched results when available."""
+    if chat_history_id:
+        return None
+    if 'cached_answer' in prefetched:
+        return prefetched['cached_answer']
+    return lookup_cached_answer(get_prompt_text(prompt))
+
+
+def save_cached_answer(prompt, user_id: str, cached_answer: dict):
+    """Start a new chat whose history is the question and its cached answer."""
+    chat_history_id = str(uuid4())
+    save_chat_history(user_id, chat_history_id, [
+        Content(role="user", parts=[Part.from_text(get_prompt_text(prompt))]),
+        Content(role="model", parts=[Part.from_text(cached_answer['answer'])]),
+    ])
+    return chat_history_id
+
+
+def get_chunk_text(chunk) -> str:
+    """Get the text of a streamed response chunk, ignoring non-text parts."""
+    try:
+        return chunk.text
+    except (ValueError, IndexError, AttributeError):
+        return ""
 
 
 def generate_text(
@@ -26,61 +222,51 @@ def generate_text(
     tools: List[Any] = None,
     safety_settings: Optional[Dict[str, Any]] = None,
     location: str = "us-central1",
-    model_name: str = "gemini-1.5-pro-001"
+    model_name: str = "gemini-1.5-pro-001",
+    tools_version=None,
+    progress=None,
+    prefetched: Optional[dict] = None
 ):
-    """Generate text."""
-    vertexai.init(project=project_id, location=location)
+    """Generate text.
 
-    if not tools:
-        tools = []
+    progress, when given, is called as progress(status, **fields) as the answer is built
+    (planning, query, executing, summarizing with the partial summary). prefetched may hold
+    the already loaded 'chat_history' and 'cached_answer' (see get_prefetch_operations).
+    """
+    prefetched = prefetched or {}
 
-    if not safety_settings:
-        safety_settings = {
-            generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-        }
+    # A new text-only chat asking an already answered question skips the models entirely
+    cached_answer = get_cached_answer(prompt, chat_history_id, prefetched)
+    if cached_answer:
+        return cached_answer['answer'], save_cached_answer(prompt, user_id, cached_answer)
 
-    # Initialize function calling model
-    function_calling_model_instance = GenerativeModel(
+    init_vertexai(project_id, location)
+    new_chat = not chat_history_id
+
+    function_calling_model_instance, output_response_model_instance = create_models(
         model_name,
-        system_instruction=None if not system_instruction else [system_instruction],
-        generation_config=GenerationConfig(
-            temperature=0.2,
-        ),
-        safety_settings=safety_settings,
+        system_instruction=system_instruction,
         tools=tools,
-        tool_config=ToolConfig(
-            function_calling_config=ToolConfig.FunctionCallingConfig(
-                mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
-                allowed_function_names=["get_diabetes_data_output"],
-            ))
+        safety_settings=safety_settings,
+        tools_version=tools_version
     )
 
-    # Initialize output response model
-    output_response_model_instance = GenerativeModel(
-        model_name,
-        system_instruction=None if not system_instruction else [system_instruction],
-        generation_config=GenerationConfig(
-            temperature=0.2,
-        ),
-        safety_settings=safety_settings
-    )
-
-    if chat_history_id:
-        chat_history = get_chat_history(user_id, chat_history_id)
-        chat = function_calling_model_instance.start_chat(history=chat_history)
-    else:
-        chat_history_id, chat_history = str(uuid4()), []
-        chat = function_calling_model_instance.start_chat()
+    chat, chat_history_id, chat_history, shaped_length = start_chat_session(
+        function_calling_model_instance, user_id, chat_history_id, prefetched.get('chat_history'))
+    history = list(chat.history)
 
     try:
+        if progress:
+            progress('planning', chat_history_id=chat_history_id)
+
         # Send initial message
-        response = chat.send_message(prompt)
+        with span("gemini_function_call_turn"):
+            response = llm_utils.call(chat_call_key(model_name), lambda: chat.send_message(prompt))
+        history = list(chat.history)
 
         # Initialize tracking variables
         output_text = ""
+        results = []
 
         break_loop = False
         while True:
@@ -94,34 +280,10 @@ def generate_text(
                     break_loop = True
                     break
                 elif function_call_name == 'get_diabetes_data_output':
-                    agent_executor = create_database_sql_agent()
-                    args = dict(response.candidates[0].content.parts[0].function_call.args)
-                    output = agent_executor.invoke(f"{system_instruction}\n{args['question']}")
-                    intermediate_steps = []
-                    for index, step in enumerate(output['intermediate_steps'][1:]):
-                        intermediate_step = step[0].to_json()['kwargs']['tool_input']
-                        if intermediate_step not in intermediate_steps:
-                            intermediate_steps.append(intermediate_step)
-
-                    intermediate_steps = [f"Query {index + 1}:\n" + intermediate_step
-                                          for index, intermediate_step in enumerate(intermediate_steps)]
-
-                    answer = output['output']
-
-                    instructions = (
-                        "Summarize the output answer. Below the output answer include and explain"
-                        " each and every query used for the answer."
-                        " Always include the output answer and the queries used for the output answer."
-                    )
-                    api_response = {
-                        'queries_used_for_output_answer': str(intermediate_steps),
-                        'instructions': instructions,
-                        'output_answer': answer}
-                    response_part = Part.from_function_response(
-                        name=function_call_name,
-                        response={"content": api_response},
-                    )
+                    response_part, result = get_diabetes_data_output(
+                        part.function_call, system_instruction, progress=progress)
                     response_parts.append(response_part)
+                    results.append(result)
                 else:
                     # Unhandled function call
                     output_text = 'Could not resolve appropriate function and determine an answer.'
@@ -130,13 +292,129 @@ def generate_text(
             if break_loop:
                 break
             else:
-                chat = output_response_model_instance.start_chat(history=chat.history)
-                response = chat.send_message(response_parts)
+                chat = output_response_model_instance.start_chat(history=list(history))
+                if progress:
+                    # Stream the summary so partial answers can be published
+                    output_text = ""
+                    with span("gemini_summary_turn"):
+                        for chunk in llm_utils.stream(
+                                chat_call_key(model_name), lambda: chat.send_message(response_parts, stream=True)):
+                            output_text += get_chunk_text(chunk)
+                            progress('summarizing', partial_summary=output_text)
+                    history = list(chat.history)
+                    break
+                with span("gemini_summary_turn"):
+                    response = llm_utils.call(chat_call_key(model_name), lambda: chat.send_message(response_parts))
+                history = list(chat.history)
+
+        remember_answers(prompt, new_chat, results, output_text)
     except Exception as e:
         print(f"Error occurred: {e}\n{traceback.format_exc()}")
         output_text = f"Please try again. An unexpected error occurred."
 
     # Save chat history
-    save_chat_history(user_id, chat_history_id, chat.history)
+    save_chat_session(user_id, chat_history_id, history, chat_history, shaped_length)
 
     return output_text, chat_history_id
+
+
+def stream_text(
+    prompt,
+    system_instruction: Optional[str] = None,
+    user_id: Optional[str] = None,
+    chat_history_id: Optional[str] = None,
+    project_id: str = os.getenv("GOOGLE_CLOUD_PROJECT"),
+    tools: List[Any] = None,
+    safety_settings: Optional[Dict[str, Any]] = None,
+    location: str = "us-central1",
+    model_name: str = "gemini-1.5-pro-001",
+    tools_version=None,
+    cancel_event=None,
+    prefetched: Optional[dict] = None
+):
+    """Generate text, streaming the final summarization turn.
+
+    Yields event dicts ({'event': ..., 'data': ...}) of type chat, status, token, error and done.
+    When cancel_event is set the stream stops early and the chat history is left untouched.
+    prefetched is as for generate_text.
+    """
+    prefetched = prefetched or {}
+    cached_answer = get_cached_answer(prompt, chat_history_id, prefetched)
+    if cached_answer:
+        chat_history_id = save_cached_answer(prompt, user_id, cached_answer)
+        yield {'event': 'chat', 'data': {'chat_history_id': chat_history_id}}
+        yield {'event': 'token', 'data': cached_answer['answer']}
+        yield {'event': 'done', 'data': {'output_text': cached_answer['answer'], 'chat_history_id': chat_history_id}}
+        return
+
+    init_vertexai(project_id, location)
+    new_chat = not chat_history_id
+
+    function_calling_model_instance, output_response_model_instance = create_models(
+        model_name,
+        system_instruction=system_instruction,
+        tools=tools,
+        safety_settings=safety_settings,
+        tools_version=tools_version
+    )
+
+    chat, chat_history_id, chat_history, shaped_length = start_chat_session(
+        function_calling_model_instance, user_id, chat_history_id, prefetched.get('chat_history'))
+    history = list(chat.history)
+    yield {'event': 'chat', 'data': {'chat_history_id': chat_history_id}}
+
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    output_text = ""
+    try:
+        yield {'event': 'status', 'data': 'planning'}
+        with span("gemini_function_call_turn"):
+            response = llm_utils.call(chat_call_key(model_name), lambda: chat.send_message(prompt))
+        history = list(chat.history)
+
+        response_parts = []
+        results = []
+        for part in response.candidates[0].content.parts:
+            function_call_name = part.function_call.name
+            if not function_call_name:
+                # Direct text response
+                output_text = part.text
+                break
+            elif function_call_name == 'get_diabetes_data_output':
+                yield {'event': 'status', 'data': 'executing'}
+                response_part, result = get_diabetes_data_output(part.function_call, system_instruction)
+                response_parts.append(response_part)
+                results.append(result)
+            else:
+                # Unhandled function call
+                output_text = 'Could not resolve appropriate function and determine an answer.'
+                break
+
+        if cancelled():
+            return
+
+        if response_parts and not output_text:
+            yield {'event': 'status', 'data': 'summarizing'}
+            chat = output_response_model_instance.start_chat(history=list(history))
+            for chunk in llm_utils.stream(chat_call_key(model_name),
+                                          lambda: chat.send_message(response_parts, stream=True)):
+                if cancelled():
+                    return
+                text = get_chunk_text(chunk)
+                if text:
+                    output_text += text
+                    yield {'event': 'token', 'data': text}
+            history = list(chat.history)
+            remember_answers(prompt, new_chat, results, output_text)
+        else:
+            yield {'event': 'token', 'data': output_text}
+    except Exception as e:
+        print(f"Error occurred: {e}\n{traceback.format_exc()}")
+        output_text = f"Please try again. An unexpected error occurred."
+        yield {'event': 'error', 'data': output_text}
+
+    # Save chat history
+    save_chat_session(user_id, chat_history_id, history, chat_history, shaped_length)
+
+    yield {'event': 'done', 'data': {'output_text': output_text, 'chat_history_id': chat_history_id}}
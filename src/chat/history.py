@@ -0,0 +1,306 @@
+import gzip
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import jsonpickle
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from src.clients.utils import get_storage_client
+from src.prefetch.utils import map_concurrently
+
+# Compress history segments with gzip
+CHAT_HISTORY_COMPRESSION = os.getenv("CHAT_HISTORY_COMPRESSION", "true").lower() == "true"
+
+# Merge segments into one once a chat has more than this many
+CHAT_HISTORY_COMPACT_THRESHOLD = int(os.getenv("CHAT_HISTORY_COMPACT_THRESHOLD", 16))
+
+# Number of chats whose decoded history is kept in memory for incremental loads
+CHAT_HISTORY_CACHE_SIZE = int(os.getenv("CHAT_HISTORY_CACHE_SIZE", 256))
+
+CODEC_VERSION = 1
+GZIP_MAGIC = b"\x1f\x8b"
+SEGMENT_PATTERN = re.compile(r"(\d{8})-(\d{8})\.json(\.gz)?$")
+
+# Decoded history per (user_id, chat_history_id), in least recently used order
+history_cache = OrderedDict()
+_history_cache_lock = threading.Lock()
+
+
+def encode_contents(contents, compress: bool = CHAT_HISTORY_COMPRESSION) -> bytes:
+    """Encode Vertex Content objects as schema-stable JSON, optionally gzip compressed."""
+    data = json.dumps(
+        {'v': CODEC_VERSION, 'contents': [content.to_dict() for content in contents]},
+        separators=(',', ':'),
+        ensure_ascii=False
+    ).encode('utf-8')
+    return gzip.compress(data, compresslevel=6) if compress else data
+
+
+def decode_contents(data: bytes) -> list:
+    """Decode bytes produced by encode_contents back into Content objects."""
+    from vertexai.generative_models import Content
+
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    payload = json.loads(data)
+    return [Content.from_dict(content) for content in payload['contents']]
+
+
+def _history_prefix(user_id: str, chat_history_id: str) -> str:
+    return f"users/{user_id}/chats/{chat_history_id}/history/"
+
+
+def _legacy_blob_name(user_id: str, chat_history_id: str) -> str:
+    return f"users/{user_id}/chats/{chat_history_id}.txt"
+
+
+def _segment_name(prefix: str, start: int, end: int, compress: bool) -> str:
+    return f"{prefix}{start:08d}-{end:08d}.json{'.gz' if compress else ''}"
+
+
+def _get_bucket():
+    return get_storage_client().bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
+
+
+def _list_segments(bucket, prefix: str):
+    """List stored segments as (start, end, blob), ordered by start then widest first."""
+    segments = []
+    for blob in bucket.list_blobs(prefix=prefix):
+        match = SEGMENT_PATTERN.search(blob.name)
+        if match:
+            segments.append((int(match.group(1)), int(match.group(2)), blob))
+    segments.sort(key=lambda segment: (segment[0], -segment[1]))
+    return segments
+
+
+def _segment_chain(segments, position: int = 0):
+    """Pick the fewest segments covering turns from position onwards (compacted ones win)."""
+    widest = {}
+    for start, end, blob in segments:
+        if start not in widest or end > widest[start][1]:
+            widest[start] = (start, end, blob)
+
+    chain = []
+    while position in widest:
+        segment = widest[position]
+        chain.append(segment)
+        position = segment[1]
+    return chain
+
+
+def _cache_get(key):
+    """Cached (contents, stored segment count) of a chat, (None, 0) when not cached."""
+    with _history_cache_lock:
+        if key in history_cache:
+            history_cache.move_to_end(key)
+            return history_cache[key]
+    return None, 0
+
+
+def _cache_set(key, contents, segment_count: int):
+    with _history_cache_lock:
+        history_cache[key] = (contents, segment_count)
+        history_cache.move_to_end(key)
+        while len(history_cache) > CHAT_HISTORY_CACHE_SIZE:
+            history_cache.popitem(last=False)
+
+
+def _cache_pop(key):
+    with _history_cache_lock:
+        history_cache.pop(key, None)
+
+
+def _migrate_legacy_history(bucket, user_id: str, chat_history_id: str):
+    """Convert a legacy jsonpickle blob into a single segment.
+
+    The legacy blob is kept, so the migration can be rolled back or repeated; once the segment
+    exists, loads no longer read it.
+    """
+    legacy_blob = bucket.blob(_legacy_blob_name(user_id, chat_history_id))
+    try:
+        # A single download, a missing blob (the common case) is one 404 instead of exists() + download
+        legacy_text = legacy_blob.download_as_text()
+    except NotFound:
+        return []
+
+    contents = jsonpickle.decode(legacy_text)
+    if contents:
+        prefix = _history_prefix(user_id, chat_history_id)
+        segment_blob = bucket.blob(_segment_name(prefix, 0, len(contents), CHAT_HISTORY_COMPRESSION))
+        try:
+            segment_blob.upload_from_string(
+                encode_contents(contents),
+                content_type='application/octet-stream',
+                if_generation_match=0
+            )
+        except PreconditionFailed:
+            # A concurrent request migrated the same blob
+            pass
+    return contents
+
+
+def load_history(user_id: str, chat_history_id: str) -> list:
+    """Load chat history, downloading only segments not already held in memory.
+
+    Segments are listed on every load (one request, compaction keeps them few); for a cached
+    chat only segments appended past the cached turns, usually none, are downloaded.
+    """
+    key = (user_id, chat_history_id)
+    bucket = _get_bucket()
+    prefix = _history_prefix(user_id, chat_history_id)
+    cached, _ = _cache_get(key)
+
+    for attempt in range(2):
+        segments = _list_segments(bucket, prefix)
+
+        if not segments:
+            contents = _migrate_legacy_history(bucket, user_id, chat_history_id)
+            _cache_set(key, contents, 1 if contents else 0)
+            return list(contents)
+
+        total = max(end for _, end, _ in segments)
+        contents = list(cached or [])
+        chain = _segment_chain(segments, len(contents))
+        if not chain or chain[-1][1] != total:
+            if cached is not None and len(cached) == total:
+                _cache_set(key, cached, len(segments))
+                return list(cached)
+            # The cached prefix no longer lines up with stored segments, reload everything
+            contents = []
+            chain = _segment_chain(segments)
+
+        # Segments are independent objects, download them concurrently
+        try:
+            for segment_contents in map_concurrently(lambda blob: decode_contents(blob.download_as_bytes()),
+                                                     [blob for _, _, blob in chain]):
+                contents.extend(segment_contents)
+            break
+        except NotFound:
+            if attempt:
+                raise
+            # A concurrent compaction deleted a listed segment, the merged one covers it
+            print(f"Chat history segment of {prefix} vanished while loading, listing again")
+
+    _cache_set(key, contents, len(segments))
+    return list(contents)
+
+
+def load_summary(user_id: str, chat_history_id: str) -> Optional[dict]:
+    """Load the stored rolling summary of a chat ({'folded': turns folded, 'summary': text})."""
+    blob = _get_bucket().blob(f"{_history_prefix(user_id, chat_history_id)}summary.json")
+    try:
+        return json.loads(blob.download_as_bytes())
+    except NotFound:
+        return None
+
+
+def save_summary(user_id: str, chat_history_id: str, summary: dict):
+    """Store the rolling summary of a chat next to its history segments."""
+    blob = _get_bucket().blob(f"{_history_prefix(user_id, chat_history_id)}summary.json")
+    blob.upload_from_string(json.dumps(summary, ensure_ascii=False), content_type='application/json')
+
+
+def _stored_length(bucket, key, prefix: str) -> int:
+    cached, _ = _cache_get(key)
+    if cached is not None:
+        return len(cached)
+    segments = _list_segments(bucket, prefix)
+    return max((end for _, end, _ in segments), default=0)
+
+
+def append_history(user_id: str, chat_history_id: str, chat_history, stored_length: Optional[int] = None):
+    """Append turns of chat_history beyond what is already stored as a new segment.
+
+    stored_length is the number of turns chat_history was loaded with. When a concurrent
+    request appended first, this request's turns are appended after the ones it stored.
+    """
+    key = (user_id, chat_history_id)
+    bucket = _get_bucket()
+    prefix = _history_prefix(user_id, chat_history_id)
+    if stored_length is None:
+        stored_length = _stored_length(bucket, key, prefix)
+    new_contents = list(chat_history)[stored_length:]
+    if not new_contents:
+        return
+
+    start = stored_length
+    for attempt in range(2):
+        end = start + len(new_contents)
+        blob = bucket.blob(_segment_name(prefix, start, end, CHAT_HISTORY_COMPRESSION))
+        try:
+            # Segments are immutable, never overwrite one written by a concurrent request
+            blob.upload_from_string(
+                encode_contents(new_contents),
+                content_type='application/octet-stream',
+                if_generation_match=0
+            )
+            break
+        except PreconditionFailed:
+            print(f"Chat history segment {blob.name} already exists, reloading")
+            _cache_pop(key)
+            start = len(load_history(user_id, chat_history_id))
+    else:
+        return
+
+    cached, segment_count = _cache_get(key)
+    if cached is not None and len(cached) == start:
+        _cache_set(key, cached + new_contents, segment_count + 1)
+        if segment_count + 1 > CHAT_HISTORY_COMPACT_THRESHOLD:
+            compact_history(user_id, chat_history_id)
+    else:
+        _cache_pop(key)
+
+
+def compact_history(user_id: str, chat_history_id: str, threshold: int = CHAT_HISTORY_COMPACT_THRESHOLD):
+    """Merge a chat's segments into one once there are more than threshold of them.
+
+    The segments the merged one covers are deleted once it is written; loads that listed
+    them just before retry with a fresh listing.
+    """
+    key = (user_id, chat_history_id)
+    bucket = _get_bucket()
+    prefix = _history_prefix(user_id, chat_history_id)
+    segments = _list_segments(bucket, prefix)
+    chain = _segment_chain(segments)
+    if len(segments) <= threshold or not chain:
+        cached, _ = _cache_get(key)
+        if cached is not None:
+            _cache_set(key, cached, len(segments))
+        return
+
+    contents, _ = _cache_get(key)
+    end = chain[-1][1]
+    if contents is None or len(contents) < end:
+        contents = load_history(user_id, chat_history_id)
+
+    merged_name = _segment_name(prefix, 0, end, CHAT_HISTORY_COMPRESSION)
+    remaining = len(segments)
+    if len(chain) > 1:
+        try:
+            bucket.blob(merged_name).upload_from_string(
+                encode_contents(contents[:end]),
+                content_type='application/octet-stream',
+                if_generation_match=0
+            )
+        except PreconditionFailed:
+            # A concurrent request compacted the same turns and deletes what they cover
+            return
+        remaining += 1
+
+    for start, segment_end, blob in segments:
+        if segment_end <= end and blob.name != merged_name:
+            try:
+                blob.delete()
+                remaining -= 1
+            except NotFound:
+                remaining -= 1
+            except Exception as e:
+                print(f"Unable to delete compacted segment {blob.name}: {e}")
+
+    cached, _ = _cache_get(key)
+    if cached is not None:
+        _cache_set(key, cached, remaining)
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import vertexai
+import vertexai.preview.generative_models as generative_models
+from vertexai.generative_models import GenerationConfig, GenerativeModel, ToolConfig
+
+# Configured model instances kept per process
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", 16))
+
+# Cache of GenerativeModel instances, in least recently used order
+model_cache = OrderedDict()
+model_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+}
+_model_cache_lock = threading.Lock()
+
+_vertexai_initialized = set()
+_vertexai_lock = threading.Lock()
+
+DEFAULT_SAFETY_SETTINGS = {
+    generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_NONE,
+    generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
+    generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_NONE,
+    generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
+}
+
+FUNCTION_CALLING_TOOL_CONFIG = ToolConfig(
+    function_calling_config=ToolConfig.FunctionCallingConfig(
+        mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
+        allowed_function_names=["get_diabetes_data_output"],
+    ))
+
+
+def init_vertexai(project_id: Optional[str] = os.getenv("GOOGLE_CLOUD_PROJECT"), location: str = "us-central1"):
+    """Initialize Vertex AI once per process for each project and location."""
+    key = (project_id, location)
+    if key in _vertexai_initialized:
+        return
+    with _vertexai_lock:
+        if key not in _vertexai_initialized:
+            vertexai.init(project=project_id, location=location)
+            _vertexai_initialized.add(key)
+
+
+def _hash(value) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16] if value else ""
+
+
+def _tools_key(tools: List[Any], tools_version) -> str:
+    """Key for a tool list: the prompt bundle version when known, otherwise a hash of the tools."""
+    if not tools:
+        return ""
+    if tools_version is not None:
+        return f"v:{tools_version}"
+    return _hash(json.dumps([tool.to_dict() for tool in tools], sort_keys=True, default=str))
+
+
+def get_model(
+    model_name: str,
+    system_instruction: Optional[str] = None,
+    tools: List[Any] = None,
+    tools_version=None,
+    temperature: float = 0.2,
+    safety_settings: Optional[Dict[str, Any]] = None
+) -> GenerativeModel:
+    """Get a configured GenerativeModel, reusing instances across requests.
+
+    Instances are keyed by model name, system instruction hash, tool bundle version and
+    generation config. Requests with custom safety settings are not cached.
+    """
+    tool_config = FUNCTION_CALLING_TOOL_CONFIG if tools else None
+
+    def build():
+        return GenerativeModel(
+            model_name,
+            system_instruction=None if not system_instruction else [system_instruction],
+            generation_config=GenerationConfig(
+                temperature=temperature,
+            ),
+            safety_settings=safety_settings or DEFAULT_SAFETY_SETTINGS,
+            tools=tools or None,
+            tool_config=tool_config
+        )
+
+    if safety_settings:
+        return build()
+
+    key = (model_name, _hash(system_instruction), _tools_key(tools, tools_version), temperature)
+    with _model_cache_lock:
+        model = model_cache.get(key)
+        if model is not None:
+            model_cache.move_to_end(key)
+            model_cache_stats['hits'] += 1
+            return model
+        model_cache_stats['misses'] += 1
+
+    model = build()
+    with _model_cache_lock:
+        model_cache[key] = model
+        model_cache.move_to_end(key)
+        while len(model_cache) > MODEL_CACHE_SIZE:
+            model_cache.popitem(last=False)
+            model_cache_stats['evictions'] += 1
+    return model
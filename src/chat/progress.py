@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+from typing import Optional
+from uuid import uuid4
+
+from src.clients.utils import get_firestore_client
+from src.metrics.utils import traced
+
+# Minimum seconds between progress writes to a chat document (Firestore sustains ~1 write/s per document)
+PROGRESS_WRITE_INTERVAL = float(os.getenv("PROGRESS_WRITE_INTERVAL", 1.0))
+
+
+def get_chat_ref(db, user_id: str, chat_history_id: str):
+    return db.collection('users').document(user_id).collection('chats').document(chat_history_id)
+
+
+@traced("firestore_write")
+def write_chat_answer(user_id: str, chat_history_id: str, output_text: str, db=None):
+    """Write the answer message and update the chat in a single batched commit."""
+    from google.cloud import firestore
+
+    db = db or get_firestore_client()
+    chat_ref = get_chat_ref(db, user_id, chat_history_id)
+    messages_ref = chat_ref.collection('messages')
+
+    answer_id = str(uuid4())
+    batch = db.batch()
+    batch.set(messages_ref.document(answer_id), {
+        'id': answer_id,
+        'content': output_text,
+        'type': 'answer',
+        'status': 'completed',
+        'timestamp': firestore.SERVER_TIMESTAMP
+    })
+    batch.set(chat_ref, {
+        'lastMessage': output_text,
+        'status': 'completed',
+        'progress': firestore.DELETE_FIELD,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    }, merge=True)
+    batch.commit()
+
+
+class ChatProgressWriter:
+    """Publishes in-flight progress for a chat to its Firestore document.
+
+    Calls to publish are coalesced: at most one write per PROGRESS_WRITE_INTERVAL, always
+    carrying the latest state, with a trailing write for updates that arrive in between.
+    Writes are serialized, so a progress write still in flight never lands after complete's.
+    Use it as the progress callback of generate_text.
+    """
+
+    def __init__(self, user_id: str, chat_history_id: Optional[str] = None, db=None,
+                 min_interval: float = PROGRESS_WRITE_INTERVAL):
+        self.user_id = user_id
+        self.chat_history_id = chat_history_id
+        self.db = db
+        self.min_interval = min_interval
+        self.writes = 0
+        self.published = 0
+        self._state = {'status': 'queued', 'queries': []}
+        self._dirty = False
+        self._last_write = 0
+        self._timer = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def __call__(self, status: str, **fields):
+        self.publish(status, **fields)
+
+    def publish(self, status: str, chat_history_id: Optional[str] = None, query: Optional[str] = None,
+                partial_summary: Optional[str] = None):
+        with self._lock:
+            if self._closed:
+                return
+            self.published += 1
+            if chat_history_id:
+                self.chat_history_id = chat_history_id
+            self._state['status'] = status
+            if query and query not in self._state['queries']:
+                self._state['queries'].append(query)
+            if partial_summary is not None:
+                self._state['partialSummary'] = partial_summary
+            self._dirty = True
+
+            delay = self._last_write + self.min_interval - time.monotonic()
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Write the latest state if it changed since the last write."""
+        with self._write_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            if not self._dirty or not self.chat_history_id or self._closed:
+                return
+            state = {**self._state, 'queries': list(self._state['queries'])}
+            self._dirty = False
+            self._last_write = time.monotonic()
+
+        try:
+            from google.cloud import firestore
+
+            db = self.db or get_firestore_client()
+            get_chat_ref(db, self.user_id, self.chat_history_id).set({
+                'status': 'processing',
+                'progress': {**state, 'updatedAt': firestore.SERVER_TIMESTAMP},
+            }, merge=True)
+            self.writes += 1
+        except Exception as e:
+            print(f"Unable to publish chat progress: {e}")
+
+    def complete(self, output_text: str, chat_history_id: Optional[str] = None):
+        """Stop publishing progress and commit the final answer and chat update together."""
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if chat_history_id:
+                self.chat_history_id = chat_history_id
+        # Waits for a progress write in flight, which would otherwise overwrite the completed status
+        with self._write_lock:
+            write_chat_answer(self.user_id, self.chat_history_id, output_text, db=self.db)
+            self.writes += 1
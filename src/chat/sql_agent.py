@@ -1,25 +1,122 @@
 import os
-import vertexai
+import threading
+import time
 
 from langchain.agents import create_sql_agent
 from langchain.agents.agent_toolkits import SQLDatabaseToolkit
 from langchain.sql_database import SQLDatabase
 from langchain_google_vertexai import VertexAI
 from langchain_google_vertexai.model_garden import ChatAnthropicVertex
-from typing import Optional
+from sqlalchemy import text
+from typing import Iterable, List, Optional
+
+from src.chat.models import init_vertexai
+from src.chat.sql_cache import is_cacheable_sql, make_cache_key, sql_result_cache
+from src.chat.sql_results import SQL_RESULT_MAX_ROWS, fetch_compact_result
+
+# Cache for reflected databases and agent executors, keyed by SQLAlchemy url
+sql_database_cache = {}
+sql_agent_cache = {}
+SQL_SCHEMA_CACHE_DURATION = int(os.getenv("SQL_SCHEMA_CACHE_DURATION", 6 * 3600))  # 6 hours
+SQL_TABLE_VERSION_CACHE_DURATION = int(os.getenv("SQL_TABLE_VERSION_CACHE_DURATION", 60))  # 1 minute
+_sql_cache_lock = threading.Lock()
+
+# Model behind the SQL fast path and agent
+SQL_AGENT_MODEL = "claude-3-5-sonnet@20240620"
+
+# Row limit the agent is told to put on queries unless the question asks for more; larger
+# results are compacted before they reach the LLM either way
+SQL_AGENT_TOP_K = int(os.getenv("SQL_AGENT_TOP_K", SQL_RESULT_MAX_ROWS))
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """SQLDatabase that memoizes table info strings (schema and sample rows)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._table_info_cache = {}
+        self._table_version = None
+        self._table_version_fetched_at = 0
+
+    @property
+    def dataset_key(self) -> str:
+        return self._engine.url.render_as_string(hide_password=True)
+
+    def get_table_version(self) -> str:
+        """Version of the dataset's tables, so cached results go stale when a table is modified.
+
+        BigQuery exposes last modification times in __TABLES__; other dialects (e.g. SQLite
+        used locally) are treated as static.
+        """
+        if self.dialect != "bigquery":
+            return "static"
+
+        if time.time() - self._table_version_fetched_at > SQL_TABLE_VERSION_CACHE_DURATION:
+            try:
+                with self._engine.connect() as connection:
+                    rows = connection.execute(text(
+                        f"SELECT table_id, last_modified_time FROM `{self._schema}.__TABLES__`"
+                        if self._schema else "SELECT table_id, last_modified_time FROM __TABLES__"
+                    )).fetchall()
+                self._table_version = str(sorted(tuple(row) for row in rows))
+            except Exception as e:
+                print(f"Unable to fetch table versions: {e}")
+                self._table_version = str(time.time() // SQL_TABLE_VERSION_CACHE_DURATION)
+            self._table_version_fetched_at = time.time()
+        return self._table_version
+
+    def run(self, command, fetch="all", include_columns=False, **kwargs):
+        """Run a query, serving read-only statements from the SQL result cache.
+
+        Full fetches are streamed in bounded batches and large results are compacted (schema,
+        row count, aggregates, head/tail sample) before they reach the LLM.
+        """
+        if not isinstance(command, str) or kwargs.get("parameters") or not is_cacheable_sql(command):
+            return super().run(command, fetch, include_columns, **kwargs)
+
+        def compute():
+            if fetch == "all" and not include_columns:
+                return fetch_compact_result(self, command)
+            return super(CachedSQLDatabase, self).run(command, fetch, include_columns, **kwargs)
+
+        key = make_cache_key(f"{fetch}:{include_columns}:{command}", self.dataset_key, self.get_table_version())
+        return sql_result_cache.get_or_compute(key, compute)
+
+    def get_table_info(self, table_names: Optional[List[str]] = None) -> str:
+        cache_key = frozenset(table_names) if table_names else None
+        if cache_key not in self._table_info_cache:
+            self._table_info_cache[cache_key] = super().get_table_info(table_names)
+        return self._table_info_cache[cache_key]
+
+    def warm(self):
+        """Pre-compute table info for every usable table."""
+        for table_name in self.get_usable_table_names():
+            self.get_table_info([table_name])
+        self.get_table_info()
+
+
+def get_sqlalchemy_url(dataset_id: Optional[str] = None) -> str:
+    """Get the SQLAlchemy url for the dataset (SQLALCHEMY_DATABASE_URL overrides, e.g. sqlite)."""
+    override_url = os.getenv("SQLALCHEMY_DATABASE_URL")
+    if override_url:
+        return override_url
+
+    project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
+    dataset_id = dataset_id or os.getenv("BIGQUERY_DATASET")
+    return f'bigquery://{project_id}/{dataset_id}'
 
 
 def get_langchain_llm(
     project_id: Optional[str] = os.getenv("GOOGLE_CLOUD_PROJECT"),
     location: Optional[str] = "us-central1",
-    model_name: str = "claude-3-5-sonnet@20240620",
+    model_name: str = SQL_AGENT_MODEL,
     max_output_tokens: int = 4096,
     temperature: float = 0.2,
     top_p: float = 0.8,
     top_k: int = 40
 ):
     """Get LangChain LLM."""
-    vertexai.init(project=project_id, location=location)
+    init_vertexai(project_id, location)
 
     if model_name.lower().startswith('claude'):
         llm = ChatAnthropicVertex(
@@ -40,24 +137,73 @@ def get_langchain_llm(
     return llm
 
 
-def create_database_sql_agent():
-    """Create Database SQL Agent."""
+def _is_fresh(entry) -> bool:
+    return entry is not None and time.time() - entry['fetched_at'] <= SQL_SCHEMA_CACHE_DURATION
 
-    # TODO: Remove hardcoding of sqlalchemy_url
-    project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
-    dataset_id = os.getenv("BIGQUERY_DATASET")
-    sqlalchemy_url = f'bigquery://{project_id}/{dataset_id}'
-    db = SQLDatabase.from_uri(sqlalchemy_url)
+
+def get_sql_database(sqlalchemy_url: Optional[str] = None) -> CachedSQLDatabase:
+    """Get the reflected database for the url, reflecting at most once per TTL."""
+    sqlalchemy_url = sqlalchemy_url or get_sqlalchemy_url()
+
+    entry = sql_database_cache.get(sqlalchemy_url)
+    if _is_fresh(entry):
+        return entry['db']
+
+    with _sql_cache_lock:
+        entry = sql_database_cache.get(sqlalchemy_url)
+        if not _is_fresh(entry):
+            entry = {
+                'db': CachedSQLDatabase.from_uri(sqlalchemy_url),
+                'fetched_at': time.time()
+            }
+            sql_database_cache[sqlalchemy_url] = entry
+            sql_agent_cache.pop(sqlalchemy_url, None)
+    return entry['db']
+
+
+def invalidate_sql_cache(sqlalchemy_url: Optional[str] = None):
+    """Drop cached schema and agents for the url, or for every url when omitted."""
+    with _sql_cache_lock:
+        if sqlalchemy_url:
+            sql_database_cache.pop(sqlalchemy_url, None)
+            sql_agent_cache.pop(sqlalchemy_url, None)
+        else:
+            sql_database_cache.clear()
+            sql_agent_cache.clear()
+
+
+def create_database_sql_agent(sqlalchemy_url: Optional[str] = None, llm=None):
+    """Create Database SQL Agent (reused per worker while the schema cache is fresh)."""
+    sqlalchemy_url = sqlalchemy_url or get_sqlalchemy_url()
+    db = get_sql_database(sqlalchemy_url)
+
+    entry = sql_agent_cache.get(sqlalchemy_url)
+    if llm is None and entry is not None and entry['db'] is db:
+        return entry['agent_executor']
 
     # TODO: Remove hardcoding of langchain llm
-    llm = get_langchain_llm()
+    custom_llm = llm is not None
+    llm = llm or get_langchain_llm()
 
     toolkit = SQLDatabaseToolkit(db=db, llm=llm)
     agent_executor = create_sql_agent(
         llm=llm,
         toolkit=toolkit,
         verbose=False,
-        top_k=100000,
+        top_k=SQL_AGENT_TOP_K,
         agent_executor_kwargs={"return_intermediate_steps": True}
     )
+
+    if not custom_llm:
+        sql_agent_cache[sqlalchemy_url] = {'db': db, 'agent_executor': agent_executor}
     return agent_executor
+
+
+def warm_sql_agent(sqlalchemy_urls: Optional[Iterable[str]] = None):
+    """Reflect schemas, cache table info and build agent executors ahead of the first request."""
+    for sqlalchemy_url in sqlalchemy_urls or [get_sqlalchemy_url()]:
+        try:
+            get_sql_database(sqlalchemy_url).warm()
+            create_database_sql_agent(sqlalchemy_url)
+        except Exception as e:
+            print(f"SQL agent warmup failed for {sqlalchemy_url}: {e}")
@@ -0,0 +1,156 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from src.clients.utils import get_storage_client
+
+# Total bytes of query results kept in memory
+SQL_RESULT_CACHE_MAX_BYTES = int(os.getenv("SQL_RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # 64 MB
+
+# Optional shared backend for results: "" (in-process only) or "gcs"
+SQL_RESULT_CACHE_BACKEND = os.getenv("SQL_RESULT_CACHE_BACKEND", "")
+
+_QUOTED_OR_SPACE = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)|\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """Normalize SQL for cache keys: collapse whitespace outside quotes and drop a trailing semicolon."""
+    normalized = _QUOTED_OR_SPACE.sub(lambda m: m.group(1) or " ", sql).strip()
+    return normalized.rstrip(";").strip()
+
+
+def is_cacheable_sql(sql: str) -> bool:
+    """Only read-only statements are cached."""
+    return normalize_sql(sql).lower().startswith(("select", "with"))
+
+
+def make_cache_key(sql: str, dataset: str, version: str) -> str:
+    return hashlib.sha256(f"{dataset}\0{version}\0{normalize_sql(sql)}".encode("utf-8")).hexdigest()
+
+
+def _is_cacheable(value) -> bool:
+    """Only text results are cached, unless they opt out (e.g. text holding an expiring link)."""
+    return isinstance(value, str) and getattr(value, "cacheable", True)
+
+
+class GCSResultStore:
+    """Shared result store in Google Cloud Storage, so instances can reuse each other's results."""
+
+    def __init__(self, bucket_name: Optional[str] = None, prefix: str = "cache/sql/"):
+        self.bucket_name = bucket_name or os.getenv("GOOGLE_CLOUD_BUCKET")
+        self.prefix = prefix
+
+    def _blob(self, key: str):
+        return get_storage_client().bucket(self.bucket_name).blob(f"{self.prefix}{key}.txt")
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return self._blob(key).download_as_text()
+        except Exception:
+            return None
+
+    def set(self, key: str, value: str):
+        try:
+            self._blob(key).upload_from_string(value, content_type='text/plain')
+        except Exception as e:
+            print(f"Unable to write shared SQL result cache entry: {e}")
+
+
+class ResultCache:
+    """LRU of query results bounded by total bytes, with single-flight execution.
+
+    Concurrent misses for the same key wait for one execution instead of each running the query.
+    """
+
+    def __init__(self, max_bytes: int = SQL_RESULT_CACHE_MAX_BYTES, shared_store=None):
+        self.max_bytes = max_bytes
+        self.shared_store = shared_store
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'collapsed': 0,
+        }
+
+    def _get_local(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _set_local(self, key, value: str):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key).encode("utf-8"))
+        self._entries[key] = value
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.encode("utf-8"))
+            self._stats['evictions'] += 1
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        with self._lock:
+            value = self._get_local(key)
+            if value is not None:
+                self._stats['hits'] += 1
+                return value
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._stats['collapsed'] += 1
+                owner = False
+            else:
+                future = Future()
+                self._in_flight[key] = future
+                owner = True
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = self.shared_store.get(key) if self.shared_store else None
+            if value is not None:
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+            else:
+                with self._lock:
+                    self._stats['misses'] += 1
+                value = compute()
+                if self.shared_store and _is_cacheable(value):
+                    self.shared_store.set(key, value)
+
+            if _is_cacheable(value):
+                with self._lock:
+                    self._set_local(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+sql_result_cache = ResultCache(shared_store=GCSResultStore() if SQL_RESULT_CACHE_BACKEND == "gcs" else None)
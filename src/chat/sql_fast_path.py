@@ -0,0 +1,310 @@
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from src.chat.sql_agent import SQL_AGENT_MODEL, create_database_sql_agent, get_langchain_llm, get_sql_database
+import src.llm.utils as llm_utils
+from src.metrics.utils import METRICS_ENABLED, observe, span, traced
+
+# Try a single generation call before falling back to the ReAct agent
+SQL_FAST_PATH_ENABLED = os.getenv("SQL_FAST_PATH_ENABLED", "true").lower() == "true"
+
+# Gemini model the fast path and agent fail over to when Claude times out, fails or its circuit is open
+SQL_FALLBACK_MODEL = os.getenv("SQL_FALLBACK_MODEL", "gemini-1.5-pro-001")
+
+# Seconds allowed for one agent run (several model calls and queries)
+SQL_AGENT_TIMEOUT = float(os.getenv("SQL_AGENT_TIMEOUT", 180))
+
+FAST_PATH_PROMPT = (
+    "You are an expert {dialect} SQL analyst. Using only the tables and columns in the schema below,"
+    " write one read-only {dialect} query that answers the question. Return only the query in a"
+    " ```sql code block. If one query cannot answer the question, return CANNOT_ANSWER.\n\n"
+    "Schema:\n{table_info}\n\n{instructions}\n\nQuestion: {question}"
+)
+
+# Statement keywords; followed by "(" they are functions such as REPLACE(s, a, b) or TRUNCATE(x, 2)
+FORBIDDEN_KEYWORDS = re.compile(
+    r"\b(insert|update|delete|drop|alter|create|merge|truncate|grant|revoke|replace)\b(?!\s*\()", re.IGNORECASE)
+# Functions whose arguments use FROM, e.g. EXTRACT(YEAR FROM col) or TRIM(' ' FROM col)
+FROM_FUNCTIONS = re.compile(r"\b(?:extract|trim|substring|overlay|position)\s*\(", re.IGNORECASE)
+TABLE_REFERENCE = re.compile(r"\b(?:from|join)\s+([`\"\[]?[\w.\-]+[`\"\]]?)(?:\s+(?:as\s+)?(\w+))?", re.IGNORECASE)
+CTE_NAME = re.compile(r"(?:\bwith|,)\s*(\w+)\s+as\s*\(", re.IGNORECASE)
+QUALIFIED_COLUMN = re.compile(r"\b(\w+)\.(\w+)\b")
+STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'")
+QUOTED_IDENTIFIER = re.compile(r"`[^`]*`|\"[^\"]*\"|\[[^\]]*\]")
+IDENTIFIER = re.compile(r"(?<![\w.])([a-z_]\w*)\b(?!\s*[.(])", re.IGNORECASE)
+OUTPUT_ALIAS = re.compile(r"(?:\bas|\))\s+(?!as\b)([a-z_]\w*)", re.IGNORECASE)
+SQL_BLOCK = re.compile(r"```(?:sql)?\s*(.*?)```", re.IGNORECASE | re.DOTALL)
+ALIAS_STOPWORDS = {
+    "where", "join", "inner", "left", "right", "full", "cross", "on", "group", "order", "limit",
+    "union", "having", "qualify", "window", "using", "natural", "outer", "except", "intersect",
+}
+# Words besides column names that may appear unqualified and unquoted in a read-only query
+SQL_WORDS = ALIAS_STOPWORDS | {
+    "select", "from", "with", "recursive", "as", "distinct", "all", "any", "some", "and", "or", "not",
+    "in", "is", "null", "true", "false", "like", "ilike", "similar", "escape", "between", "exists",
+    "case", "when", "then", "else", "end", "by", "asc", "desc", "nulls", "first", "last", "offset",
+    "fetch", "next", "only", "top", "percent", "over", "partition", "rows", "range", "groups",
+    "preceding", "following", "current", "row", "unbounded", "filter", "within", "ignore", "respect",
+    "lateral", "tablesample", "system", "interval", "at", "time", "zone", "for", "to", "collate",
+    "current_date", "current_time", "current_timestamp", "localtime", "localtimestamp",
+    # Date parts
+    "year", "quarter", "month", "week", "isoweek", "isoyear", "day", "dayofweek", "dayofyear", "dow",
+    "doy", "epoch", "hour", "minute", "second", "millisecond", "microsecond",
+    # Types, as in CAST(x AS INT64) or DATE '2024-01-01'
+    "int", "integer", "smallint", "bigint", "int64", "float", "float64", "double", "precision", "real",
+    "numeric", "decimal", "bignumeric", "string", "text", "varchar", "char", "bool", "boolean", "date",
+    "datetime", "timestamp", "bytes", "json",
+}
+
+
+class SQLValidationError(Exception):
+    """Raised when generated SQL fails local validation."""
+
+
+class AgentCancelled(Exception):
+    """Raised inside an agent run that was abandoned (timed out or superseded by a fallback)."""
+
+
+class CancelCallback(BaseCallbackHandler):
+    """Stops an agent run at its next model call or tool call once cancelled is set.
+
+    Must come first in the callbacks, so an abandoned run reports nothing to the handlers after it.
+    """
+
+    raise_error = True
+
+    def __init__(self, cancelled: threading.Event):
+        self.cancelled = cancelled
+
+    def _check(self, *args, **kwargs):
+        if self.cancelled.is_set():
+            raise AgentCancelled("Agent run was abandoned")
+
+    on_llm_start = on_chat_model_start = on_tool_start = on_agent_action = _check
+
+
+class LLMCallCounter(BaseCallbackHandler):
+    """Counts and times LLM calls made while running a chain or agent (hedged calls run concurrently)."""
+
+    def __init__(self):
+        self.count = 0
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def on_llm_start(self, *args, run_id=None, **kwargs):
+        with self._lock:
+            self.count += 1
+        self._started[run_id] = time.perf_counter()
+
+    on_chat_model_start = on_llm_start
+
+    def on_llm_end(self, *args, run_id=None, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is not None and METRICS_ENABLED:
+            observe("agent_llm_call", time.perf_counter() - started)
+
+
+class ProgressCallback(BaseCallbackHandler):
+    """Reports each query the agent runs to a progress callback."""
+
+    def __init__(self, progress):
+        self.progress = progress
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        if (serialized or {}).get('name') == 'sql_db_query':
+            self.progress('query', query=input_str)
+            self.progress('executing')
+
+
+def extract_sql(text: str) -> Optional[str]:
+    """Extract the SQL statement from a model response."""
+    if "CANNOT_ANSWER" in text:
+        return None
+    match = SQL_BLOCK.search(text)
+    sql = (match.group(1) if match else text).strip()
+    return sql.rstrip(";").strip() or None
+
+
+def get_schema_columns(db) -> Dict[str, Set[str]]:
+    """Map each usable table name (lower case) to its column names."""
+    columns = {}
+    usable_tables = {name.lower() for name in db.get_usable_table_names()}
+    for table in db._metadata.sorted_tables:
+        if table.name.lower() in usable_tables:
+            columns[table.name.lower()] = {column.name.lower() for column in table.columns}
+    return columns
+
+
+def _mask_function_from(body: str) -> str:
+    """Replace FROM inside EXTRACT(... FROM col) and similar calls so it is not read as a table reference."""
+    masked = list(body)
+    for match in FROM_FUNCTIONS.finditer(body):
+        depth = 0
+        for index in range(match.end() - 1, len(body)):
+            if body[index] == "(":
+                depth += 1
+            elif body[index] == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+            elif depth == 1 and body[index:index + 4].lower() == "from" and \
+                    re.match(r"\W", body[index - 1]) and re.match(r"\W", body[index + 4:index + 5] or " "):
+                masked[index:index + 4] = ",   "
+    return "".join(masked)
+
+
+def validate_sql(sql: str, schema_columns: Dict[str, Set[str]]):
+    """Check the SQL is a single read-only query over known tables and columns.
+
+    Qualified columns are checked against their table; unqualified ones must belong to one of
+    the referenced tables or be an alias, CTE name or SQL word.
+    """
+    body = _mask_function_from(STRING_LITERAL.sub("''", sql))
+    if ";" in body:
+        raise SQLValidationError("Only a single statement is allowed")
+    if not body.lstrip().lower().startswith(("select", "with")):
+        raise SQLValidationError("Only SELECT queries are allowed")
+    if FORBIDDEN_KEYWORDS.search(body):
+        raise SQLValidationError("Only read-only queries are allowed")
+
+    cte_names = {name.lower() for name in CTE_NAME.findall(body)}
+    aliases = {}
+    for reference, alias in TABLE_REFERENCE.findall(body):
+        table_name = reference.strip("`\"[]").split(".")[-1].lower()
+        if table_name in cte_names:
+            continue
+        if table_name not in schema_columns:
+            raise SQLValidationError(f"Unknown table: {table_name}")
+        aliases[table_name] = table_name
+        if alias and alias.lower() not in ALIAS_STOPWORDS:
+            aliases[alias.lower()] = table_name
+
+    for qualifier, column in QUALIFIED_COLUMN.findall(body):
+        table_name = aliases.get(qualifier.lower())
+        if table_name and column.lower() not in schema_columns[table_name]:
+            raise SQLValidationError(f"Unknown column: {table_name}.{column}")
+
+    known = set(aliases) | cte_names | SQL_WORDS
+    known.update(alias.lower() for alias in OUTPUT_ALIAS.findall(body))
+    for table_name in set(aliases.values()):
+        known.update(schema_columns[table_name])
+    for identifier in IDENTIFIER.findall(QUOTED_IDENTIFIER.sub("''", body)):
+        if identifier.lower() not in known:
+            raise SQLValidationError(f"Unknown column: {identifier}")
+
+
+def _response_text(response) -> str:
+    return response if isinstance(response, str) else getattr(response, "content", str(response))
+
+
+@traced("sql_fast_path")
+def run_fast_path(question: str, system_instruction: Optional[str] = None, llm=None, db=None,
+                  progress=None, counter: Optional[LLMCallCounter] = None) -> dict:
+    """Generate SQL in one call from the cached schema, validate it locally and execute it.
+
+    The default model fails over to SQL_FALLBACK_MODEL; a given llm is used alone. Model calls,
+    hedges and fallbacks included, are counted on counter, which outlives a failed run.
+    """
+    counter = counter or LLMCallCounter()
+    db = db or get_sql_database()
+    prompt = FAST_PATH_PROMPT.format(
+        dialect=db.dialect,
+        table_info=db.get_table_info(),
+        instructions=system_instruction or "",
+        question=question,
+    )
+
+    def generate(model_llm):
+        return model_llm.invoke(prompt, config={'callbacks': [counter]})
+
+    if llm is not None:
+        candidates = [(getattr(llm, "model_name", None) or type(llm).__name__, lambda: generate(llm))]
+    else:
+        candidates = [
+            (SQL_AGENT_MODEL, lambda: generate(get_langchain_llm())),
+            (SQL_FALLBACK_MODEL, lambda: generate(get_langchain_llm(model_name=SQL_FALLBACK_MODEL))),
+        ]
+    with span("sql_generate"):
+        sql = extract_sql(_response_text(llm_utils.call_with_fallback(candidates, hedge=True)))
+    if not sql:
+        raise SQLValidationError("Model could not answer with a single query")
+
+    validate_sql(sql, get_schema_columns(db))
+    if progress:
+        progress('query', query=sql)
+        progress('executing')
+    result = db.run(sql)
+    return {
+        'output_answer': f"Result of the query:\n{result}",
+        'queries': [f"Query 1:\n{sql}"],
+        'sql_path': 'fast',
+        'llm_calls': counter.count,
+    }
+
+
+@traced("sql_agent")
+def run_agent(question: str, system_instruction: Optional[str] = None, progress=None) -> dict:
+    """Answer the question with the SQL agent executor, failing over to an agent on SQL_FALLBACK_MODEL.
+
+    A run that timed out keeps its thread until it returns; it is cancelled at its next model or
+    tool call when the fallback starts (or the answer is returned), so it stops querying and no
+    longer reports progress or counts calls.
+    """
+    counter = LLMCallCounter()
+    runs: List[threading.Event] = []
+
+    def invoke(create_agent):
+        for cancelled in runs:
+            cancelled.set()
+        cancelled = threading.Event()
+        runs.append(cancelled)
+        callbacks = [CancelCallback(cancelled), counter] + ([ProgressCallback(progress)] if progress else [])
+        return create_agent().invoke(f"{system_instruction}\n{question}", config={'callbacks': callbacks})
+
+    try:
+        output = llm_utils.call_with_fallback([
+            (f"agent:{SQL_AGENT_MODEL}", lambda: invoke(create_database_sql_agent)),
+            (f"agent:{SQL_FALLBACK_MODEL}", lambda: invoke(
+                lambda: create_database_sql_agent(llm=get_langchain_llm(model_name=SQL_FALLBACK_MODEL)))),
+        ], timeout=SQL_AGENT_TIMEOUT)
+    finally:
+        for cancelled in runs:
+            cancelled.set()
+    intermediate_steps = []
+    for index, step in enumerate(output['intermediate_steps'][1:]):
+        intermediate_step = step[0].to_json()['kwargs']['tool_input']
+        if intermediate_step not in intermediate_steps:
+            intermediate_steps.append(intermediate_step)
+
+    intermediate_steps = [f"Query {index + 1}:\n" + intermediate_step
+                          for index, intermediate_step in enumerate(intermediate_steps)]
+
+    return {
+        'output_answer': output['output'],
+        'queries': intermediate_steps,
+        'sql_path': 'agent',
+        'llm_calls': counter.count,
+    }
+
+
+def answer_question(question: str, system_instruction: Optional[str] = None, progress=None) -> dict:
+    """Answer with the single-shot fast path, falling back to the agent on validation or execution errors."""
+    fast_path_calls = LLMCallCounter()
+    if SQL_FAST_PATH_ENABLED:
+        try:
+            return run_fast_path(question, system_instruction, progress=progress, counter=fast_path_calls)
+        except SQLValidationError as e:
+            print(f"SQL fast path rejected, falling back to agent: {e}")
+        except Exception as e:
+            print(f"SQL fast path failed, falling back to agent: {e}")
+
+    result = run_agent(question, system_instruction, progress=progress)
+    result['llm_calls'] += fast_path_calls.count
+    if SQL_FAST_PATH_ENABLED:
+        result['sql_path'] = 'agent_fallback'
+    return result
@@ -0,0 +1,293 @@
+import csv
+import os
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from decimal import Decimal
+from numbers import Number
+from typing import Iterable, List, Optional, Sequence
+from uuid import uuid4
+
+import google.auth
+import google.auth.transport.requests
+from google.auth.credentials import Signing
+from langchain_community.utilities.sql_database import truncate_word
+from sqlalchemy import text
+
+from src.clients.utils import get_bigquery_client, get_bigquery_storage_client, get_storage_client
+from src.metrics.utils import traced
+
+try:
+    import pyarrow  # noqa: F401 (required by the BigQuery Storage read API)
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Results up to these sizes are passed to the LLM verbatim
+SQL_RESULT_MAX_ROWS = int(os.getenv("SQL_RESULT_MAX_ROWS", 200))
+SQL_RESULT_MAX_BYTES = int(os.getenv("SQL_RESULT_MAX_BYTES", 16 * 1024))  # 16 KB
+
+# Larger results are summarized with this many head and tail rows
+SQL_RESULT_SAMPLE_ROWS = int(os.getenv("SQL_RESULT_SAMPLE_ROWS", 10))
+
+# Stop reading after this many rows; aggregates then cover the rows read
+SQL_RESULT_SCAN_MAX_ROWS = int(os.getenv("SQL_RESULT_SCAN_MAX_ROWS", 1_000_000))
+
+# Values longer than this are cut in rows shown to the LLM, as SQLDatabase.run does
+SQL_RESULT_MAX_STRING_LENGTH = int(os.getenv("SQL_RESULT_MAX_STRING_LENGTH", 300))
+
+# Save the full result of large queries to GCS for download
+SQL_RESULT_EXPORT = os.getenv("SQL_RESULT_EXPORT", "true").lower() == "true"
+
+# Exports are deleted after this many days (a bucket lifecycle rule)
+SQL_RESULT_EXPORT_RETENTION_DAYS = int(os.getenv("SQL_RESULT_EXPORT_RETENTION_DAYS", 7))
+
+# Download links end up in the LLM's answer and the chat history, so they expire quickly
+SQL_RESULT_EXPORT_LINK_MINUTES = int(os.getenv("SQL_RESULT_EXPORT_LINK_MINUTES", 60))
+EXPORT_PREFIX = "exports/sql/"
+
+FETCH_BATCH_SIZE = 1000
+
+_signing_credentials = None
+_export_lifecycle_checked = False
+_export_lock = threading.Lock()
+
+
+class ExportedResult(str):
+    """Result text with a signed download link; the link expires, so the text is not cached."""
+    cacheable = False
+
+
+class ResultCompactor:
+    """Consume result rows batch by batch while keeping memory bounded.
+
+    Keeps every row only while the result is small enough to give to the LLM verbatim, and
+    otherwise just the head, the tail, the row count and per-column numeric aggregates. Once
+    a result turns out to be large, export_factory(columns) is called and every row read so
+    far, and from then on, is streamed to the writer it returns. Rows shown to the LLM have
+    string values cut to max_string_length; exported rows are complete.
+    """
+
+    def __init__(self, columns: Sequence[str], max_rows: int = SQL_RESULT_MAX_ROWS,
+                 max_bytes: int = SQL_RESULT_MAX_BYTES, sample_rows: int = SQL_RESULT_SAMPLE_ROWS,
+                 export_factory=None, max_string_length: int = SQL_RESULT_MAX_STRING_LENGTH):
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_string_length = max_string_length
+        self.row_count = 0
+        self.truncated = False
+        self.rows: Optional[List[tuple]] = []
+        self.full_rows: Optional[List[tuple]] = [] if export_factory is not None else None
+        self.text_bytes = 0
+        self.head: List[tuple] = []
+        self.tail = deque(maxlen=sample_rows)
+        self.sample_rows = sample_rows
+        self.aggregates = {}
+        self.export_factory = export_factory
+        self.export_writer = None
+
+    def add_rows(self, rows: Iterable[Sequence]):
+        for row in rows:
+            row = tuple(row)
+            shown_row = tuple(truncate_word(value, length=self.max_string_length) for value in row)
+            self.row_count += 1
+            if len(self.head) < self.sample_rows:
+                self.head.append(shown_row)
+            self.tail.append(shown_row)
+
+            if self.rows is not None:
+                self.rows.append(shown_row)
+                if self.full_rows is not None:
+                    self.full_rows.append(row)
+                self.text_bytes += len(str(shown_row)) + 2
+                if len(self.rows) > self.max_rows or self.text_bytes > self.max_bytes:
+                    # Too large for the prompt, keep only the compact form from here on
+                    if self.export_factory is not None:
+                        self._export(self.full_rows, start=True)
+                    self.rows = None
+                    self.full_rows = None
+            elif self.export_writer is not None:
+                self._export([row])
+
+            for column, value in zip(self.columns, row):
+                if isinstance(value, (Number, Decimal)) and not isinstance(value, bool):
+                    stats = self.aggregates.setdefault(column, {'count': 0, 'sum': 0, 'min': value, 'max': value})
+                    stats['count'] += 1
+                    stats['sum'] += value
+                    stats['min'] = min(stats['min'], value)
+                    stats['max'] = max(stats['max'], value)
+
+    def _export(self, rows: List[tuple], start: bool = False):
+        """Write rows to the export; the export is best effort and dropped on the first error."""
+        try:
+            if start:
+                self.export_writer = self.export_factory(self.columns)
+            for row in rows:
+                self.export_writer.writerow(row)
+        except Exception as e:
+            print(f"Unable to export the full result, continuing without it: {e}")
+            self.export_writer = None
+
+    @property
+    def is_compact(self) -> bool:
+        return self.rows is None
+
+    def to_text(self, export_path: Optional[str] = None) -> str:
+        """Full rows (same format as SQLDatabase.run) when small, otherwise a compact summary."""
+        if not self.is_compact:
+            return str(self.rows) if self.rows else ""
+
+        lines = [
+            f"Result has {self.row_count}{'+' if self.truncated else ''} rows"
+            f" and columns {self.columns}. It is too large to show in full.",
+        ]
+        if self.aggregates:
+            lines.append("Numeric column aggregates (over rows read):")
+            for column, stats in self.aggregates.items():
+                average = stats['sum'] / stats['count'] if stats['count'] else None
+                lines.append(f"  {column}: count={stats['count']} sum={stats['sum']} min={stats['min']}"
+                             f" max={stats['max']} avg={average}")
+        lines.append(f"First {len(self.head)} rows: {self.head}")
+        lines.append(f"Last {len(self.tail)} rows: {list(self.tail)}")
+        if export_path:
+            lines.append(f"Full result saved for download (link valid {SQL_RESULT_EXPORT_LINK_MINUTES} minutes)"
+                         f" at: {export_path}")
+        return "\n".join(lines)
+
+
+def _ensure_export_lifecycle(bucket):
+    """Add a rule deleting exports after SQL_RESULT_EXPORT_RETENTION_DAYS, once per process.
+
+    Best effort: without storage.buckets.update the rule has to be set on the bucket by hand.
+    """
+    global _export_lifecycle_checked
+    with _export_lock:
+        if _export_lifecycle_checked:
+            return
+        _export_lifecycle_checked = True
+
+    try:
+        bucket.reload()
+        for rule in bucket.lifecycle_rules:
+            condition = rule.get('condition', {})
+            if rule.get('action', {}).get('type') == "Delete" and EXPORT_PREFIX in condition.get('matchesPrefix', []):
+                return
+        bucket.add_lifecycle_delete_rule(age=SQL_RESULT_EXPORT_RETENTION_DAYS, matches_prefix=[EXPORT_PREFIX])
+        bucket.patch()
+    except Exception as e:
+        print(f"Unable to set the lifecycle rule for {EXPORT_PREFIX}: {e}")
+
+
+def _signed_url(blob) -> str:
+    """V4 signed GET url for blob, signed through the IAM API when the credentials hold no key (Cloud Run)."""
+    global _signing_credentials
+    with _export_lock:
+        if _signing_credentials is None:
+            _signing_credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        credentials = _signing_credentials
+        if isinstance(credentials, Signing):
+            return blob.generate_signed_url(version="v4", method="GET", credentials=credentials,
+                                            expiration=timedelta(minutes=SQL_RESULT_EXPORT_LINK_MINUTES))
+        if not credentials.valid:
+            credentials.refresh(google.auth.transport.requests.Request())
+        service_account_email, access_token = credentials.service_account_email, credentials.token
+
+    return blob.generate_signed_url(version="v4", method="GET", service_account_email=service_account_email,
+                                    access_token=access_token,
+                                    expiration=timedelta(minutes=SQL_RESULT_EXPORT_LINK_MINUTES))
+
+
+class _GCSExport:
+    """Streams CSV rows to a GCS object without buffering the whole result."""
+
+    def __init__(self, columns):
+        bucket = get_storage_client().bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
+        _ensure_export_lifecycle(bucket)
+        self._blob = bucket.blob(f"{EXPORT_PREFIX}{time.strftime('%Y%m%d')}/{uuid4()}.csv")
+        self._file = self._blob.open("w", content_type="text/csv", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+    def download_url(self) -> Optional[str]:
+        try:
+            return _signed_url(self._blob)
+        except Exception as e:
+            print(f"Unable to sign the download url of {self._blob.name}: {e}")
+            return None
+
+
+def _bigquery_batches(db, sql: str):
+    """Stream BigQuery results in batches, through the Storage read API when pyarrow is installed."""
+    from google.cloud import bigquery
+
+    url = db._engine.url
+    job_config = bigquery.QueryJobConfig(
+        default_dataset=f"{url.host}.{url.database}" if url.database else None
+    )
+    row_iterator = get_bigquery_client().query(sql, job_config=job_config).result(page_size=FETCH_BATCH_SIZE)
+    columns = [field.name for field in row_iterator.schema]
+
+    def batches():
+        if HAS_PYARROW:
+            for record_batch in row_iterator.to_arrow_iterable(bqstorage_client=get_bigquery_storage_client()):
+                yield [tuple(row.values()) for row in record_batch.to_pylist()]
+        else:
+            for page in row_iterator.pages:
+                yield [tuple(row.values()) for row in page]
+
+    return columns, batches()
+
+
+def _sqlalchemy_batches(db, sql: str):
+    """Stream results from any SQLAlchemy dialect with a server side cursor when supported."""
+    def batches():
+        with db._engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(text(sql))
+            yield list(result.keys())
+            while True:
+                rows = result.fetchmany(FETCH_BATCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+
+    # The first item is the columns; the connection is closed if execute raises or the batches are closed
+    batches = batches()
+    return next(batches), batches
+
+
+@traced("sql_execute")
+def fetch_compact_result(db, sql: str, export: bool = SQL_RESULT_EXPORT) -> str:
+    """Run a query with bounded memory and return text sized for the LLM prompt.
+
+    When the full result was exported the text is an ExportedResult holding a signed download link.
+    """
+    if db.dialect == "bigquery":
+        columns, batches = _bigquery_batches(db, sql)
+    else:
+        columns, batches = _sqlalchemy_batches(db, sql)
+
+    compactor = ResultCompactor(columns, export_factory=_GCSExport if export else None,
+                                max_string_length=getattr(db, "_max_string_length", SQL_RESULT_MAX_STRING_LENGTH))
+    try:
+        for batch in batches:
+            compactor.add_rows(batch)
+            if compactor.row_count >= SQL_RESULT_SCAN_MAX_ROWS:
+                compactor.truncated = True
+                break
+    finally:
+        batches.close()
+        if compactor.export_writer is not None:
+            compactor.export_writer.close()
+
+    download_url = compactor.export_writer.download_url() if compactor.export_writer else None
+    if download_url:
+        return ExportedResult(compactor.to_text(download_url))
+    return compactor.to_text()
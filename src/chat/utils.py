@@ -1,60 +1,99 @@
-import jsonpickle
+import hashlib
 import mimetypes
 import os
 import re
-from google.cloud import storage
 from typing import Optional
+from google.api_core.exceptions import PreconditionFailed
 from uuid import uuid4
 
+from src.chat.history import append_history, load_history
+from src.clients.utils import get_storage_client
+from src.metrics.utils import traced
+
+# Extensions for the media types the app stores; mimetypes has no entry for some (audio/webm, audio/wav)
+MEDIA_EXTENSIONS = {
+    'audio/webm': '.webm',
+    'video/webm': '.webm',
+    'audio/mpeg': '.mp3',
+    'audio/wav': '.wav',
+    'audio/x-wav': '.wav',
+    'audio/ogg': '.ogg',
+    'audio/mp4': '.m4a',
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/heic': '.heic',
+    'image/heif': '.heif',
+}
+
 
 def clean_text(text):
     """Clean text."""
     return re.sub(r'\s+', ' ', text)
 
 
+@traced("history_load")
 def get_chat_history(user_id: str, chat_history_id: Optional[str] = None):
     """Fetch chat history from Google Cloud Storage."""
     if not chat_history_id:
         return []
 
-    client = storage.Client()
-    bucket = client.bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
-    blob = bucket.blob(f"users/{user_id}/chats/{chat_history_id}.txt")
-
-    if blob.exists():
-        return jsonpickle.decode(blob.download_as_text())
-    else:
-        return []
+    return load_history(user_id, chat_history_id)
 
 
+@traced("history_save")
 def save_chat_history(user_id: str, chat_history_id: str, chat_history):
-    """Save updated chat history back to Google Cloud Storage."""
-    client = storage.Client()
-    bucket = client.bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
-    blob = bucket.blob(f"users/{user_id}/chats/{chat_history_id}.txt")
+    """Append new chat history turns to Google Cloud Storage."""
+    append_history(user_id, chat_history_id, chat_history)
 
-    if isinstance(chat_history, list):
-        encoded_chat_history = jsonpickle.encode(chat_history, True)
-    else:
-        encoded_chat_history = chat_history
 
-    # Convert the chat history to JSON and upload
-    blob.upload_from_string(encoded_chat_history, content_type='text/plain')
+def media_extension(mime_type: str) -> str:
+    """File extension for a MIME type, .bin when it has none (the stored content type still tells)."""
+    return MEDIA_EXTENSIONS.get(mime_type) or mimetypes.guess_extension(mime_type) or ".bin"
 
 
 def upload_image_to_gcs(user_id: str, chat_history_id: str, image_bytes, image_mime_type):
     """Uploads image bytes to GCS bucket with a random UUID as the file name."""
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     bucket_name = os.getenv("GOOGLE_CLOUD_BUCKET")
     bucket = storage_client.bucket(bucket_name)
 
     # Get the file extension from the MIME type
-    extension = mimetypes.guess_extension(image_mime_type)
-    if not extension:
-        raise ValueError(f"Unsupported MIME type: {image_mime_type}")
+    extension = media_extension(image_mime_type)
 
     # Generate a unique name with the correct extension
     image_name = f"users/{user_id}/chats/{chat_history_id}/{uuid4()}{extension}"
     blob = bucket.blob(image_name)
     blob.upload_from_string(image_bytes, content_type=image_mime_type)
     return f"gs://{bucket_name}/{image_name}"
+
+
+def media_object_name(user_id: str, media_bytes, media_mime_type) -> str:
+    """Object name of media in the bucket: the hash of its content, so identical media share one object."""
+    # Get the file extension from the MIME type
+    extension = media_extension(media_mime_type)
+
+    content_hash = hashlib.sha256(media_bytes).hexdigest()
+    return f"users/{user_id}/media/{content_hash}{extension}"
+
+
+def media_gcs_path(user_id: str, media_bytes, media_mime_type) -> str:
+    """The gs:// path upload_media_to_gcs stores media under."""
+    return f"gs://{os.getenv('GOOGLE_CLOUD_BUCKET')}/{media_object_name(user_id, media_bytes, media_mime_type)}"
+
+
+def upload_media_to_gcs(user_id: str, media_bytes, media_mime_type):
+    """Uploads media bytes to GCS bucket named by their content hash, skipping media already stored."""
+    storage_client = get_storage_client()
+    bucket_name = os.getenv("GOOGLE_CLOUD_BUCKET")
+    bucket = storage_client.bucket(bucket_name)
+
+    # Identical media always maps to the same object
+    media_name = media_object_name(user_id, media_bytes, media_mime_type)
+    blob = bucket.blob(media_name)
+    try:
+        blob.upload_from_string(media_bytes, content_type=media_mime_type, if_generation_match=0)
+    except PreconditionFailed:
+        # Already uploaded
+        pass
+    return f"gs://{bucket_name}/{media_name}"
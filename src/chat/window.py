@@ -0,0 +1,243 @@
+import json
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import List, Optional
+
+import tiktoken
+from vertexai.generative_models import Content, Part
+
+from src.metrics.utils import traced
+from src.prefetch.utils import submit
+
+# Recent turns always sent verbatim, and the token budget for the verbatim window
+CHAT_HISTORY_WINDOW_TURNS = int(os.getenv("CHAT_HISTORY_WINDOW_TURNS", 8))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", 8000))
+
+# Model used to fold older turns into the rolling summary, and the model it fails over to
+CHAT_HISTORY_SUMMARY_MODEL = os.getenv("CHAT_HISTORY_SUMMARY_MODEL", "gemini-1.5-flash-001")
+CHAT_HISTORY_SUMMARY_FALLBACK_MODEL = os.getenv("CHAT_HISTORY_SUMMARY_FALLBACK_MODEL", "claude-3-5-sonnet@20240620")
+
+# Seconds allowed for summarizing, older turns are truncated instead once it runs out
+CHAT_HISTORY_SUMMARY_TIMEOUT = float(os.getenv("CHAT_HISTORY_SUMMARY_TIMEOUT", 20))
+
+# Function response payloads (SQL results) are cut to this many characters before summarizing
+FUNCTION_RESPONSE_SUMMARY_CHARS = 2000
+
+# Number of chats whose rolling summary is kept in memory (summaries are also stored in GCS)
+CHAT_SUMMARY_CACHE_SIZE = int(os.getenv("CHAT_SUMMARY_CACHE_SIZE", 512))
+
+# Seconds before retrying to load the tiktoken encoding after a failure (token counts are approximated meanwhile)
+TOKENIZER_RETRY_SECONDS = float(os.getenv("TOKENIZER_RETRY_SECONDS", 300))
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and an assistant that answers"
+    " questions about a diabetes datamart with SQL. Keep the user's goals, filters, definitions,"
+    " important numbers and the SQL queries that produced them. Be concise.\n\n"
+    "Current summary:\n{summary}\n\nNew conversation turns:\n{turns}\n\nUpdated summary:"
+)
+
+# Rolling summaries per (user_id, chat_history_id): {'folded': turns folded, 'summary': text}
+summary_cache = OrderedDict()
+_summary_cache_lock = threading.Lock()
+_encoding = None
+_encoding_failed_at = None
+_encoding_lock = threading.Lock()
+
+# Token count per Content object; cached histories reuse their objects, so each turn is counted once
+_token_counts = weakref.WeakKeyDictionary()
+_token_counts_lock = threading.Lock()
+
+
+def _get_encoding():
+    """The cl100k_base encoding, None while it cannot be loaded (retried every TOKENIZER_RETRY_SECONDS)."""
+    global _encoding, _encoding_failed_at
+    if _encoding is not None:
+        return _encoding
+    with _encoding_lock:
+        if _encoding is None and (_encoding_failed_at is None
+                                  or time.monotonic() - _encoding_failed_at >= TOKENIZER_RETRY_SECONDS):
+            try:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # The encoding file is downloaded on first use (unless baked into the image),
+                # fall back to ~4 characters per token until a retry succeeds
+                print(f"Unable to load tiktoken encoding, approximating token counts: {e}")
+                _encoding_failed_at = time.monotonic()
+    return _encoding
+
+
+def count_text_tokens(text: str) -> int:
+    """Count tokens in text with tiktoken (cl100k_base approximates Gemini tokenization)."""
+    encoding = _get_encoding()
+    if not encoding:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def content_to_text(content, max_function_response_chars: Optional[int] = None) -> str:
+    """Flatten a Content into text, including function calls and responses."""
+    lines = []
+    for part in content.parts:
+        part_dict = part.to_dict()
+        if 'text' in part_dict:
+            lines.append(part_dict['text'])
+        elif 'function_call' in part_dict:
+            lines.append(f"[function call] {json.dumps(part_dict['function_call'])}")
+        elif 'function_response' in part_dict:
+            response = json.dumps(part_dict['function_response'])
+            if max_function_response_chars and len(response) > max_function_response_chars:
+                response = response[:max_function_response_chars] + "...(truncated)"
+            lines.append(f"[function response] {response}")
+        else:
+            lines.append(f"[{', '.join(part_dict.keys())}]")
+    return f"{content.role}: " + "\n".join(lines)
+
+
+def count_content_tokens(content) -> int:
+    """Approximate the prompt tokens used by a Content object, counting each object once."""
+    with _token_counts_lock:
+        count = _token_counts.get(content)
+    if count is None:
+        count = count_text_tokens(content_to_text(content))
+        with _token_counts_lock:
+            _token_counts[content] = count
+    return count
+
+
+def count_tokens(contents) -> int:
+    """Approximate the prompt tokens used by a list of Content objects."""
+    return sum(count_content_tokens(content) for content in contents)
+
+
+def _is_user_message(content) -> bool:
+    """A user turn that starts an exchange (not a function response)."""
+    return content.role == "user" and not any('function_response' in part.to_dict() for part in content.parts)
+
+
+def _window_start(history, token_counts: List[int], window_turns: int, token_budget: int) -> int:
+    """Index where the verbatim window starts, aligned to a user message."""
+    start = max(len(history) - window_turns, 0)
+    while start < len(history) and not _is_user_message(history[start]):
+        start += 1
+
+    # Drop whole exchanges from the front until the window fits the budget
+    window_tokens = sum(token_counts[start:])
+    while start < len(history) and window_tokens > token_budget:
+        window_tokens -= token_counts[start]
+        start += 1
+        while start < len(history) and not _is_user_message(history[start]):
+            window_tokens -= token_counts[start]
+            start += 1
+
+    return start
+
+
+def _turns_text(turns) -> str:
+    return "\n".join(content_to_text(content, FUNCTION_RESPONSE_SUMMARY_CHARS) for content in turns)
+
+
+def _summarize(previous_summary: str, turns) -> str:
+    """Fold turns into the previous summary with a small model."""
+    from src.llm.generate import generate_text
+
+    return generate_text(
+        SUMMARY_PROMPT.format(summary=previous_summary or "(none)", turns=_turns_text(turns)),
+        models=[CHAT_HISTORY_SUMMARY_MODEL, CHAT_HISTORY_SUMMARY_FALLBACK_MODEL],
+        temperature=0.0,
+        max_output_tokens=1024,
+        timeout=CHAT_HISTORY_SUMMARY_TIMEOUT
+    )
+
+
+def _load_stored_summary(user_id: str, chat_history_id: str) -> Optional[dict]:
+    from src.chat.history import load_summary
+
+    try:
+        return load_summary(user_id, chat_history_id)
+    except Exception as e:
+        print(f"Unable to load the chat summary: {e}")
+        return None
+
+
+def _store_summary(user_id: str, chat_history_id: str, summary: dict):
+    from src.chat.history import save_summary
+
+    try:
+        save_summary(user_id, chat_history_id, summary)
+    except Exception as e:
+        print(f"Unable to store the chat summary: {e}")
+
+
+def get_rolling_summary(user_id: str, chat_history_id: str, older_turns) -> str:
+    """Get the summary of older_turns, only summarizing turns not folded in before.
+
+    Summaries are cached in memory and stored next to the chat history, so a cold instance
+    picks up where the last one left off. When summarizing fails the older turns are
+    truncated instead, and that fallback is not cached.
+    """
+    key = (user_id, chat_history_id)
+    with _summary_cache_lock:
+        cached = summary_cache.get(key)
+    if cached is None and user_id and chat_history_id:
+        cached = _load_stored_summary(user_id, chat_history_id)
+
+    if cached and cached['folded'] == len(older_turns):
+        summary = cached['summary']
+    else:
+        previous, folded = "", 0
+        if cached and cached['folded'] < len(older_turns):
+            previous, folded = cached['summary'], cached['folded']
+        try:
+            summary = _summarize(previous, older_turns[folded:])
+        except Exception as e:
+            print(f"Unable to summarize chat history: {e}")
+            return (previous + "\n" + _turns_text(older_turns[folded:]))[-FUNCTION_RESPONSE_SUMMARY_CHARS * 2:]
+        cached = {'folded': len(older_turns), 'summary': summary}
+        if user_id and chat_history_id:
+            # Stored off the request path, the next request of this instance uses the memory copy
+            submit(_store_summary, user_id, chat_history_id, cached)
+
+    with _summary_cache_lock:
+        summary_cache[key] = cached
+        summary_cache.move_to_end(key)
+        while len(summary_cache) > CHAT_SUMMARY_CACHE_SIZE:
+            summary_cache.popitem(last=False)
+    return summary
+
+
+@traced("history_shape")
+def shape_history(
+    history: List[Content],
+    user_id: Optional[str] = None,
+    chat_history_id: Optional[str] = None,
+    window_turns: int = CHAT_HISTORY_WINDOW_TURNS,
+    token_budget: int = CHAT_HISTORY_TOKEN_BUDGET
+):
+    """Keep the recent window verbatim and fold older turns into a rolling summary.
+
+    Returns the shaped history and token stats ({'tokens_before', 'tokens_after', 'tokens_saved'}).
+    """
+    history = list(history)
+    token_counts = [count_content_tokens(content) for content in history]
+    tokens_before = sum(token_counts)
+    start = _window_start(history, token_counts, window_turns, token_budget)
+
+    if start == 0:
+        shaped = history
+    else:
+        summary = get_rolling_summary(user_id, chat_history_id, history[:start])
+        shaped = [
+            Content(role="user", parts=[Part.from_text(f"Summary of our earlier conversation:\n{summary}")]),
+            Content(role="model", parts=[Part.from_text("Understood.")]),
+        ] + history[start:]
+
+    tokens_after = count_tokens(shaped[:2]) + sum(token_counts[start:]) if start else tokens_before
+    stats = {
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_saved': tokens_before - tokens_after,
+    }
+    return shaped, stats
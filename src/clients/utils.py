@@ -0,0 +1,214 @@
+import os
+import sys
+import threading
+from typing import Any, Callable, Dict
+
+import google.auth
+import google.auth.transport.requests
+import requests
+from requests.adapters import HTTPAdapter
+
+# Connection pool sizing for the HTTP based clients
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 10))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 32))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+
+# Registry of shared clients, created lazily on first use
+_clients: Dict[str, Any] = {}
+_factories: Dict[str, Callable[[], Any]] = {}
+_lock = threading.Lock()
+
+# Counters for created and reused clients
+client_stats = {
+    'created': 0,
+    'reused': 0,
+    'injected': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _stats_lock:
+        client_stats[name] += 1
+
+
+def register_client_factory(name: str, factory: Callable[[], Any]):
+    """Register a factory used to lazily build the named client."""
+    _factories[name] = factory
+
+
+def get_client(name: str):
+    """Return the shared client registered under name, creating it once."""
+    client = _clients.get(name)
+    if client is not None:
+        _count('reused')
+        return client
+
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            if name not in _factories:
+                raise KeyError(f"No client factory registered for: {name}")
+            client = _factories[name]()
+            _clients[name] = client
+            _count('created')
+        else:
+            _count('reused')
+    return client
+
+
+def set_client(name: str, client):
+    """Inject a client (e.g. a fake in tests) under name."""
+    with _lock:
+        _clients[name] = client
+        _count('injected')
+
+
+def reset_clients():
+    """Drop every cached client so the next lookup builds a fresh one."""
+    with _lock:
+        _clients.clear()
+
+
+def _reset_after_fork():
+    """Forked children must not share gRPC channels or sockets with the parent."""
+    global _lock, _stats_lock
+    _lock = threading.Lock()
+    _stats_lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _pooled_session(scopes=None):
+    """Build an authorized requests session backed by a keep-alive connection pool."""
+    credentials, _ = google.auth.default(scopes=scopes)
+    session = google.auth.transport.requests.AuthorizedSession(credentials)
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _create_storage_client():
+    from google.cloud import storage
+    session = _pooled_session(scopes=['https://www.googleapis.com/auth/devstorage.full_control'])
+    return storage.Client(_http=session)
+
+
+def _create_firestore_client():
+    from google.cloud import firestore
+    return firestore.Client()
+
+
+def _create_tasks_client():
+    from google.cloud import tasks_v2
+    return tasks_v2.CloudTasksClient()
+
+
+def _create_bigquery_client():
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+
+def _create_bigquery_storage_client():
+    from google.cloud import bigquery_storage
+    return bigquery_storage.BigQueryReadClient()
+
+
+def _create_anthropic_client(region: str = "us-east5"):
+    import httpx
+    from anthropic import AnthropicVertex
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_MAXSIZE,
+            max_keepalive_connections=HTTP_POOL_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+    return AnthropicVertex(region=region,
+                           project_id=os.getenv("GOOGLE_CLOUD_PROJECT"),
+                           http_client=http_client)
+
+
+register_client_factory("storage", _create_storage_client)
+register_client_factory("firestore", _create_firestore_client)
+register_client_factory("tasks", _create_tasks_client)
+register_client_factory("bigquery", _create_bigquery_client)
+register_client_factory("bigquery_storage", _create_bigquery_storage_client)
+
+
+def get_storage_client():
+    """Shared Google Cloud Storage client."""
+    return get_client("storage")
+
+
+def get_firestore_client():
+    """Shared Firestore client."""
+    return get_client("firestore")
+
+
+def get_tasks_client():
+    """Shared Cloud Tasks client."""
+    return get_client("tasks")
+
+
+def get_bigquery_client():
+    """Shared BigQuery client."""
+    return get_client("bigquery")
+
+
+def get_bigquery_storage_client():
+    """Shared BigQuery Storage read client."""
+    return get_client("bigquery_storage")
+
+
+def get_anthropic_client(region: str = "us-east5"):
+    """Shared AnthropicVertex client for the given region."""
+    name = f"anthropic:{region}"
+    if name not in _factories:
+        register_client_factory(name, lambda: _create_anthropic_client(region))
+    return get_client(name)
+
+
+def _count_connections(client) -> int:
+    """Best-effort count of open connections held by a client's pool."""
+    try:
+        # requests / urllib3 backed clients (storage)
+        http = getattr(client, "_http", None)
+        if isinstance(http, requests.Session):
+            total = 0
+            for adapter in set(http.adapters.values()):
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[key]
+                    total += pool.num_connections
+            return total
+
+        # httpx backed clients (anthropic), httpx is only loaded once one exists
+        httpx = sys.modules.get("httpx")
+        http_client = getattr(client, "_client", None)
+        if httpx and isinstance(http_client, httpx.Client):
+            return len(http_client._transport._pool.connections)
+    except Exception:
+        pass
+
+    # gRPC clients hold a single multiplexed channel
+    return 1
+
+
+def get_client_stats():
+    """Return counters for created/reused clients and open connections."""
+    with _lock:
+        clients = dict(_clients)
+    with _stats_lock:
+        stats = dict(client_stats)
+    return {
+        **stats,
+        'clients': len(clients),
+        'connections': {name: _count_connections(client) for name, client in clients.items()},
+    }
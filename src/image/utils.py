@@ -0,0 +1,277 @@
+import hashlib
+import io
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Optional, Tuple
+
+from src.audio.utils import iter_chunks
+from src.chat.utils import media_gcs_path, upload_media_to_gcs
+from src.metrics.utils import span
+from src.prefetch.utils import submit
+
+# Largest accepted upload, and largest decoded image (guards against decompression bombs)
+IMAGE_MAX_INPUT_BYTES = int(os.getenv("IMAGE_MAX_INPUT_BYTES", 20 * 1024 * 1024))  # 20 MB
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", 50_000_000))
+
+# Longest side after downscaling; Gemini gains nothing from larger images (0 disables resizing)
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1536))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+
+# Images within the maximum dimension are only re-encoded above this size
+IMAGE_REENCODE_MIN_BYTES = int(os.getenv("IMAGE_REENCODE_MIN_BYTES", 512 * 1024))  # 512 KB
+
+# Upload mode: "background" (overlaps the upload with enqueueing the task) or "sync"
+IMAGE_UPLOAD_MODE = os.getenv("IMAGE_UPLOAD_MODE", "background")
+
+# Seconds to wait for a background upload before giving up on it
+IMAGE_UPLOAD_TIMEOUT = float(os.getenv("IMAGE_UPLOAD_TIMEOUT", 30))
+
+# Recently processed images per process, keyed by user and hash of the original bytes
+IMAGE_DEDUP_CACHE_SIZE = int(os.getenv("IMAGE_DEDUP_CACHE_SIZE", 1024))
+
+# Formats Gemini accepts; anything else is converted to JPEG or PNG
+SUPPORTED_MIME_TYPES = ["image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"]
+
+# (user id, original hash) -> (gs:// path, MIME type), in least recently used order
+processed_images = OrderedDict()
+_processed_images_lock = threading.Lock()
+
+# gs:// path -> Future of an upload still running in this process
+_pending_uploads = {}
+_pending_uploads_lock = threading.Lock()
+
+image_stats = {
+    'images': 0,
+    'duplicates': 0,
+    'resized': 0,
+    'reencoded': 0,
+    'passthrough': 0,
+    'rejected': 0,
+    'upload_failures': 0,
+    'input_bytes': 0,
+    'output_bytes': 0,
+    'bytes_saved': 0,
+    'seconds': 0.0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, value=1):
+    with _stats_lock:
+        image_stats[name] += value
+
+
+class ImageError(Exception):
+    """Raised when an image is rejected or cannot be processed within the configured limits."""
+
+
+class ImageUploadError(Exception):
+    """Raised when a staged image could not be uploaded, so it must not be referenced."""
+
+
+def read_image(source, max_bytes: int = IMAGE_MAX_INPUT_BYTES) -> bytes:
+    """Read bytes, a file-like object or an iterable of chunks fully, failing once it exceeds max_bytes."""
+    buffer = bytearray()
+    for chunk in iter_chunks(source):
+        buffer += chunk
+        if len(buffer) > max_bytes:
+            raise ImageError(f"Image exceeds {max_bytes} bytes")
+    return bytes(buffer)
+
+
+def _has_alpha(image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def downscale_image(
+    image_bytes: bytes,
+    mime_type: str,
+    max_dimension: int = IMAGE_MAX_DIMENSION,
+    quality: int = IMAGE_JPEG_QUALITY
+) -> Tuple[bytes, str]:
+    """Downscale an image to max_dimension on its longest side and re-encode it.
+
+    Applies the EXIF orientation (and drops the remaining metadata), keeps PNG and transparent
+    images lossless and encodes the rest as JPEG. The original is kept when it is already within the limits
+    and small, when Pillow cannot decode it (e.g. HEIC), or when processing would not shrink it.
+    """
+    from PIL import Image, ImageOps
+
+    resize = False
+    try:
+        with span("image_decode"):
+            image = Image.open(io.BytesIO(image_bytes))
+            width, height = image.size
+            if width * height > IMAGE_MAX_PIXELS:
+                raise ImageError(f"Image has {width * height} pixels, the limit is {IMAGE_MAX_PIXELS}")
+
+            resize = bool(max_dimension) and max(width, height) > max_dimension
+            if not resize and len(image_bytes) < IMAGE_REENCODE_MIN_BYTES and mime_type in SUPPORTED_MIME_TYPES:
+                _count('passthrough')
+                return image_bytes, mime_type
+
+            if resize:
+                # JPEG decodes straight at a reduced scale (no smaller than the target size), much
+                # faster than decoding at full size and resizing
+                scale = max_dimension / max(width, height)
+                image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except ImageError:
+        raise
+    except Image.DecompressionBombError as e:
+        raise ImageError(f"Image rejected as a decompression bomb: {e}")
+    except Exception as e:
+        if mime_type not in SUPPORTED_MIME_TYPES:
+            raise ImageError(f"Unable to decode {mime_type} image: {e}")
+        _count('passthrough')
+        return image_bytes, mime_type
+
+    with span("image_resize"):
+        if resize and max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+    with span("image_encode"):
+        output = io.BytesIO()
+        if _has_alpha(image) or mime_type == "image/png":
+            # Screenshots and diagrams stay lossless, JPEG blurs text and inflates flat colour
+            image.save(output, format="PNG")
+            output_mime_type = "image/png"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+            output_mime_type = "image/jpeg"
+        output_bytes = output.getvalue()
+
+    # Resampling can inflate flat images (anti-aliased text in PNG), upload the smaller of the two
+    if len(output_bytes) >= len(image_bytes) and mime_type in SUPPORTED_MIME_TYPES:
+        _count('passthrough')
+        return image_bytes, mime_type
+
+    _count('resized' if resize else 'reencoded')
+    return output_bytes, output_mime_type
+
+
+def _upload(user_id: str, gcs_path: str, image_bytes: bytes, mime_type: str):
+    try:
+        with span("image_upload"):
+            return upload_media_to_gcs(user_id, image_bytes, mime_type)
+    except Exception as e:
+        _count('upload_failures')
+        with _processed_images_lock:
+            for key, (path, _) in list(processed_images.items()):
+                if path == gcs_path:
+                    del processed_images[key]
+        raise ImageUploadError(f"Unable to upload {gcs_path}: {e}") from e
+    finally:
+        with _pending_uploads_lock:
+            _pending_uploads.pop(gcs_path, None)
+
+
+def _start_upload(user_id: str, gcs_path: str, image_bytes: bytes, mime_type: str) -> Future:
+    """Upload in the background, joining an upload of the same path already running.
+
+    The Future is registered before the upload starts, so _upload always finds it to remove;
+    submit runs outside the lock since on pool threads it runs _upload inline.
+    """
+    with _pending_uploads_lock:
+        upload = _pending_uploads.get(gcs_path)
+        if upload is not None:
+            return upload
+        upload = _pending_uploads[gcs_path] = Future()
+
+    def resolve(task: Future):
+        if task.exception() is not None:
+            upload.set_exception(task.exception())
+        else:
+            upload.set_result(task.result())
+
+    try:
+        task = submit(_upload, user_id, gcs_path, image_bytes, mime_type)
+    except Exception as e:
+        with _pending_uploads_lock:
+            _pending_uploads.pop(gcs_path, None)
+        upload.set_exception(ImageUploadError(f"Unable to upload {gcs_path}: {e}"))
+        raise upload.exception() from e
+    task.add_done_callback(resolve)
+    return upload
+
+
+def stage_image(source, mime_type: str, user_id: str, upload_mode: Optional[str] = None):
+    """Validate, downscale and upload an image, returning (gs:// path, MIME type, upload).
+
+    Images are stored under the hash of their processed bytes, so the same image is stored
+    once per user, and the same original is only processed once per process. With the
+    background upload mode, upload is a Future the caller waits on with wait_for_upload;
+    otherwise the upload has finished and upload is None. A failed synchronous upload raises
+    ImageUploadError.
+    """
+    start_time = time.perf_counter()
+    try:
+        with span("image_read"):
+            image_bytes = read_image(source)
+    except ImageError:
+        _count('rejected')
+        raise
+
+    _count('images')
+    _count('input_bytes', len(image_bytes))
+    original_key = (user_id, hashlib.sha256(image_bytes).hexdigest())
+
+    with _processed_images_lock:
+        cached = processed_images.get(original_key)
+        if cached:
+            processed_images.move_to_end(original_key)
+    if cached:
+        _count('duplicates')
+        _count('bytes_saved', len(image_bytes))
+        gcs_path, output_mime_type = cached
+        with _pending_uploads_lock:
+            upload = _pending_uploads.get(gcs_path)
+        _count('seconds', time.perf_counter() - start_time)
+        return gcs_path, output_mime_type, upload
+
+    try:
+        output_bytes, output_mime_type = downscale_image(image_bytes, mime_type)
+    except ImageError:
+        _count('rejected')
+        raise
+    _count('output_bytes', len(output_bytes))
+    _count('bytes_saved', len(image_bytes) - len(output_bytes))
+
+    gcs_path = media_gcs_path(user_id, output_bytes, output_mime_type)
+    with _processed_images_lock:
+        processed_images[original_key] = (gcs_path, output_mime_type)
+        if len(processed_images) > IMAGE_DEDUP_CACHE_SIZE:
+            processed_images.popitem(last=False)
+
+    upload = None
+    if (upload_mode or IMAGE_UPLOAD_MODE) == "background":
+        upload = _start_upload(user_id, gcs_path, output_bytes, output_mime_type)
+    else:
+        _upload(user_id, gcs_path, output_bytes, output_mime_type)
+
+    _count('seconds', time.perf_counter() - start_time)
+    return gcs_path, output_mime_type, upload
+
+
+def wait_for_upload(upload, timeout: float = IMAGE_UPLOAD_TIMEOUT):
+    """Wait for a background upload started by stage_image, raising ImageUploadError if it failed."""
+    if upload is not None:
+        with span("image_upload_wait"):
+            try:
+                upload.result(timeout=timeout)
+            except FutureTimeoutError:
+                raise ImageUploadError(f"Image upload did not finish within {timeout}s")
+
+
+def wait_for_pending_upload(gcs_path: Optional[str], timeout: float = IMAGE_UPLOAD_TIMEOUT):
+    """Wait for an upload of gcs_path still running in this process (tasks dispatched in process)."""
+    if not gcs_path:
+        return
+    with _pending_uploads_lock:
+        upload = _pending_uploads.get(gcs_path)
+    wait_for_upload(upload, timeout)
@@ -0,0 +1,59 @@
+import os
+from typing import List, Optional
+
+import src.llm.utils as llm_utils
+
+CLAUDE_MODEL = "claude-3-5-sonnet@20240620"
+GEMINI_MODEL = "gemini-1.5-flash-001"
+
+# Models tried in order for one-shot text generation such as chat titles
+LLM_TEXT_MODELS = [model for model in os.getenv("LLM_TEXT_MODELS", f"{CLAUDE_MODEL},{GEMINI_MODEL}").split(",") if model]
+
+
+def _generate_claude(prompt, model_name: str, system_instruction: Optional[str], temperature: float,
+                     max_output_tokens: int) -> str:
+    import src.anthropic.generate as anthropic_generate
+
+    return anthropic_generate.generate(
+        prompt,
+        system_instruction=system_instruction or "",
+        model_name=model_name,
+        max_output_tokens=max_output_tokens
+    )
+
+
+def _generate_gemini(prompt, model_name: str, system_instruction: Optional[str], temperature: float,
+                     max_output_tokens: int) -> str:
+    from vertexai.generative_models import GenerationConfig
+
+    from src.chat.models import get_model, init_vertexai
+
+    init_vertexai()
+    model = get_model(model_name, system_instruction=system_instruction, temperature=temperature)
+    response = model.generate_content(
+        prompt,
+        generation_config=GenerationConfig(temperature=temperature, max_output_tokens=max_output_tokens)
+    )
+    return response.text
+
+
+def generate_text(
+    prompt,
+    models: Optional[List[str]] = None,
+    system_instruction: Optional[str] = None,
+    temperature: float = 0.2,
+    max_output_tokens: int = 4096,
+    timeout: Optional[float] = None,
+    hedge: bool = True
+) -> str:
+    """Generate text with the first available of models (Claude on Vertex or Gemini), failing over in order.
+
+    Calls are bounded by timeout and the request deadline, and hedged when hedging is enabled.
+    Raises llm_utils.LLMUnavailable when no model answered.
+    """
+    candidates = []
+    for model_name in models or LLM_TEXT_MODELS:
+        backend = _generate_claude if model_name.lower().startswith("claude") else _generate_gemini
+        candidates.append((model_name, lambda backend=backend, model_name=model_name: backend(
+            prompt, model_name, system_instruction, temperature, max_output_tokens)))
+    return llm_utils.call_with_fallback(candidates, timeout=timeout, hedge=hedge)
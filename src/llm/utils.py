@@ -0,0 +1,398 @@
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.metrics.utils import observe
+
+# Seconds allowed for one model call, and for the wait between two chunks of a streamed answer
+LLM_CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", 60))
+LLM_STREAM_CHUNK_TIMEOUT = float(os.getenv("LLM_STREAM_CHUNK_TIMEOUT", 30))
+
+# Seconds allowed for all model calls of one request (retries and failovers included)
+LLM_REQUEST_DEADLINE = float(os.getenv("LLM_REQUEST_DEADLINE", 240))
+
+# Hedging: when a stateless call is still running after the given percentile of the model's
+# recent latencies, send a duplicate and use whichever answers first
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", 0.95))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", 0.5))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+
+# Recent call latencies kept per model, for hedging and the reported percentiles
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", 200))
+
+# Consecutive failures that open a model's circuit, and seconds before a trial call is let through
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", 30))
+
+# Threads running model calls; a call that misses its deadline keeps its thread until it returns
+LLM_CALL_WORKERS = int(os.getenv("LLM_CALL_WORKERS", 64))
+
+# Absolute (time.monotonic) deadline of the current request's model calls
+_deadline = contextvars.ContextVar("llm_deadline", default=None)
+
+_executor = None
+_executor_lock = threading.Lock()
+_models: Dict[str, "ModelState"] = {}
+_models_lock = threading.Lock()
+
+
+class LLMTimeout(Exception):
+    """Raised when a model call misses its per-call timeout or the request deadline."""
+
+
+class CircuitOpen(Exception):
+    """Raised when a model's circuit is open and the call was not attempted."""
+
+
+class LLMUnavailable(Exception):
+    """Raised when every model of a failover chain failed or was skipped."""
+
+    def __init__(self, errors: Dict[str, Exception]):
+        super().__init__("; ".join(f"{model}: {error!r}" for model, error in errors.items()))
+        self.errors = errors
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failures; once `reset` seconds have passed a single
+    trial call is let through (half open), closing the circuit on success."""
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, reset: float = LLM_BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.opens = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self._trial_running or self.consecutive_failures >= self.failures:
+                if self.opened_at is None or self._trial_running:
+                    self.opens += 1
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release(self):
+        """End a call that says nothing about the model (e.g. the request ran out of time)."""
+        with self._lock:
+            self._trial_running = False
+
+
+class ModelState:
+    """Circuit breaker, recent latencies and counters of one model."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.stage = "llm_" + re.sub(r"[^\w-]", "_", model)
+        self.breaker = CircuitBreaker()
+        self.latencies = deque(maxlen=LLM_LATENCY_WINDOW)
+        self.stats = {
+            'calls': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'short_circuited': 0,
+            'hedges': 0,
+            'hedge_wins': 0,
+            'fallbacks': 0,
+            'deadline_exceeded': 0,
+        }
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def record_latency(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+        observe(self.stage, seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, None until enough latencies were recorded."""
+        if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return max(LLM_HEDGE_MIN_DELAY, self.percentile(LLM_HEDGE_PERCENTILE))
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            'circuit_open': int(self.breaker.state != "closed"),
+            'circuit_opens': self.breaker.opens,
+            'p50_seconds': self.percentile(0.50) or 0.0,
+            'p95_seconds': self.percentile(0.95) or 0.0,
+            'p99_seconds': self.percentile(0.99) or 0.0,
+        }
+
+
+def get_model_state(model: str) -> ModelState:
+    state = _models.get(model)
+    if state is None:
+        with _models_lock:
+            state = _models.setdefault(model, ModelState(model))
+    return state
+
+
+def get_llm_stats() -> dict:
+    """Counters, circuit state and latency percentiles per model."""
+    with _models_lock:
+        models = dict(_models)
+    return {model: state.to_dict() for model, state in models.items()}
+
+
+def reset_llm_state():
+    """Forget breakers and latencies (used by benchmarks)."""
+    with _models_lock:
+        _models.clear()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Shared pool model calls run on, so callers can stop waiting at their deadline."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=LLM_CALL_WORKERS, thread_name_prefix="llm")
+    return _executor
+
+
+def _reset_after_fork():
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@contextmanager
+def deadline(seconds: float = LLM_REQUEST_DEADLINE):
+    """Bound every model call made in this context to finish within seconds from now.
+
+    Nested deadlines can only shorten the enclosing one. The deadline follows the context into
+    prefetch threads and model call threads.
+    """
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, None without one."""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def attempt_timeout(timeout: Optional[float] = None) -> float:
+    """Timeout for the next attempt: the per-call timeout, cut to what is left of the deadline."""
+    timeout = timeout or LLM_CALL_TIMEOUT
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise LLMTimeout("Request deadline exceeded")
+    return min(timeout, left)
+
+
+def stop_at_deadline(retry_state) -> bool:
+    """tenacity stop condition: no further attempts once the request deadline has passed."""
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def _submit(fn: Callable):
+    context = contextvars.copy_context()
+    return get_executor().submit(context.run, fn)
+
+
+def _budget(timeout: Optional[float]) -> Tuple[float, bool]:
+    """Seconds to wait for the next answer, and whether the request deadline cut them short."""
+    timeout = timeout or LLM_CALL_TIMEOUT
+    wait_for = attempt_timeout(timeout)
+    return wait_for, wait_for < timeout
+
+
+def _begin(state: ModelState):
+    if not state.breaker.allow():
+        state._count('short_circuited')
+        raise CircuitOpen(f"Circuit for {state.model} is open")
+    state._count('calls')
+
+
+def _failed(state: ModelState, error: Exception, deadline_cut: bool = False):
+    if isinstance(error, LLMTimeout) and deadline_cut:
+        # The request spent its time elsewhere (tools, SQL), the model is not to blame
+        state._count('deadline_exceeded')
+        state.breaker.release()
+        return
+    state._count('failures')
+    if isinstance(error, LLMTimeout):
+        state._count('timeouts')
+    state.breaker.record_failure()
+
+
+def call(model: str, fn: Callable, timeout: Optional[float] = None, hedge: bool = False):
+    """Run fn() (a call to model) with a timeout, the request deadline and model's circuit breaker.
+
+    With hedge (for stateless calls only) and LLM_HEDGE_ENABLED, a duplicate call is sent once
+    the first has run longer than the model's recent p95 latency; the first answer wins.
+    fn runs under a deadline of the call's own timeout, so retries inside it (tenacity with
+    stop_at_deadline) and their per-attempt timeouts stop when the call gives up on it.
+    Raises CircuitOpen without calling fn when the circuit is open, LLMTimeout when the call
+    does not finish in time, and otherwise whatever fn raised. Timeouts caused by the request
+    deadline rather than the per-call timeout do not count against the model's circuit.
+    """
+    state = get_model_state(model)
+    wait_for, deadline_cut = _budget(timeout)
+    _begin(state)
+    start = time.monotonic()
+    try:
+        def bounded():
+            with deadline(start + wait_for - time.monotonic()):
+                return fn()
+
+        futures = [_submit(bounded)]
+        hedge_delay = state.hedge_delay() if hedge and LLM_HEDGE_ENABLED else None
+        if hedge_delay is not None and hedge_delay < wait_for:
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                state._count('hedges')
+                futures.append(_submit(bounded))
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, start + wait_for - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise LLMTimeout(f"{model} did not answer within {wait_for:.1f}s")
+            for future in done:
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        state._count('hedge_wins')
+                    result = future.result()
+                    break
+                error = future.exception()
+            else:
+                continue
+            break
+        else:
+            raise error
+    except Exception as e:
+        _failed(state, e, deadline_cut)
+        raise
+
+    state.record_latency(time.monotonic() - start)
+    state.breaker.record_success()
+    return result
+
+
+def call_with_fallback(candidates: List[Tuple[str, Callable]], timeout: Optional[float] = None,
+                       hedge: bool = False):
+    """Call the first available model of candidates [(model, fn), ...], failing over in order.
+
+    Models with an open circuit are skipped, a failed or timed out call moves on to the next
+    model. Raises LLMUnavailable with every model's error when none answered.
+    """
+    errors = {}
+    for index, (model, fn) in enumerate(candidates):
+        if index:
+            get_model_state(model)._count('fallbacks')
+        try:
+            return call(model, fn, timeout=timeout, hedge=hedge)
+        except Exception as e:
+            errors[model] = e
+            if not isinstance(e, CircuitOpen):
+                print(f"Model call to {model} failed: {e!r}")
+            left = remaining()
+            if left is not None and left <= 0:
+                break
+    raise LLMUnavailable(errors)
+
+
+def stream(model: str, fn: Callable[[], Iterator], timeout: Optional[float] = None,
+           chunk_timeout: Optional[float] = None) -> Iterator:
+    """Iterate over the stream fn() returns, bounding the wait for the first chunk by timeout,
+    for each later chunk by chunk_timeout, and the whole stream by the request deadline."""
+    state = get_model_state(model)
+    wait_for, deadline_cut = _budget(timeout)
+    _begin(state)
+    start = time.monotonic()
+    first_chunk = True
+    sentinel = object()
+    try:
+        iterator = iter(_call_within(fn, wait_for))
+        while True:
+            wait_for, deadline_cut = _budget(timeout if first_chunk else (chunk_timeout or LLM_STREAM_CHUNK_TIMEOUT))
+            future = _submit(lambda: next(iterator, sentinel))
+            done, _ = wait([future], timeout=wait_for)
+            if not done:
+                raise LLMTimeout(f"{model} stream stalled for {wait_for:.1f}s")
+            chunk = future.result()
+            if chunk is sentinel:
+                break
+            if first_chunk:
+                state.record_latency(time.monotonic() - start)
+                first_chunk = False
+            yield chunk
+    except GeneratorExit:
+        # The consumer stopped reading, the model itself did not fail
+        state.breaker.record_success()
+        raise
+    except Exception as e:
+        _failed(state, e, deadline_cut)
+        raise
+    state.breaker.record_success()
+
+
+def _call_within(fn: Callable, timeout: float):
+    """Run fn() on the call pool, waiting at most timeout seconds for it to return."""
+    future = _submit(fn)
+    done, _ = wait([future], timeout=timeout)
+    if not done:
+        raise LLMTimeout(f"Model call did not start answering within {timeout:.1f}s")
+    return future.result()
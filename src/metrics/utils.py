@@ -0,0 +1,187 @@
+import contextvars
+import hmac
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict
+
+from flask import Response, g, has_request_context, request
+
+# Stage timing; when disabled span() returns a shared no-op context manager
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# /metrics requires "Authorization: Bearer <METRICS_TOKEN>"; without a token it is only served
+# when METRICS_PUBLIC=true, for deployments whose ingress is internal only
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "false").lower() == "true"
+
+# Histogram bucket upper bounds, in seconds
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Stage durations of the current request, for the Server-Timing header
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+_histograms: Dict[str, dict] = {}
+_histograms_lock = threading.Lock()
+_collectors: Dict[str, Callable[[], dict]] = {}
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def observe(stage: str, seconds: float):
+    """Record a duration for stage in its histogram and in the current request's timings."""
+    with _histograms_lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'count': 0, 'sum': 0.0}
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        for index, bound in enumerate(HISTOGRAM_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+                break
+
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def _timed_span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def span(stage: str):
+    """Context manager timing a stage, e.g. `with span("history_load"): ...`."""
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return _timed_span(stage)
+
+
+def traced(stage: str):
+    """Decorator timing every call of a function as stage."""
+    def decorator(f):
+        if not METRICS_ENABLED:
+            return f
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with _timed_span(stage):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def register_collector(name: str, collector: Callable[[], dict]):
+    """Expose numeric values returned by collector() as gauges named <name>_<key>."""
+    _collectors[name] = collector
+
+
+def _flatten(prefix: str, values: dict):
+    for key, value in values.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            yield from _flatten(name, value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def render_prometheus() -> str:
+    """Render stage histograms and collector gauges in the Prometheus text format."""
+    lines = [
+        "# HELP stage_duration_seconds Duration of request stages.",
+        "# TYPE stage_duration_seconds histogram",
+    ]
+    with _histograms_lock:
+        histograms = {stage: {**histogram, 'buckets': list(histogram['buckets'])}
+                      for stage, histogram in _histograms.items()}
+
+    for stage, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+            cumulative += count
+            lines.append(f'stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+        lines.append(f'stage_duration_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+        lines.append(f'stage_duration_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+    for collector_name, collector in sorted(_collectors.items()):
+        try:
+            values = collector()
+        except Exception as e:
+            print(f"Metrics collector {collector_name} failed: {e}")
+            continue
+        for name, value in _flatten(collector_name, values):
+            name = "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def get_stage_summary() -> dict:
+    """Count, total and mean seconds per stage (used by benchmarks)."""
+    with _histograms_lock:
+        return {
+            stage: {
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'mean': histogram['sum'] / histogram['count'] if histogram['count'] else 0.0,
+            }
+            for stage, histogram in _histograms.items()
+        }
+
+
+def reset_metrics():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def init_app(app):
+    """Collect per-request stage timings, add Server-Timing headers and serve /metrics."""
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_request_timings():
+        _request_timings.set([])
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        if not has_request_context() or 'request_start' not in g:
+            return response
+        timings = _request_timings.get() or []
+        if not response.is_streamed:
+            entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings]
+            entries.append(f"total;dur={(time.perf_counter() - g.request_start) * 1000:.1f}")
+            response.headers['Server-Timing'] = ", ".join(entries)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        """Prometheus metrics."""
+        if not _metrics_authorized(request.headers.get('Authorization', '')):
+            return Response("Not found", status=404, mimetype="text/plain")
+        return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def _metrics_authorized(auth_header: str) -> bool:
+    if METRICS_TOKEN:
+        return hmac.compare_digest(auth_header.encode('utf-8'), f"Bearer {METRICS_TOKEN}".encode('utf-8'))
+    return METRICS_PUBLIC
@@ -0,0 +1,120 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict, Tuple
+
+# Shared pool for independent I/O started ahead of when its result is needed
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 32))
+
+# Default seconds to wait for a prefetched result, measured from when it was started
+PREFETCH_TIMEOUT = float(os.getenv("PREFETCH_TIMEOUT", 10))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Marks the pool's own threads, which run nested work inline
+_pool_thread = threading.local()
+
+
+class PrefetchTimeout(Exception):
+    """Raised when a prefetched operation misses its deadline."""
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Shared prefetch thread pool, created on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch",
+                                               initializer=_mark_pool_thread)
+    return _executor
+
+
+def _mark_pool_thread():
+    _pool_thread.active = True
+
+
+def in_pool_thread() -> bool:
+    """Whether the caller runs on a prefetch pool thread."""
+    return getattr(_pool_thread, "active", False)
+
+
+def _reset_after_fork():
+    """Forked children get a fresh pool, the parent's threads do not exist there."""
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def submit(fn: Callable, *args, **kwargs):
+    """Run fn on the shared pool with the caller's context (so stage timings reach its request).
+
+    Called from a pool thread, fn runs inline instead: a pool thread waiting on work queued
+    behind it could deadlock the bounded pool once every worker does the same.
+    """
+    if in_pool_thread():
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    context = contextvars.copy_context()
+    return get_executor().submit(context.run, fn, *args, **kwargs)
+
+
+def map_concurrently(fn: Callable, items, timeout: float = PREFETCH_TIMEOUT):
+    """Apply fn to items concurrently on the shared pool, returning results in order.
+
+    From a pool thread (e.g. inside a prefetched operation) the items are processed in turn.
+    """
+    items = list(items)
+    if len(items) < 2 or in_pool_thread():
+        return [fn(item) for item in items]
+    futures = [submit(fn, item) for item in items]
+    deadline = time.monotonic() + timeout
+    try:
+        return [future.result(timeout=max(0.0, deadline - time.monotonic())) for future in futures]
+    except TimeoutError:
+        raise PrefetchTimeout(f"{getattr(fn, '__name__', 'operation')} did not finish within {timeout}s")
+
+
+class Prefetch:
+    """Independent operations started together, each collected with its own deadline.
+
+    prefetch = Prefetch()
+    prefetch.start('history', get_chat_history, user_id, chat_history_id)
+    prefetch.start('prompts', get_prompt_bundle, timeout=5)
+    history = prefetch.result('history')
+
+    Waiting is bounded by each operation's deadline, so the total wait is the slowest
+    operation rather than the sum. Errors raised by an operation are re-raised by result.
+    """
+
+    def __init__(self):
+        self._operations: Dict[str, Tuple[Any, float]] = {}
+
+    def start(self, name: str, fn: Callable, *args, timeout: float = PREFETCH_TIMEOUT, **kwargs):
+        self._operations[name] = (submit(fn, *args, **kwargs), time.monotonic() + timeout)
+        return self
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._operations
+
+    def result(self, name: str):
+        future, deadline = self._operations[name]
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            raise PrefetchTimeout(f"Prefetch of {name} did not finish before its deadline")
+
+    def results(self) -> Dict[str, Any]:
+        return {name: self.result(name) for name in self._operations}
@@ -0,0 +1,101 @@
+import json
+import threading
+from typing import Optional
+
+from src.metrics.utils import traced
+from src.prefetch.utils import map_concurrently
+from src.remote_config.utils import get_gcs_prompt, get_remote_config_value, get_remote_config_version
+
+
+class PromptBundle:
+    """Prompts and tools for task_chat, built once per Remote Config template version."""
+
+    def __init__(self, version, system_instruction: str, function_description: str,
+                 function_parameters: dict):
+        from vertexai.generative_models import FunctionDeclaration, Tool
+
+        self.version = version
+        self.system_instruction = system_instruction
+        self.function_description = function_description
+        self.function_parameters = function_parameters
+
+        # Define diabetes datamart tool
+        get_diabetes_data_output = FunctionDeclaration(
+            name="get_diabetes_data_output",
+            description=function_description,
+            parameters=function_parameters,
+        )
+        self.tools = [
+            Tool(
+                function_declarations=[
+                    get_diabetes_data_output
+                ],
+            )
+        ]
+
+
+# Bundle for the current template version, swapped as a whole when the version changes
+_prompt_bundle: Optional[PromptBundle] = None
+_prompt_bundle_lock = threading.Lock()
+_prompt_bundle_rebuilding = False
+
+
+def _get_prompt_file(key: str, version) -> Optional[str]:
+    config = get_remote_config_value("Prompts", key)
+    if not config:
+        print(f"Configuration not found: Prompts:{key}")
+        return None
+    return get_gcs_prompt(config['fileName'], version=version)
+
+
+def build_prompt_bundle(version=None) -> Optional[PromptBundle]:
+    """Fetch and compile the task_chat prompts, returning None if any configuration is missing."""
+    # The three prompt files are independent downloads, fetch them concurrently
+    system_instruction, function_description, function_parameters = map_concurrently(
+        lambda key: _get_prompt_file(key, version),
+        ["sqlAgentSystemInstruction", "sqlAgentFunctionDescription", "sqlAgentFunctionParameters"]
+    )
+    if system_instruction is None or function_description is None or function_parameters is None:
+        return None
+
+    return PromptBundle(
+        version=version,
+        system_instruction=system_instruction,
+        function_description=function_description,
+        function_parameters=json.loads(function_parameters),
+    )
+
+
+def _rebuild_in_background(version):
+    global _prompt_bundle, _prompt_bundle_rebuilding
+    try:
+        bundle = build_prompt_bundle(version)
+        if bundle is not None:
+            _prompt_bundle = bundle
+    except Exception as e:
+        print(f"Unable to rebuild prompt bundle for version {version}: {e}")
+    finally:
+        _prompt_bundle_rebuilding = False
+
+
+@traced("prompt_bundle")
+def get_prompt_bundle() -> Optional[PromptBundle]:
+    """Get the prompt bundle for the current Remote Config version.
+
+    The first call builds the bundle; when the template version changes the previous bundle
+    keeps being served while a single background rebuild swaps in the new one.
+    """
+    global _prompt_bundle, _prompt_bundle_rebuilding
+    version = get_remote_config_version()
+    bundle = _prompt_bundle
+    if bundle is not None and bundle.version == version:
+        return bundle
+
+    with _prompt_bundle_lock:
+        bundle = _prompt_bundle
+        if bundle is None:
+            _prompt_bundle = bundle = build_prompt_bundle(version)
+        elif bundle.version != version and not _prompt_bundle_rebuilding:
+            _prompt_bundle_rebuilding = True
+            threading.Thread(target=_rebuild_in_background, args=(version,), daemon=True).start()
+    return bundle
@@ -1,7 +1,7 @@
 import time
 import json
 import os
-from google.cloud import storage
+import threading
 from functools import wraps
 from flask import request, Response
 from typing import Optional
@@ -10,6 +10,9 @@ import google.auth
 import google.auth.transport.requests
 import requests
 
+from src.clients.utils import get_storage_client
+from src.metrics.utils import traced
+
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 BASE_URL = 'https://firebaseremoteconfig.googleapis.com'
 REMOTE_CONFIG_ENDPOINT = f'v1/projects/{PROJECT_ID}/remoteConfig'
@@ -18,68 +21,158 @@ REMOTE_CONFIG_URL = f'{BASE_URL}/{REMOTE_CONFIG_ENDPOINT}'
 # Cache for Remote Config values
 remote_config_cache = {}
 remote_config_last_fetch = 0
+remote_config_etag = None
+remote_config_version = None
 REMOTE_CONFIG_CACHE_DURATION = 3600  # 1 hour
+REMOTE_CONFIG_RETRY_INTERVAL = 60  # 1 minute after a failed refresh
+REMOTE_CONFIG_TIMEOUT = 10
 
-# Cache for GCS prompts
-gcs_prompt_cache = {}
+# Single-flight guard for refreshes
+_remote_config_lock = threading.Lock()
+_remote_config_refreshing = False
 
+# Credentials are reused and only refreshed when expired
+_credentials = None
+_credentials_lock = threading.Lock()
 
-def get_access_token():
-    credentials, project_id = google.auth.default(
-        scopes=['https://www.googleapis.com/auth/firebase.remoteconfig']
-    )
-    # Set the quota project
-    credentials = credentials.with_quota_project(project_id)
-    auth_req = google.auth.transport.requests.Request()
-    credentials.refresh(auth_req)
-    return credentials.token
+# Cache for GCS prompts, keyed by (file name, Remote Config version) so template edits pick up new prompts
+gcs_prompt_cache = {}
 
 
-def fetch_remote_config():
+def get_access_token():
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            credentials, project_id = google.auth.default(
+                scopes=['https://www.googleapis.com/auth/firebase.remoteconfig']
+            )
+            # Set the quota project
+            _credentials = credentials.with_quota_project(project_id)
+
+        if not _credentials.valid:
+            auth_req = google.auth.transport.requests.Request()
+            _credentials.refresh(auth_req)
+        return _credentials.token
+
+
+def fetch_remote_config(etag: Optional[str] = None):
+    """Fetch the Remote Config template, returning (template, etag).
+
+    The template is None when the request failed, and the string "not-modified" when the
+    server confirms the template still matches etag.
+    """
     headers = {
         'Authorization': f'Bearer {get_access_token()}',
         'Accept-Encoding': 'gzip',
         'X-goog-user-project': PROJECT_ID
     }
-    resp = requests.get(REMOTE_CONFIG_URL, headers=headers)
+    if etag:
+        headers['If-None-Match'] = etag
+    resp = requests.get(REMOTE_CONFIG_URL, headers=headers, timeout=REMOTE_CONFIG_TIMEOUT)
+    if resp.status_code == 304:
+        return "not-modified", etag
     if resp.status_code == 200:
-        return resp.json()
+        return resp.json(), resp.headers.get('ETag')
     else:
         print('Unable to get template')
         print(resp.text)
-        return None
-
-
+        return None, etag
+
+
+def parse_remote_config(config):
+    """Flatten a Remote Config template into {"group:key": value}."""
+    values = {}
+    if config and 'parameterGroups' in config:
+        for group_name, group_data in config['parameterGroups'].items():
+            if 'parameters' in group_data:
+                for param_key, param_value in group_data['parameters'].items():
+                    if param_value['valueType'] == 'JSON':
+                        values[f"{group_name}:{param_key}"] = json.loads(param_value['defaultValue']['value'])
+                    else:
+                        values[f"{group_name}:{param_key}"] = param_value['defaultValue']['value']
+    return values
+
+
+@traced("remote_config_fetch")
+def refresh_remote_config():
+    """Fetch the template and swap in new values, keeping the last good values on failure."""
+    global remote_config_cache, remote_config_last_fetch, remote_config_etag, remote_config_version
+    try:
+        config, etag = fetch_remote_config(remote_config_etag)
+    except Exception as e:
+        print(f"Unable to fetch Remote Config: {e}")
+        config, etag = None, remote_config_etag
+
+    if config is None:
+        # Retry sooner than a full cache period, serving the last good values meanwhile
+        remote_config_last_fetch = time.time() - REMOTE_CONFIG_CACHE_DURATION + REMOTE_CONFIG_RETRY_INTERVAL
+        return False
+
+    version = config.get('version', {}).get('versionNumber') if isinstance(config, dict) else remote_config_version
+    if config != "not-modified" and (version is None or version != remote_config_version or not remote_config_cache):
+        remote_config_cache = parse_remote_config(config)
+        remote_config_version = version
+    remote_config_etag = etag
+    remote_config_last_fetch = time.time()
+    return True
+
+
+def _refresh_in_background():
+    global _remote_config_refreshing
+    try:
+        refresh_remote_config()
+    finally:
+        _remote_config_refreshing = False
+
+
+@traced("remote_config")
 def get_remote_config_value(parameter_group, key):
-    global remote_config_last_fetch
-    current_time = time.time()
-
-    if current_time - remote_config_last_fetch > REMOTE_CONFIG_CACHE_DURATION:
-        config = fetch_remote_config()
-        if config and 'parameterGroups' in config:
-            for group_name, group_data in config['parameterGroups'].items():
-                if 'parameters' in group_data:
-                    for param_key, param_value in group_data['parameters'].items():
-                        if param_value['valueType'] == 'JSON':
-                            remote_config_cache[f"{group_name}:{param_key}"] = json.loads(param_value['defaultValue']['value'])
-                        else:
-                            remote_config_cache[f"{group_name}:{param_key}"] = param_value['defaultValue']['value']
-        remote_config_last_fetch = current_time
+    """Get a Remote Config value, refreshing a stale template in the background.
+
+    Only the very first lookup in a process waits on the network; afterwards the cached
+    values are served immediately while at most one refresh runs at a time.
+    """
+    global _remote_config_refreshing
+
+    if not remote_config_last_fetch:
+        with _remote_config_lock:
+            if not remote_config_last_fetch:
+                refresh_remote_config()
+    elif time.time() - remote_config_last_fetch > REMOTE_CONFIG_CACHE_DURATION and not _remote_config_refreshing:
+        with _remote_config_lock:
+            if not _remote_config_refreshing:
+                _remote_config_refreshing = True
+                threading.Thread(target=_refresh_in_background, daemon=True).start()
 
     cache_key = f"{parameter_group}:{key}"
     return remote_config_cache.get(cache_key)
 
 
-def get_gcs_prompt(file_name, bucket_name: Optional[str] = None):
+def get_remote_config_version():
+    """Version number of the Remote Config template currently served."""
+    return remote_config_version
+
+
+@traced("prompt_fetch")
+def get_gcs_prompt(file_name, bucket_name: Optional[str] = None, version=None):
     if not bucket_name:
         bucket_name = os.getenv("GOOGLE_CLOUD_BUCKET")
 
-    if file_name not in gcs_prompt_cache:
-        storage_client = storage.Client()
+    if version is None:
+        version = remote_config_version
+
+    cache_key = (file_name, version)
+    if cache_key not in gcs_prompt_cache:
+        storage_client = get_storage_client()
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(f"shared/prompts/{file_name}")
-        gcs_prompt_cache[file_name] = blob.download_as_text()
-    return gcs_prompt_cache[file_name]
+        prompt = blob.download_as_text()
+
+        # Drop prompts cached for older template versions
+        for stale_key in [key for key in gcs_prompt_cache if key[0] == file_name]:
+            gcs_prompt_cache.pop(stale_key, None)
+        gcs_prompt_cache[cache_key] = prompt
+    return gcs_prompt_cache[cache_key]
 
 
 def generate_decorator(parameter_group, endpoint_key):
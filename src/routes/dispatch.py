@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+import src.routes.utils as endpoint_utils
+from src.metrics.utils import traced
+
+# Task dispatch backend: "cloud_tasks" (default) or "in_process"
+TASK_DISPATCH_BACKEND = os.getenv("TASK_DISPATCH_BACKEND", "cloud_tasks")
+
+# In-process backend sizing
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", 4))
+TASK_QUEUE_DEPTH = int(os.getenv("TASK_QUEUE_DEPTH", 16))
+TASK_DEADLINE = float(os.getenv("TASK_DEADLINE", 600))  # 10 minutes
+
+
+class QueueFullError(Exception):
+    """Raised when the in-process task queue is at capacity."""
+
+
+class CloudTasksDispatcher:
+    """Dispatch tasks through Cloud Tasks, which calls back into this service over HTTP."""
+
+    name = "cloud_tasks"
+
+    def dispatch(self, url, payload, **kwargs):
+        return endpoint_utils.create_cloud_task(url, payload, **kwargs)
+
+    def drain(self, timeout: float) -> bool:
+        # Queued tasks live in Cloud Tasks, nothing to wait for
+        return True
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class InProcessDispatcher:
+    """Dispatch tasks to a bounded in-process worker pool.
+
+    At most max_workers tasks run at once and at most queue_depth are waiting; beyond that
+    dispatch raises QueueFullError so the caller can shed load. Tasks still queued when their
+    deadline passes are dropped, and the deadline is forwarded to the handler in the
+    X-Task-Deadline header.
+    """
+
+    name = "in_process"
+
+    def __init__(self, max_workers: int = TASK_WORKERS, queue_depth: int = TASK_QUEUE_DEPTH,
+                 deadline: float = TASK_DEADLINE):
+        self.deadline = deadline
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="task")
+        self._slots = threading.BoundedSemaphore(max_workers + queue_depth)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._outstanding = 0
+        self._accepting = True
+        self._stats = {
+            'dispatched': 0,
+            'rejected': 0,
+            'running': 0,
+            'completed': 0,
+            'failed': 0,
+            'expired': 0,
+            'deadline_exceeded': 0,
+        }
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self._stats[key] += delta
+
+    def dispatch(self, url, payload, **kwargs):
+        if not self._accepting or not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise QueueFullError(f"Task queue is full, rejected task for {url}")
+
+        app = current_app._get_current_object()
+        deadline = time.time() + self.deadline
+        task_payload = {**payload, **kwargs}
+        with self._lock:
+            self._stats['dispatched'] += 1
+            self._outstanding += 1
+        try:
+            self._executor.submit(self._run, app, url, task_payload, deadline)
+        except Exception:
+            self._finish()
+            raise
+        return f"in-process:{url}"
+
+    def _finish(self):
+        self._slots.release()
+        with self._lock:
+            self._outstanding -= 1
+            if not self._outstanding:
+                self._idle.notify_all()
+
+    def _run(self, app, url, payload, deadline):
+        try:
+            if time.time() > deadline:
+                self._count('expired')
+                print(f"Dropping expired task for {url}")
+                return
+
+            self._count('running')
+            try:
+                with app.test_client() as client:
+                    response = client.post(url, json=payload, headers={'X-Task-Deadline': str(deadline)})
+                if response.status_code >= 400:
+                    self._count('failed')
+                    print(f"Task for {url} failed with status {response.status_code}")
+                else:
+                    self._count('completed')
+                if time.time() > deadline:
+                    self._count('deadline_exceeded')
+            finally:
+                self._count('running', -1)
+        except Exception as e:
+            self._count('failed')
+            print(f"Error occurred in task for {url}: {e}\n{traceback.format_exc()}")
+        finally:
+            self._finish()
+
+    def drain(self, timeout: float) -> bool:
+        """Reject new tasks and wait up to timeout seconds for queued and running ones."""
+        self._accepting = False
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._outstanding, timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': self.name, 'outstanding': self._outstanding, **self._stats}
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Get the process-wide task dispatcher for the configured backend."""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                if TASK_DISPATCH_BACKEND == InProcessDispatcher.name:
+                    _dispatcher = InProcessDispatcher()
+                else:
+                    _dispatcher = CloudTasksDispatcher()
+    return _dispatcher
+
+
+def set_dispatcher(dispatcher):
+    """Replace the process-wide task dispatcher (e.g. in tests or load tests)."""
+    global _dispatcher
+    _dispatcher = dispatcher
+
+
+@traced("task_enqueue")
+def dispatch_task(url, payload, **kwargs):
+    """Dispatch a background task to url with the configured backend."""
+    return get_dispatcher().dispatch(url, payload, **kwargs)
+
+
+def drain_tasks(timeout: float) -> bool:
+    """Stop dispatching and wait for in-process tasks, returning whether they all finished."""
+    if _dispatcher is None:
+        return True
+    return _dispatcher.drain(timeout)
@@ -0,0 +1,195 @@
+import binascii
+import os
+import tempfile
+import threading
+from typing import Iterable, Optional, Tuple
+
+from flask import Request, jsonify, request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+# Whole request body; larger Content-Lengths are rejected before anything is read
+INGEST_MAX_REQUEST_BYTES = int(os.getenv("INGEST_MAX_REQUEST_BYTES", 48 * 1024 * 1024))  # 48 MB
+
+# Each uploaded file part, checked while it streams in
+INGEST_MAX_PART_BYTES = int(os.getenv("INGEST_MAX_PART_BYTES", 32 * 1024 * 1024))  # 32 MB
+
+# Each non-file form field, such as the JSON payload (which may carry base64 audio)
+INGEST_MAX_FIELD_BYTES = int(os.getenv("INGEST_MAX_FIELD_BYTES", 36 * 1024 * 1024))  # 36 MB
+
+# Bytes of a part kept in memory before it spills to a temporary file
+INGEST_SPOOL_MAX_MEMORY = int(os.getenv("INGEST_SPOOL_MAX_MEMORY", 1024 * 1024))  # 1 MB
+
+# Leading bytes used to detect the MIME type
+SNIFF_BYTES = 2048
+
+# Base64 characters decoded at a time (a multiple of 4)
+BASE64_CHUNK_CHARS = 64 * 1024
+
+ingest_stats = {
+    'parts': 0,
+    'spilled': 0,
+    'bytes': 0,
+    'rejected_size': 0,
+    'rejected_type': 0,
+    'rejected_invalid': 0,
+}
+_stats_lock = threading.Lock()
+
+# One libmagic handle per thread, libmagic is not thread-safe and opening it loads the database
+_local = threading.local()
+
+
+def _count(name: str, value: int = 1):
+    with _stats_lock:
+        ingest_stats[name] += value
+
+
+class InvalidUpload(BadRequest):
+    """Raised when an upload cannot be decoded, e.g. malformed base64."""
+
+
+class SpooledPart(tempfile.SpooledTemporaryFile):
+    """Buffer for an uploaded file part: in memory up to max_memory, on disk beyond, rejected
+    past max_bytes. Keeps the leading bytes so the MIME type is sniffed without reading back."""
+
+    def __init__(self, max_bytes: int = INGEST_MAX_PART_BYTES, max_memory: int = INGEST_SPOOL_MAX_MEMORY):
+        super().__init__(max_size=max_memory)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.head = b""
+        self._mime_type = None
+        _count('parts')
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            _count('rejected_size')
+            raise RequestEntityTooLarge(f"Uploaded file exceeds {self.max_bytes} bytes")
+        if len(self.head) < SNIFF_BYTES:
+            self.head += bytes(data[:SNIFF_BYTES - len(self.head)])
+        _count('bytes', len(data))
+        rolled = self._rolled
+        written = super().write(data)
+        if self._rolled and not rolled:
+            _count('spilled')
+        return written
+
+    @property
+    def mime_type(self) -> str:
+        if self._mime_type is None:
+            self._mime_type = sniff_mime(self.head)
+        return self._mime_type
+
+
+class IngestRequest(Request):
+    """Request that streams multipart file parts into SpooledPart buffers."""
+
+    max_form_memory_size = INGEST_MAX_FIELD_BYTES
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if content_length and content_length > INGEST_MAX_PART_BYTES:
+            _count('rejected_size')
+            raise RequestEntityTooLarge(f"Uploaded file exceeds {INGEST_MAX_PART_BYTES} bytes")
+        return SpooledPart()
+
+
+def sniff_mime(head: bytes) -> str:
+    """MIME type of data from its leading bytes, using this thread's cached detector."""
+    detector = getattr(_local, "magic", None)
+    if detector is None:
+        import magic
+        detector = _local.magic = magic.Magic(mime=True)
+    return detector.from_buffer(bytes(head[:SNIFF_BYTES]))
+
+
+def is_allowed_mime_type(mime_type: str, allowed_mime_types: Iterable[str]) -> bool:
+    """Whether mime_type is listed, entries ending in "/" allow every subtype (e.g. "image/")."""
+    return any(mime_type == allowed or (allowed.endswith("/") and mime_type.startswith(allowed))
+               for allowed in allowed_mime_types)
+
+
+def _check_upload(size: int, mime_type: str, allowed_mime_types: Iterable[str], max_bytes: int):
+    if size > max_bytes:
+        _count('rejected_size')
+        raise RequestEntityTooLarge(f"Upload exceeds {max_bytes} bytes")
+    if not is_allowed_mime_type(mime_type, allowed_mime_types):
+        _count('rejected_type')
+        raise UnsupportedMediaType(f"Unsupported upload type: {mime_type}")
+
+
+def open_upload(name: str, allowed_mime_types: Iterable[str], max_bytes: int) -> Tuple[Optional[object], Optional[str]]:
+    """The stream and sniffed MIME type of uploaded file `name`, or (None, None) when absent.
+
+    Size and type are checked before the body is read, raising RequestEntityTooLarge or
+    UnsupportedMediaType. The stream is positioned at the start of the upload.
+    """
+    upload = request.files.get(name)
+    if upload is None:
+        return None, None
+
+    stream = upload.stream
+    if isinstance(stream, SpooledPart):
+        size, mime_type = stream.size, stream.mime_type
+    else:
+        head = stream.read(SNIFF_BYTES)
+        size = stream.seek(0, os.SEEK_END)
+        stream.seek(0)
+        mime_type = sniff_mime(head)
+
+    _check_upload(size, mime_type, allowed_mime_types, max_bytes)
+    return stream, mime_type
+
+
+def decode_base64_upload(text: str, allowed_mime_types: Iterable[str], max_bytes: int):
+    """Decode base64 text a chunk at a time into a SpooledPart, returning (stream, MIME type).
+
+    The decoded size is estimated and the MIME type sniffed from the first chunk before the
+    rest is decoded, so oversized or unsupported payloads are rejected without decoding them.
+    Malformed base64 raises InvalidUpload (a 400).
+    """
+    if not isinstance(text, str):
+        _count('rejected_invalid')
+        raise InvalidUpload("Base64 upload must be a string")
+    if len(text) // 4 * 3 > max_bytes + 3:
+        _count('rejected_size')
+        raise RequestEntityTooLarge(f"Upload exceeds {max_bytes} bytes")
+
+    # Chunks stay aligned to 4 characters unless the text is wrapped
+    wrapped = any(whitespace in text for whitespace in "\n\r\t ")
+    part = SpooledPart(max_bytes=max_bytes)
+    carry = ""
+    try:
+        for start in range(0, len(text), BASE64_CHUNK_CHARS):
+            chunk = text[start:start + BASE64_CHUNK_CHARS]
+            if wrapped:
+                chunk = carry + "".join(chunk.split())
+            usable = len(chunk) - len(chunk) % 4
+            part.write(binascii.a2b_base64(chunk[:usable]))
+            carry = chunk[usable:]
+            if start == 0:
+                _check_upload(0, part.mime_type, allowed_mime_types, max_bytes)
+        if carry:
+            part.write(binascii.a2b_base64(carry + "=" * (-len(carry) % 4)))
+    except ValueError as e:
+        # binascii.Error, or non-ASCII characters
+        part.close()
+        _count('rejected_invalid')
+        raise InvalidUpload(f"Invalid base64 upload: {e}")
+    except Exception:
+        part.close()
+        raise
+
+    part.seek(0)
+    return part, part.mime_type
+
+
+def init_app(app):
+    """Stream uploads through size-capped spooled buffers and answer rejections with JSON."""
+    app.request_class = IngestRequest
+    app.config["MAX_CONTENT_LENGTH"] = INGEST_MAX_REQUEST_BYTES
+
+    @app.errorhandler(RequestEntityTooLarge)
+    @app.errorhandler(UnsupportedMediaType)
+    @app.errorhandler(InvalidUpload)
+    def upload_rejected(e):
+        return jsonify({'error': e.description}), e.code
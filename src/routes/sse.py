@@ -0,0 +1,84 @@
+import json
+import os
+import queue
+import threading
+from flask import Response
+
+# Seconds of silence before a heartbeat comment is sent to keep the connection open
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", 15))
+
+# Maximum events buffered between the producer and a slow client
+SSE_MAX_BUFFERED_EVENTS = int(os.getenv("SSE_MAX_BUFFERED_EVENTS", 64))
+
+_DONE = object()
+
+
+def format_sse(data, event: str = None) -> str:
+    """Format a single Server-Sent Event frame."""
+    message = f"event: {event}\n" if event else ""
+    payload = data if isinstance(data, str) else json.dumps(data)
+    for line in payload.split("\n"):
+        message += f"data: {line}\n"
+    return message + "\n"
+
+
+def stream_events(produce, heartbeat_interval: float = None, max_buffered_events: int = None):
+    """Run produce(cancel_event) on a worker thread and yield its events as SSE frames.
+
+    The bounded queue applies backpressure to the producer when the client reads slowly,
+    heartbeats are sent while the producer is busy, and closing this generator (client
+    disconnect) sets cancel_event so the producer can stop.
+    """
+    heartbeat_interval = heartbeat_interval or SSE_HEARTBEAT_INTERVAL
+    events = queue.Queue(maxsize=max_buffered_events or SSE_MAX_BUFFERED_EVENTS)
+    cancel_event = threading.Event()
+
+    def put(item):
+        while not cancel_event.is_set():
+            try:
+                events.put(item, timeout=heartbeat_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        producer = produce(cancel_event)
+        try:
+            for event in producer:
+                if not put(event):
+                    break
+        except Exception as e:
+            print(f"Error occurred while streaming: {e}")
+            put({'event': 'error', 'data': 'Please try again. An unexpected error occurred.'})
+        finally:
+            producer.close()
+            put(_DONE)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    try:
+        while True:
+            try:
+                item = events.get(timeout=heartbeat_interval)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+
+            if item is _DONE:
+                break
+            yield format_sse(item.get('data'), item.get('event'))
+    finally:
+        cancel_event.set()
+
+
+def sse_response(produce, **kwargs):
+    """Build a streaming text/event-stream response from an event producer."""
+    return Response(
+        stream_events(produce, **kwargs),
+        mimetype="text/event-stream",
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        }
+    )
@@ -1,11 +1,113 @@
+import hashlib
 import json
 import os
 import random
-from google.cloud import tasks_v2
+import threading
+import time
+from collections import OrderedDict
 from flask import jsonify
 from firebase_admin import auth
 
+from src.clients.utils import get_tasks_client
+from src.metrics.utils import traced
+
+
+# Verified ID tokens, keyed by token hash, in least recently used order
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", 10000))
+AUTH_CHECK_REVOKED = os.getenv("AUTH_CHECK_REVOKED", "false").lower() == "true"
+AUTH_REVOCATION_CHECK_INTERVAL = int(os.getenv("AUTH_REVOCATION_CHECK_INTERVAL", 300))  # 5 minutes
+
+auth_token_cache = OrderedDict()
+auth_token_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'expired': 0,
+    'revoked': 0,
+}
+_auth_token_cache_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _auth_token_cache_lock:
+        auth_token_cache_stats[name] += 1
+
+
+def _token_key(auth_token: str) -> str:
+    return hashlib.sha256(auth_token.encode('utf-8')).hexdigest()
+
+
+def _is_revoked(decoded_token) -> bool:
+    """Slow path: check whether the user's tokens were revoked or the account disabled."""
+    user = auth.get_user(decoded_token['uid'])
+    if user.disabled:
+        return True
+    valid_after = (user.tokens_valid_after_timestamp or 0) / 1000
+    return decoded_token.get('iat', 0) < valid_after
+
+
+def _get_cached_token(key: str):
+    now = time.time()
+    with _auth_token_cache_lock:
+        entry = auth_token_cache.get(key)
+        if entry is None:
+            return None
+        if entry['decoded']['exp'] <= now:
+            auth_token_cache.pop(key, None)
+            auth_token_cache_stats['expired'] += 1
+            return None
+        auth_token_cache.move_to_end(key)
+        if not AUTH_CHECK_REVOKED or now - entry['revocation_checked_at'] < AUTH_REVOCATION_CHECK_INTERVAL:
+            return entry['decoded']
+
+    if _is_revoked(entry['decoded']):
+        with _auth_token_cache_lock:
+            auth_token_cache.pop(key, None)
+            auth_token_cache_stats['revoked'] += 1
+        raise auth.RevokedIdTokenError('The Firebase ID token has been revoked.')
+    entry['revocation_checked_at'] = now
+    return entry['decoded']
+
+
+def _cache_token(key: str, decoded_token):
+    with _auth_token_cache_lock:
+        auth_token_cache[key] = {'decoded': decoded_token, 'revocation_checked_at': time.time()}
+        auth_token_cache.move_to_end(key)
+        while len(auth_token_cache) > AUTH_TOKEN_CACHE_SIZE:
+            auth_token_cache.popitem(last=False)
+
+
+def verify_id_token_cached(auth_token: str):
+    """Verify an ID token, skipping signature verification for tokens verified before.
+
+    Entries expire with the token's exp claim. With AUTH_CHECK_REVOKED, revocation is checked
+    on verification and again at most every AUTH_REVOCATION_CHECK_INTERVAL seconds.
+    """
+    key = _token_key(auth_token)
+    decoded_token = _get_cached_token(key)
+    if decoded_token is not None:
+        _count('hits')
+        return decoded_token
+
+    _count('misses')
+    decoded_token = auth.verify_id_token(auth_token, check_revoked=AUTH_CHECK_REVOKED)
+    _cache_token(key, decoded_token)
+    return decoded_token
+
+
+def get_auth_token_cache_stats():
+    """Counters and hit rate of the verified token cache."""
+    with _auth_token_cache_lock:
+        stats = dict(auth_token_cache_stats)
+        size = len(auth_token_cache)
+    lookups = stats['hits'] + stats['misses']
+    return {
+        **stats,
+        'size': size,
+        'hit_rate': stats['hits'] / lookups if lookups else 0.0,
+    }
+
 
+@traced("auth")
 def verify_auth_token(request):
     auth_header = request.headers.get('Authorization')
     if not auth_header:
@@ -13,13 +115,14 @@ def verify_auth_token(request):
 
     try:
         auth_token = auth_header.split(' ')[1]
-        return auth.verify_id_token(auth_token)
+        return verify_id_token_cached(auth_token)
     except IndexError:
         return jsonify({'error': 'Invalid authorization header format'}), 401
-    except auth.InvalidIdTokenError:
+    except (auth.InvalidIdTokenError, auth.UserDisabledError):
         return jsonify({'error': 'Invalid authorization token'}), 401
 
 
+@traced("parse_json")
 def parse_json_data(request):
     """Parse JSON data from the request."""
     if 'json' in request.files:
@@ -30,11 +133,14 @@ def parse_json_data(request):
         json_data = request.form.get('json')
         return json.loads(json_data) if json_data else {}
     else:
-        return request.json or {}
+        # Not cached, so the raw body is released once parsed (it may carry base64 audio)
+        return request.get_json(cache=False) or {}
 
 
 def create_cloud_task(url, payload, **kwargs):
-    client = tasks_v2.CloudTasksClient()
+    from google.cloud import tasks_v2
+
+    client = get_tasks_client()
 
     # Determine project ID
     project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
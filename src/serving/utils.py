@@ -0,0 +1,165 @@
+import importlib
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Tuple
+
+from flask import jsonify
+
+# Seconds a worker waits for warmup before accepting requests (warmup keeps running afterwards).
+# 0 accepts immediately for the fastest cold start; gate traffic with a /readyz startup probe instead
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 0))
+
+# Seconds allowed for in-flight work to finish after SIGTERM (Cloud Run kills the instance after 10)
+GRACEFUL_TIMEOUT = float(os.getenv("GRACEFUL_TIMEOUT", 8))
+
+# Import the warmup modules in the parent process before forking: workers share their memory,
+# but the server only starts listening once they are loaded
+PRELOAD_MODULES = os.getenv("PRELOAD_MODULES", "false").lower() == "true"
+
+# Hooks run before forking (CPU only, no clients or threads) and after forking in each worker
+_preload_hooks: List[Tuple[str, Callable[[], None]]] = []
+_warmup_hooks: List[Tuple[str, Callable[[], None]]] = []
+
+# Heavy modules loaded on first use or, ahead of it, at the start of warmup
+_warmup_imports: List[str] = []
+
+warmup_status: Dict[str, dict] = {}
+_warmup_started = False
+_warmup_lock = threading.Lock()
+_ready = threading.Event()
+_draining = threading.Event()
+_drain_started_at = None
+
+
+def register_preload_hook(name: str, hook: Callable[[], None]):
+    """Run hook once in the parent process before workers fork (e.g. load tokenizers)."""
+    _preload_hooks.append((name, hook))
+
+
+def register_warmup_hook(name: str, hook: Callable[[], None]):
+    """Run hook in every worker before it reports ready (e.g. create clients, prime caches)."""
+    _warmup_hooks.append((name, hook))
+
+
+def register_warmup_import(module_name: str):
+    """Import module_name at the start of warmup, before the warmup hooks run."""
+    _warmup_imports.append(module_name)
+
+
+def import_warmup_modules():
+    """Import the warmup modules one after another (concurrent imports can deadlock)."""
+    for module_name in _warmup_imports:
+        importlib.import_module(module_name)
+
+
+def _run_hook(kind: str, name: str, hook: Callable[[], None]):
+    start = time.perf_counter()
+    status = {'status': 'running'}
+    if kind == "warmup":
+        warmup_status[name] = status
+    try:
+        hook()
+        status['status'] = 'ok'
+    except Exception as e:
+        status.update(status='failed', error=str(e))
+        print(f"{kind.capitalize()} hook {name} failed: {e}\n{traceback.format_exc()}")
+    status['seconds'] = round(time.perf_counter() - start, 3)
+
+
+def run_preload():
+    """Run the preload hooks in order, after importing the warmup modules with PRELOAD_MODULES."""
+    if PRELOAD_MODULES:
+        _run_hook("preload", "imports", import_warmup_modules)
+    for name, hook in _preload_hooks:
+        _run_hook("preload", name, hook)
+
+
+def start_warmup(timeout: float = None) -> bool:
+    """Import the warmup modules, then run the warmup hooks concurrently and mark the worker
+    ready once all have finished.
+
+    Waits up to timeout seconds (0 returns immediately) and returns whether warmup completed.
+    Failed hooks are reported by /readyz but do not block readiness, the lazy paths retry them.
+    """
+    global _warmup_started
+    with _warmup_lock:
+        if not _warmup_started:
+            _warmup_started = True
+
+            def warmup():
+                _run_hook("warmup", "imports", import_warmup_modules)
+                threads = [threading.Thread(target=_run_hook, args=("warmup", name, hook), daemon=True)
+                           for name, hook in _warmup_hooks]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                _ready.set()
+                print(f"Warmup complete: {warmup_status}")
+
+            threading.Thread(target=warmup, daemon=True).start()
+
+    return _ready.wait(WARMUP_TIMEOUT if timeout is None else timeout)
+
+
+def is_ready() -> bool:
+    return _ready.is_set() and not _draining.is_set()
+
+
+def is_draining() -> bool:
+    return _draining.is_set()
+
+
+def begin_drain():
+    """Stop reporting ready so no new traffic is routed here."""
+    global _drain_started_at
+    if not _draining.is_set():
+        print("Draining: no longer accepting new work")
+        _drain_started_at = time.monotonic()
+        _draining.set()
+
+
+def drain(timeout: float = GRACEFUL_TIMEOUT):
+    """Stop accepting work and wait for queued background tasks.
+
+    The wait is bounded by what is left of timeout since draining began, so the total stays
+    within the platform's shutdown grace period.
+    """
+    from src.routes.dispatch import drain_tasks
+
+    begin_drain()
+    remaining = max(0.0, timeout - (time.monotonic() - _drain_started_at))
+    if not drain_tasks(remaining):
+        print(f"Background tasks still running after {timeout}s drain")
+
+
+def install_signal_handlers(timeout: float = GRACEFUL_TIMEOUT):
+    """Drain and exit on SIGTERM when serving without gunicorn (python main.py)."""
+    def handle_sigterm(signum, frame):
+        drain(timeout)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def init_app(app):
+    """Serve /healthz (liveness) and /readyz (ready after warmup, unready while draining)."""
+    @app.route("/healthz")
+    def healthz():
+        """Liveness probe."""
+        return jsonify({'status': 'ok'})
+
+    @app.route("/readyz")
+    def readyz():
+        """Readiness probe."""
+        if is_draining():
+            status = 'draining'
+        elif _ready.is_set():
+            status = 'ready'
+        else:
+            status = 'warming_up'
+        return jsonify({'status': status, 'warmup': warmup_status}), 200 if status == 'ready' else 503
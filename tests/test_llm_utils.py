@@ -0,0 +1,164 @@
+import itertools
+import time
+
+import pytest
+
+import src.llm.utils as llm_utils
+from src.llm.utils import CircuitBreaker, CircuitOpen, LLMTimeout, LLMUnavailable
+
+MODEL = "model"
+
+
+@pytest.fixture(autouse=True)
+def fresh_model_state():
+    llm_utils.reset_llm_state()
+    yield
+    llm_utils.reset_llm_state()
+
+
+def fail():
+    raise RuntimeError("model error")
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failures=3, reset=60)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    breaker.record_success()
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.opens == 1
+
+
+def test_breaker_lets_one_trial_through_when_half_open():
+    breaker = CircuitBreaker(failures=1, reset=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = CircuitBreaker(failures=1, reset=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert breaker.opens == 2
+
+
+def test_released_trial_lets_the_next_one_through():
+    breaker = CircuitBreaker(failures=1, reset=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert breaker.opens == 1
+
+
+def test_call_returns_and_records_latency():
+    assert llm_utils.call(MODEL, lambda: "answer") == "answer"
+    state = llm_utils.get_model_state(MODEL)
+    assert state.stats['calls'] == 1
+    assert len(state.latencies) == 1
+
+
+def test_call_errors_count_against_the_circuit(monkeypatch):
+    state = llm_utils.get_model_state(MODEL)
+    monkeypatch.setattr(state, "breaker", CircuitBreaker(failures=2, reset=60))
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            llm_utils.call(MODEL, fail)
+
+    calls = []
+    with pytest.raises(CircuitOpen):
+        llm_utils.call(MODEL, lambda: calls.append(1))
+    assert not calls
+    assert state.stats['failures'] == 2
+    assert state.stats['short_circuited'] == 1
+
+
+def test_call_timeout_is_a_model_failure():
+    with pytest.raises(LLMTimeout):
+        llm_utils.call(MODEL, lambda: time.sleep(0.5), timeout=0.1)
+    state = llm_utils.get_model_state(MODEL)
+    assert state.stats['timeouts'] == 1
+    assert state.breaker.consecutive_failures == 1
+
+
+def test_request_deadline_timeouts_do_not_count_against_the_model():
+    state = llm_utils.get_model_state(MODEL)
+    with llm_utils.deadline(0.1):
+        with pytest.raises(LLMTimeout):
+            llm_utils.call(MODEL, lambda: time.sleep(0.5), timeout=5)
+    with llm_utils.deadline(0):
+        with pytest.raises(LLMTimeout, match="deadline"):
+            llm_utils.call(MODEL, lambda: "answer", timeout=5)
+
+    assert state.stats['calls'] == 1
+    assert state.stats['deadline_exceeded'] == 1
+    assert state.stats['failures'] == 0
+    assert state.breaker.consecutive_failures == 0
+
+
+def test_fn_runs_under_the_call_budget():
+    seen = []
+    with llm_utils.deadline(60):
+        llm_utils.call(MODEL, lambda: seen.append(llm_utils.remaining()), timeout=2)
+    assert 1.5 < seen[0] <= 2
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins(monkeypatch):
+    monkeypatch.setattr(llm_utils, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(llm_utils, "LLM_HEDGE_MIN_SAMPLES", 1)
+    monkeypatch.setattr(llm_utils, "LLM_HEDGE_MIN_DELAY", 0.05)
+    state = llm_utils.get_model_state(MODEL)
+    state.record_latency(0.05)
+    attempts = itertools.count()
+
+    def slow_then_fast():
+        if next(attempts) == 0:
+            time.sleep(1)
+            return "slow"
+        return "fast"
+
+    start = time.monotonic()
+    assert llm_utils.call(MODEL, slow_then_fast, timeout=5, hedge=True) == "fast"
+    assert time.monotonic() - start < 0.5
+    assert state.stats['hedges'] == 1
+    assert state.stats['hedge_wins'] == 1
+
+
+def test_calls_are_not_hedged_without_hedge(monkeypatch):
+    monkeypatch.setattr(llm_utils, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(llm_utils, "LLM_HEDGE_MIN_SAMPLES", 1)
+    monkeypatch.setattr(llm_utils, "LLM_HEDGE_MIN_DELAY", 0.05)
+    state = llm_utils.get_model_state(MODEL)
+    state.record_latency(0.05)
+
+    assert llm_utils.call(MODEL, lambda: time.sleep(0.2) or "answer", timeout=5) == "answer"
+    assert state.stats['hedges'] == 0
+
+
+def test_fallback_moves_on_to_the_next_model():
+    assert llm_utils.call_with_fallback([("primary", fail), ("secondary", lambda: "answer")]) == "answer"
+    assert llm_utils.get_model_state("secondary").stats['fallbacks'] == 1
+
+    with pytest.raises(LLMUnavailable) as raised:
+        llm_utils.call_with_fallback([("primary", fail), ("secondary", fail)])
+    assert set(raised.value.errors) == {"primary", "secondary"}
@@ -0,0 +1,76 @@
+import threading
+import time
+
+# Imported by the writer on its first write, which would otherwise take longer than the intervals below
+from google.cloud import firestore  # noqa: F401
+
+from benchmarks.fakes import FakeFirestoreClient, Latency
+from src.chat.progress import ChatProgressWriter
+
+CHAT_PATH = "users/user/chats/chat"
+
+
+class RecordingFirestore(FakeFirestoreClient):
+    """Fake Firestore keeping the order of writes to the chat document."""
+
+    def __init__(self, latency: Latency):
+        super().__init__(latency)
+        self.log = []
+
+    def write(self, path: str, data: dict, merge: bool):
+        super().write(path, data, merge)
+        if path == CHAT_PATH:
+            self.log.append(data['status'])
+
+
+def make_writer(min_interval: float, firestore: float = 0.0, chat_history_id: str = "chat"):
+    db = RecordingFirestore(Latency(firestore=firestore, jitter=0))
+    return db, ChatProgressWriter("user", chat_history_id, db=db, min_interval=min_interval)
+
+
+def test_updates_are_coalesced_into_a_trailing_write():
+    db, writer = make_writer(min_interval=0.5)
+    writer('thinking')
+    for index in range(10):
+        writer('query', query=f"SELECT {index}")
+    writer('executing')
+
+    assert writer.writes == 1
+    time.sleep(0.8)
+    assert writer.writes == 2
+    assert writer.published == 12
+    progress = db.documents[CHAT_PATH]['progress']
+    assert progress['status'] == 'executing'
+    assert progress['queries'] == [f"SELECT {index}" for index in range(10)]
+
+
+def test_nothing_is_written_before_the_chat_exists():
+    db, writer = make_writer(min_interval=0, chat_history_id=None)
+    writer('thinking')
+    assert writer.writes == 0
+    writer('query', chat_history_id="chat", query="SELECT 1")
+    assert db.documents[CHAT_PATH]['progress']['queries'] == ["SELECT 1"]
+
+
+def test_complete_lands_after_a_progress_write_in_flight():
+    db, writer = make_writer(min_interval=0, firestore=0.2)
+    publishing = threading.Thread(target=writer, args=('executing',))
+    publishing.start()
+    time.sleep(0.05)
+    writer.complete("answer")
+    publishing.join(1)
+
+    assert db.log == ['processing', 'completed']
+    assert db.documents[CHAT_PATH]['status'] == 'completed'
+
+
+def test_pending_trailing_write_is_dropped_on_complete():
+    db, writer = make_writer(min_interval=0.2)
+    writer('thinking')
+    writer('executing')
+    writer.complete("answer")
+    writer('late')
+    time.sleep(0.3)
+
+    assert db.log == ['processing', 'completed']
+    assert writer.published == 2
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+from src.chat.sql_cache import ResultCache
+
+
+class Uncacheable(str):
+    cacheable = False
+
+
+def test_concurrent_misses_run_the_query_once():
+    cache = ResultCache(max_bytes=1024)
+    calls = []
+    started = threading.Event()
+
+    def compute():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute)))
+               for _ in range(8)]
+    threads[0].start()
+    started.wait(1)
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+
+    assert results == ["result"] * 8
+    assert len(calls) == 1
+    assert cache.stats()['collapsed'] == 7
+    assert cache.get_or_compute("key", compute) == "result"
+    assert cache.stats()['hits'] == 1
+
+
+def test_failure_reaches_waiters_and_is_not_cached():
+    cache = ResultCache(max_bytes=1024)
+    started = threading.Event()
+
+    def compute():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("query failed")
+
+    errors = []
+
+    def run():
+        try:
+            cache.get_or_compute("key", compute)
+        except ValueError as e:
+            errors.append(e)
+
+    owner = threading.Thread(target=run)
+    owner.start()
+    started.wait(1)
+    waiter = threading.Thread(target=run)
+    waiter.start()
+    owner.join(2)
+    waiter.join(2)
+
+    assert len(errors) == 2
+    assert cache.get_or_compute("key", lambda: "retried") == "retried"
+
+
+def test_total_bytes_stay_within_bound():
+    cache = ResultCache(max_bytes=100)
+    for index in range(10):
+        cache.get_or_compute(f"key{index}", lambda: "x" * 30)
+
+    stats = cache.stats()
+    assert stats['bytes'] <= 100
+    assert stats['entries'] == 3
+    assert stats['evictions'] == 7
+    # Least recently used entries go first
+    assert cache.get_or_compute("key9", lambda: pytest.fail("evicted")) == "x" * 30
+
+
+def test_oversized_and_uncacheable_results_are_not_kept():
+    cache = ResultCache(max_bytes=100)
+    assert cache.get_or_compute("big", lambda: "x" * 101) == "x" * 101
+    assert cache.get_or_compute("link", lambda: Uncacheable("signed url")) == "signed url"
+    assert cache.stats()['entries'] == 0
+    assert cache.stats()['bytes'] == 0
+
+
+def test_bound_counts_encoded_bytes():
+    cache = ResultCache(max_bytes=100)
+    cache.get_or_compute("a", lambda: "é" * 30)
+    cache.get_or_compute("b", lambda: "é" * 30)
+    assert cache.stats()['bytes'] == 60
+    assert cache.stats()['entries'] == 1
@@ -0,0 +1,47 @@
+import pytest
+
+from src.chat.sql_fast_path import SQLValidationError, extract_sql, validate_sql
+
+SCHEMA = {
+    'patients': {'patient_id', 'age', 'gender', 'diagnosis'},
+    'visits': {'visit_id', 'patient_id', 'visited_at', 'cost'},
+}
+
+
+@pytest.mark.parametrize("text, sql", [
+    ("```sql\nSELECT 1;\n```", "SELECT 1"),
+    ("Here you go:\n```\nSELECT age FROM patients\n```\nDone.", "SELECT age FROM patients"),
+    ("SELECT age FROM patients;", "SELECT age FROM patients"),
+    ("CANNOT_ANSWER", None),
+    ("```sql\n;\n```", None),
+])
+def test_extract_sql(text, sql):
+    assert extract_sql(text) == sql
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT COUNT(*) FROM patients WHERE age > 65",
+    "SELECT p.gender, AVG(v.cost) AS avg_cost FROM patients p JOIN visits AS v ON p.patient_id = v.patient_id"
+    " GROUP BY p.gender ORDER BY avg_cost DESC",
+    "WITH older AS (SELECT patient_id FROM patients WHERE age > 65) SELECT COUNT(*) AS n FROM older",
+    "SELECT EXTRACT(YEAR FROM visited_at) AS year, SUM(cost) FROM visits GROUP BY 1",
+    "SELECT REPLACE(diagnosis, 'Type 2', 'T2') FROM patients",
+    "SELECT diagnosis FROM patients WHERE diagnosis = 'drop; delete from patients'",
+    "SELECT COUNT(*) FROM `project.dataset.patients` WHERE gender = 'F'",
+])
+def test_validate_sql_accepts_read_only_queries(sql):
+    validate_sql(sql, SCHEMA)
+
+
+@pytest.mark.parametrize("sql, message", [
+    ("SELECT 1; DROP TABLE patients", "single statement"),
+    ("DELETE FROM patients", "Only SELECT"),
+    ("WITH x AS (SELECT 1) DELETE FROM patients", "read-only"),
+    ("SELECT * FROM doctors", "Unknown table: doctors"),
+    ("SELECT p.weight FROM patients p", "Unknown column: patients.weight"),
+    ("SELECT weight FROM patients", "Unknown column: weight"),
+    ("SELECT cost FROM patients", "Unknown column: cost"),
+])
+def test_validate_sql_rejects(sql, message):
+    with pytest.raises(SQLValidationError, match=message):
+        validate_sql(sql, SCHEMA)